@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys # manage arguments
+import getopt # manage arguments
+import os
+import json # mpmap alignments and dataset description
+import random # deterministic generator
+from strainflair.clusters_index import ClustersIndexWriter
+
+# Synthetic datasets: a pangenome graph (gfa) of gene clusters, its clusters index and vg mpmap alignments (json,
+# as output by vg view -j -K) of reads sampled from the genes of the strains. The same scale and seed always give
+# the same files.
+# Each cluster is a chain of positions. A position is a node shared by all the genes of the cluster (with probability
+# shared_fraction) or a set of alternative nodes (variants). Each strain present in the cluster has one or several
+# copies of a gene, walking one node per position, possibly in reverse orientation.
+
+scales = {
+    "tiny":   {"nb_strains": 4,  "nb_clusters": 20,    "nb_nodes": (3, 10),  "nb_reads": 2000},
+    "small":  {"nb_strains": 10, "nb_clusters": 500,   "nb_nodes": (5, 40),  "nb_reads": 50000},
+    "medium": {"nb_strains": 20, "nb_clusters": 5000,  "nb_nodes": (5, 60),  "nb_reads": 500000},
+    "large":  {"nb_strains": 50, "nb_clusters": 20000, "nb_nodes": (5, 80),  "nb_reads": 2000000},
+}
+
+default_parameters = {
+    "seed": 1,
+    "shared_fraction": 0.6,         # proportion of positions with a single node shared by all genes of the cluster
+    "max_alleles": 3,               # maximal number of alternative nodes of a variant position
+    "max_node_len": 40,
+    "strain_presence": 0.7,         # probability that a strain has a gene in a cluster
+    "duplicate_fraction": 0.1,      # probability that a strain has two copies of a gene
+    "reverse_fraction": 0.2,        # probability that a gene walks the cluster in reverse orientation
+    "max_read_nodes": 6,            # maximal number of nodes of an alignment
+    "error_fraction": 0.2,          # proportion of alignments with a substitution
+    "multi_subpath_fraction": 0.3,  # proportion of alignments split in several subpaths
+    "branch_fraction": 0.1,         # proportion of multi subpath alignments with an alternative (worse) subpath
+    "multi_line_fraction": 0.15,    # proportion of reads with other alignments (other lines), equally good or worse
+    "unmapped_fraction": 0.05,      # proportion of reads without alignment
+}
+
+def get_parameters(scale: str, **parameters):
+    """
+    parameters of a scale (see scales), with default_parameters for the others
+    """
+    scale_parameters = dict(default_parameters)
+    scale_parameters.update(scales[scale])
+    scale_parameters.update(parameters)
+    return scale_parameters
+
+def get_strain_name(strain: int):
+    return "NZ_CP%06d.1" % strain
+
+def generate_pangenome(out_dir: str, parameters):
+    """
+    writes out_dir/graph.gfa and out_dir/clusters_index.db.
+    Returns the length of each node (dict) and the genes: list of (strain, node ids in the orientation of the gene)
+    """
+    rng = random.Random(parameters["seed"])
+    node_len = {}
+    genes = []
+    links = set()
+    nb_genes_strain = [0]*parameters["nb_strains"]
+    index = ClustersIndexWriter(f"{out_dir}/clusters_index.db")
+    with open(f"{out_dir}/graph.gfa", "w") as gfa_file:
+        gfa_file.write("H\tVN:Z:1.0\n")
+        for cluster in range(parameters["nb_clusters"]):
+            # nodes of each position
+            positions = []
+            for _ in range(rng.randint(*parameters["nb_nodes"])):
+                nb_alleles = 1 if rng.random() < parameters["shared_fraction"] else rng.randint(2, parameters["max_alleles"])
+                alleles = []
+                for _ in range(nb_alleles):
+                    node_id = len(node_len)+1
+                    node_len[node_id] = rng.randint(1, parameters["max_node_len"])
+                    gfa_file.write(f"S\t{node_id}\t{''.join(rng.choices('ACGT', k=node_len[node_id]))}\n")
+                    alleles.append(node_id)
+                positions.append(alleles)
+
+            # genes of the strains
+            genes_list = []
+            genes_len = []
+            for strain in range(parameters["nb_strains"]):
+                if rng.random() >= parameters["strain_presence"]:
+                    continue
+                walk = [rng.choice(alleles) for alleles in positions]
+                nb_copies = 2 if rng.random() < parameters["duplicate_fraction"] else 1
+                for _ in range(nb_copies):
+                    nb_genes_strain[strain] += 1
+                    gene_name = f"gi|{cluster}|ref|{get_strain_name(strain)}|_{nb_genes_strain[strain]}"
+                    if rng.random() < parameters["reverse_fraction"]:
+                        gene_walk = walk[::-1]
+                        orientation = "-"
+                    else:
+                        gene_walk = walk
+                        orientation = "+"
+                    gfa_file.write(f"P\t{gene_name}\t{','.join(f'{node_id}{orientation}' for node_id in gene_walk)}\t{','.join(f'{node_len[node_id]}M' for node_id in gene_walk)}\n")
+                    genes.append((strain, gene_walk))
+                    genes_list.append(gene_name)
+                    genes_len.append(sum(node_len[node_id] for node_id in walk))
+                    links.update(zip(walk, walk[1:]))
+            if genes_list:
+                index.add_cluster(f"Cluster_{cluster}", {'genes_list': genes_list, 'genes_len': genes_len, 'len_rep': max(genes_len)})
+        for from_node, to_node in sorted(links):
+            gfa_file.write(f"L\t{from_node}\t+\t{to_node}\t+\t0M\n")
+    index.close()
+    return node_len, genes
+
+def get_mapping(node_ids, node_len, rng, error: bool):
+    """
+    vg mapping of a list of nodes, with a substitution in the first node long enough if error
+    """
+    mapping = []
+    for node_id in node_ids:
+        length = node_len[node_id]
+        if error and length > 2:
+            edit = [{"from_length": 1, "to_length": 1}, {"from_length": 1, "to_length": 1, "sequence": rng.choice("ACGT")}, {"from_length": length-2, "to_length": length-2}]
+            error = False
+        else:
+            edit = [{"from_length": length, "to_length": length}]
+        mapping.append({"position": {"node_id": str(node_id)}, "edit": edit})
+    return mapping
+
+def get_subpaths(node_ids, node_len, rng, parameters, score_penalty=0):
+    """
+    subpaths of an alignment on a list of nodes: a single subpath or a chain of subpaths,
+    the second one possibly having a worse alternative (branch)
+    """
+    error = rng.random() < parameters["error_fraction"]
+    score = sum(node_len[node_id] for node_id in node_ids) - 5*error - score_penalty
+    if len(node_ids) == 1 or rng.random() >= parameters["multi_subpath_fraction"]:
+        return [{"path": {"mapping": get_mapping(node_ids, node_len, rng, error)}, "score": score}]
+    cuts = sorted(rng.sample(range(1, len(node_ids)), min(len(node_ids)-1, rng.randint(1, 2))))
+    parts = [node_ids[start:end] for start, end in zip([0]+cuts, cuts+[len(node_ids)])]
+    subpaths = []
+    for i, part in enumerate(parts):
+        part_score = score//len(parts) if i < len(parts)-1 else score - (score//len(parts))*(len(parts)-1)
+        subpath = {"path": {"mapping": get_mapping(part, node_len, rng, error and i == 0)}}
+        if part_score != 0: # score field is not displayed if = 0
+            subpath["score"] = part_score
+        if i < len(parts)-1:
+            subpath["next"] = [i+1]
+        subpaths.append(subpath)
+    if rng.random() < parameters["branch_fraction"]:
+        # alternative to the second subpath, with a substitution
+        subpaths[0]["next"].append(len(subpaths))
+        branch = {"path": {"mapping": get_mapping(parts[1], node_len, rng, True)}, "score": subpaths[1].get("score", 0)-5}
+        if len(parts) > 2:
+            branch["next"] = [2]
+        subpaths.append(branch)
+    return subpaths
+
+def generate_alignments(out_dir: str, parameters, node_len, genes):
+    """
+    writes out_dir/mapping.json: one json line per alignment, alignments of a read being on successive lines.
+    Reads are sampled from the genes proportionally to the abundance of their strain.
+    Returns the number of reads
+    """
+    rng = random.Random(parameters["seed"]+1)
+    strains_abundance = [rng.random() for _ in range(parameters["nb_strains"])]
+    genes_weights = [strains_abundance[strain] for strain, _ in genes]
+    previous_sequence = None
+    with open(f"{out_dir}/mapping.json", "w") as mapping_file:
+        for read in range(parameters["nb_reads"]):
+            _, walk = rng.choices(genes, weights=genes_weights)[0]
+            start = rng.randrange(len(walk))
+            node_ids = walk[start:start+rng.randint(1, parameters["max_read_nodes"])]
+            if rng.random() < 0.5:
+                node_ids = node_ids[::-1]
+            # successive reads have distinct sequences (lines of a read are grouped by sequence)
+            sequence = previous_sequence
+            while sequence == previous_sequence:
+                sequence = ''.join(rng.choices('ACGT', k=sum(node_len[node_id] for node_id in node_ids)))
+            previous_sequence = sequence
+            alignments = []
+            if rng.random() < parameters["unmapped_fraction"]:
+                alignments.append({"sequence": sequence, "name": f"read{read}"})
+            else:
+                alignments.append({"sequence": sequence, "name": f"read{read}", "subpath": get_subpaths(node_ids, node_len, rng, parameters)})
+                if rng.random() < parameters["multi_line_fraction"]:
+                    # other alignments on another gene, as good (multi mapped read) or worse
+                    for _ in range(rng.randint(1, 2)):
+                        _, other_walk = rng.choice(genes)
+                        other_start = rng.randrange(max(1, len(other_walk)-len(node_ids)+1))
+                        other_node_ids = other_walk[other_start:other_start+len(node_ids)]
+                        alignments.append({"sequence": sequence, "name": f"read{read}", "subpath": get_subpaths(other_node_ids, node_len, rng, parameters, rng.choice([0, 0, 1, 10]))})
+            for alignment in alignments:
+                mapping_file.write(json.dumps(alignment, separators=(',', ':'))+"\n")
+    return parameters["nb_reads"]
+
+def generate_dataset(out_dir: str, scale: str, **parameters):
+    """
+    writes the pangenome, its clusters index, the alignments and dataset.json (parameters and sizes) in out_dir.
+    The dataset is not generated again if out_dir already contains it with the same parameters
+    """
+    parameters = get_parameters(scale, **parameters)
+    dataset_file_name = f"{out_dir}/dataset.json"
+    if os.path.exists(dataset_file_name):
+        with open(dataset_file_name) as dataset_file:
+            dataset = json.load(dataset_file)
+        if dataset["parameters"] == json.loads(json.dumps(parameters)):
+            return dataset
+    os.makedirs(out_dir, exist_ok=True)
+    node_len, genes = generate_pangenome(out_dir, parameters)
+    nb_reads = generate_alignments(out_dir, parameters, node_len, genes)
+    dataset = {
+        "scale": scale,
+        "parameters": parameters,
+        "nb_nodes": len(node_len),
+        "nb_paths": len(genes),
+        "nb_reads": nb_reads,
+        "gfa_size": os.path.getsize(f"{out_dir}/graph.gfa"),
+        "mapping_size": os.path.getsize(f"{out_dir}/mapping.json"),
+    }
+    with open(dataset_file_name, "w") as dataset_file:
+        json.dump(dataset, dataset_file, indent=1)
+    return dataset
+
+def usage():
+    print("Usage: python -m benchmarks.generate -o out_dir [-s scale] [--seed seed]")
+    scales_description = ', '.join(f"{scale} ({parameters['nb_clusters']} clusters, {parameters['nb_reads']} reads)" for scale, parameters in scales.items())
+    print(f"\t-s scale: {scales_description} [default: tiny]")
+
+if __name__ == "__main__":
+    out_dir = None
+    scale = "tiny"
+    seed = default_parameters["seed"]
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "ho:s:", ["seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-o":
+            out_dir = a
+        elif o == "-s":
+            scale = a
+        elif o == "--seed":
+            seed = int(a)
+    if not out_dir or scale not in scales:
+        usage()
+        sys.exit(1)
+    print(json.dumps(generate_dataset(out_dir, scale, seed=seed), indent=1))
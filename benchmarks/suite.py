@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys # manage arguments
+import getopt # manage arguments
+import os
+import json # results
+import time # benchmark times
+import hashlib # golden outputs
+import subprocess # one process per benchmark
+import tempfile
+from .generate import scales, generate_dataset
+from strainflair.telemetry import get_metrics
+
+# Each benchmark runs in its own process, so that its peak memory (RSS) is measured alone. The peak memory includes
+# the setup of the benchmark (eg. loading the graph before timing the parsing), the time does not.
+# Outputs of json2csv and compute_strains_abundance are checked against golden.json (sha256 of the output files
+# for the datasets of a scale, see generate.py).
+
+golden_file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")
+
+def load_pangenome(data_dir: str, clusters=True):
+    from strainflair.json2csv import Pangenome
+    pangenome = Pangenome()
+    pangenome.fill_pangenome(f"{data_dir}/graph.gfa")
+    if clusters:
+        pangenome.fill_cluster_id_for_each_path(f"{data_dir}/clusters_index.db")
+    return pangenome
+
+def get_mapped_alignments(data_dir: str):
+    """
+    decoded alignments of the mapping file that have subpaths
+    """
+    alignments = []
+    with open(f"{data_dir}/mapping.json") as mapping_file:
+        for line in mapping_file:
+            alignment = json.loads(line)
+            if "subpath" in alignment:
+                alignments.append(alignment)
+    return alignments
+
+def bench_fill_pangenome(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import Pangenome
+    pangenome = Pangenome()
+    t = time.perf_counter()
+    pangenome.fill_pangenome(f"{data_dir}/graph.gfa")
+    return time.perf_counter()-t, {"paths": len(pangenome.paths), "bytes": dataset["gfa_size"]}
+
+def bench_bfs(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import BFS
+    pangenome = load_pangenome(data_dir, clusters=False)
+    alignments = get_mapped_alignments(data_dir)
+    t = time.perf_counter()
+    for alignment in alignments:
+        BFS(alignment, pangenome)
+    return time.perf_counter()-t, {"alignments": len(alignments), "subpaths": sum(len(alignment["subpath"]) for alignment in alignments)}
+
+def bench_get_matching_path(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import BFS
+    pangenome = load_pangenome(data_dir, clusters=False)
+    walks = [[n[0] for n in aligned_path.mapped_node_ids_cov] for alignment in get_mapped_alignments(data_dir) for aligned_path in BFS(alignment, pangenome)]
+    t = time.perf_counter()
+    for walk in walks:
+        # both orientations, without the cache of json2csv
+        pangenome.get_matching_path(walk)
+        pangenome.get_matching_path(walk[::-1])
+    return time.perf_counter()-t, {"walks": len(walks)}
+
+def bench_parse_vgmpmap(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import parse_vgmpmap
+    pangenome = load_pangenome(data_dir)
+    t = time.perf_counter()
+    parse_vgmpmap(f"{data_dir}/mapping.json", pangenome, 0.95)
+    return time.perf_counter()-t, {"reads": dataset["nb_reads"], "bytes": dataset["mapping_size"]}
+
+def bench_print_to_csv(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import parse_vgmpmap
+    pangenome = load_pangenome(data_dir)
+    parse_vgmpmap(f"{data_dir}/mapping.json", pangenome, 0.95)
+    t = time.perf_counter()
+    pangenome.print_to_csv(f"{out_dir}/print_to_csv.csv")
+    pangenome.print_error_distribution(f"{out_dir}/print_to_csv_dist_err.txt")
+    return time.perf_counter()-t, {"paths": len(pangenome.paths)}
+
+def bench_json2csv(data_dir: str, dataset, out_dir: str):
+    from strainflair.json2csv import json2csv_main
+    sys.argv = ["json2csv", "-g", f"{data_dir}/graph.gfa", "-m", f"{data_dir}/mapping.json", "-p", f"{data_dir}/clusters_index.db", "-t", "0.95", "-o", f"{out_dir}/json2csv"]
+    t = time.perf_counter()
+    json2csv_main()
+    return time.perf_counter()-t, {"reads": dataset["nb_reads"], "bytes": dataset["mapping_size"]}
+
+def bench_compute_strains_abundance(data_dir: str, dataset, out_dir: str):
+    """
+    needs the output of bench_json2csv
+    """
+    from strainflair.compute_strains_abundance import compute_strains_abundance_main
+    sys.argv = ["compute_strains_abundance", "-i", f"{out_dir}/json2csv.csv", "-o", f"{out_dir}/strains", "-t", "0.5"]
+    t = time.perf_counter()
+    compute_strains_abundance_main()
+    return time.perf_counter()-t, {"paths": dataset["nb_paths"]}
+
+# benchmark name: (function, output files checked against the golden outputs)
+benchmarks = {
+    "fill_pangenome": (bench_fill_pangenome, []),
+    "bfs": (bench_bfs, []),
+    "get_matching_path": (bench_get_matching_path, []),
+    "parse_vgmpmap": (bench_parse_vgmpmap, []),
+    "print_to_csv": (bench_print_to_csv, ["print_to_csv.csv", "print_to_csv_dist_err.txt"]),
+    "json2csv": (bench_json2csv, ["json2csv.csv", "json2csv_dist_err.txt"]),
+    "compute_strains_abundance": (bench_compute_strains_abundance, ["strains.csv"]),
+}
+
+def run_benchmark(name: str, data_dir: str, out_dir: str, result_file_name: str):
+    """
+    runs a benchmark in this process, its time and counts are written in result_file_name (json)
+    """
+    with open(f"{data_dir}/dataset.json") as dataset_file:
+        dataset = json.load(dataset_file)
+    seconds, counts = benchmarks[name][0](data_dir, dataset, out_dir)
+    with open(result_file_name, "w") as result_file:
+        json.dump({"seconds": seconds, "counts": counts}, result_file)
+
+def file_hash(file_name: str):
+    with open(file_name, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def measure_benchmark(name: str, data_dir: str, out_dir: str):
+    """
+    runs a benchmark in a new process. Returns its time, throughputs (counts per second) and peak memory
+    """
+    # the strain columns of json2csv are ordered as a set of strings: fixed hash seed for comparable outputs
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen([sys.executable, "-m", "benchmarks.suite", "--run", name, data_dir, out_dir, result_file.name], stdout=devnull, stderr=devnull, env=env)
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            return {"name": name, "failed": True}
+        result = json.load(result_file)
+    return {
+        "name": name,
+        "seconds": result["seconds"],
+        "throughput": {f"{key}/s": count/result["seconds"] for key, count in result["counts"].items()},
+        "peak_rss": get_metrics(rusage)["peak_rss"],
+    }
+
+def check_golden(name: str, scale: str, out_dir: str, golden, update=False):
+    """
+    returns the output files of a benchmark that differ from the golden outputs of the scale (None if there is no golden output).
+    If update, the golden outputs are replaced by these outputs
+    """
+    hashes = {file_name: file_hash(f"{out_dir}/{file_name}") for file_name in benchmarks[name][1]}
+    if update:
+        golden.setdefault(scale, {}).update(hashes)
+        return []
+    if scale not in golden:
+        return None
+    return [file_name for file_name, file_hash in hashes.items() if golden[scale].get(file_name) != file_hash]
+
+# STARTUP
+# strainflair imports the module of a subcommand (and its dependencies) only when it runs. The startup benchmark
+# measures the import time of each subcommand in a new process, and checks it against its budget (seconds) and 
+# that the subcommand does not import the heavy dependencies it does not need.
+# subcommand: (budget, modules that must not be imported)
+startup_budgets = {
+    "concat_graphs": (0.2, ["numpy", "pandas", "Bio"]),
+    "pipeline": (0.2, ["numpy", "pandas", "Bio"]),
+    "graphs_construction": (1, ["pandas"]),
+    "genes_prediction": (1, ["pandas"]),
+    "json2csv": (0.5, ["pandas", "Bio"]),
+    "compute_strains_abundance": (1, ["Bio"]),
+}
+
+startup_code = """
+import sys, time, json, importlib
+t = time.perf_counter()
+import strainflair.__main__
+importlib.import_module(f"strainflair.{strainflair.__main__.subcommands[sys.argv[1]]}")
+print(json.dumps({"seconds": time.perf_counter()-t, "modules": list(sys.modules)}))
+"""
+
+def measure_startup(subcommand: str, nb_runs=3):
+    """
+    returns the import time of a subcommand (best of nb_runs) and the modules it imports
+    """
+    results = [json.loads(subprocess.check_output([sys.executable, "-c", startup_code, subcommand])) for _ in range(nb_runs)]
+    return min(result["seconds"] for result in results), results[0]["modules"]
+
+def check_startup(budget_factor=1):
+    """
+    prints the import time of each subcommand, returns the results and the subcommands over budget 
+    or importing forbidden modules
+    """
+    print("Startup")
+    results = []
+    failures = []
+    for subcommand, (budget, forbidden_modules) in startup_budgets.items():
+        seconds, modules = measure_startup(subcommand)
+        imported_modules = [module for module in forbidden_modules if module in modules]
+        status = "OK"
+        if seconds > budget*budget_factor or imported_modules:
+            failures.append(subcommand)
+            status = f"OVER BUDGET ({budget*budget_factor:.2f}s)" if seconds > budget*budget_factor else ""
+            status += f" IMPORTS {', '.join(imported_modules)}" if imported_modules else ""
+        print(f"\t{subcommand}: {seconds:.3f}s {status}")
+        results.append({"name": "startup", "subcommand": subcommand, "seconds": seconds, "imported_forbidden_modules": imported_modules})
+    return results, failures
+
+def usage():
+    print("Usage: python -m benchmarks [-s scale1,scale2,...] [-b benchmark1,benchmark2,...] [-d work_dir] [-o results_file] [--update-golden] [--startup-budget-factor factor]")
+    print(f"\t-s: scales among {', '.join(scales)} [default: tiny,small]")
+    print(f"\t-b: benchmarks among startup, {', '.join(benchmarks)} [default: all]")
+    print("\t-d: directory of the datasets and of the outputs, datasets are generated once [default: benchmarks_work]")
+    print("\t-o: also write the results in this json file")
+    print("\t--update-golden: replace the golden outputs of these scales by the outputs of this run")
+    print("\t--startup-budget-factor: multiply the import time budgets of the subcommands (slow machines) [default: 1]")
+
+def main():
+    selected_scales = ["tiny", "small"]
+    selected_benchmarks = ["startup"] + list(benchmarks)
+    work_dir = "benchmarks_work"
+    results_file_name = None
+    update_golden = False
+    budget_factor = 1
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hs:b:d:o:", ["update-golden", "startup-budget-factor="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-s":
+            selected_scales = a.split(",")
+        elif o == "-b":
+            selected_benchmarks = a.split(",")
+        elif o == "-d":
+            work_dir = a
+        elif o == "-o":
+            results_file_name = a
+        elif o == "--update-golden":
+            update_golden = True
+        elif o == "--startup-budget-factor":
+            budget_factor = float(a)
+    if any(scale not in scales for scale in selected_scales) or any(name not in benchmarks and name != "startup" for name in selected_benchmarks):
+        usage()
+        sys.exit(1)
+    if "compute_strains_abundance" in selected_benchmarks and "json2csv" not in selected_benchmarks:
+        selected_benchmarks.insert(selected_benchmarks.index("compute_strains_abundance"), "json2csv")
+
+    golden = {}
+    if os.path.exists(golden_file_name):
+        with open(golden_file_name) as golden_file:
+            golden = json.load(golden_file)
+    results = []
+    failed = False
+    if "startup" in selected_benchmarks:
+        selected_benchmarks.remove("startup")
+        startup_results, startup_failures = check_startup(budget_factor)
+        results += startup_results
+        failed |= bool(startup_failures)
+        if not selected_benchmarks:
+            selected_scales = []
+    for scale in selected_scales:
+        data_dir = os.path.abspath(f"{work_dir}/{scale}")
+        out_dir = f"{data_dir}/outputs"
+        print(f"Dataset {scale}: generating in {data_dir}" if not os.path.exists(f"{data_dir}/dataset.json") else f"Dataset {scale}: {data_dir}")
+        dataset = generate_dataset(data_dir, scale)
+        os.makedirs(out_dir, exist_ok=True)
+        print(f"\t{dataset['nb_nodes']} nodes, {dataset['nb_paths']} paths, {dataset['nb_reads']} reads, gfa {dataset['gfa_size']/1e6:.1f} MB, json {dataset['mapping_size']/1e6:.1f} MB")
+        for name in selected_benchmarks:
+            result = measure_benchmark(name, data_dir, out_dir)
+            result["scale"] = scale
+            if result.get("failed"):
+                print(f"\t{name}: FAILED")
+                failed = True
+            else:
+                result["golden"] = check_golden(name, scale, out_dir, golden, update_golden)
+                throughput = ', '.join(f"{count:.0f} {key}" for key, count in result["throughput"].items())
+                golden_status = "" if result["golden"] is None or not benchmarks[name][1] else " golden outputs OK" if not result["golden"] else f" DIFFERS FROM GOLDEN OUTPUTS: {', '.join(result['golden'])}"
+                print(f"\t{name}: {result['seconds']:.3f}s, {throughput}, peak RSS {result['peak_rss']/2**20:.0f} MB{golden_status}")
+                failed |= bool(result["golden"])
+            results.append(result)
+    if update_golden:
+        with open(golden_file_name, "w") as golden_file:
+            json.dump(golden, golden_file, indent=1, sort_keys=True)
+            golden_file.write("\n")
+    if results_file_name:
+        with open(results_file_name, "w") as results_file:
+            json.dump(results, results_file, indent=1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 6 and sys.argv[1] == "--run":
+        run_benchmark(*sys.argv[2:])
+    else:
+        main()
@@ -1,5 +1,18 @@
-from .compute_strains_abundance import compute_strains_abundance_main
-from .concat_graphs import concat_graphs_main
-from .genes_prediction import genes_prediction_main
-from .json2csv import json2csv_main
-from .graphs_construction import graphs_construction_main
\ No newline at end of file
+import importlib # entry points are imported when used, see __main__
+
+# entry point: module
+entry_points = {
+    "compute_strains_abundance_main": "compute_strains_abundance",
+    "concat_graphs_main": "concat_graphs",
+    "genes_prediction_main": "genes_prediction",
+    "genes_clustering_main": "genes_clustering",
+    "json2csv_main": "json2csv",
+    "graphs_construction_main": "graphs_construction",
+    "pipeline_main": "pipeline"
+}
+
+def __getattr__(name):
+    # importing strainflair does not import the modules and their dependencies (numpy, pandas, Bio)
+    if name in entry_points:
+        return getattr(importlib.import_module(f".{entry_points[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,56 @@
-from strainflair import (
-  compute_strains_abundance_main,
-  graphs_construction_main,
-  json2csv_main,
-  concat_graphs_main,
-  genes_prediction_main
-)
\ No newline at end of file
+import sys
+import importlib
+
+# strainflair subcommand: module, imported only when the subcommand runs.
+# Each module has a subcommand_main entry point, reading its arguments in sys.argv
+subcommands = {
+    "genes_prediction": "genes_prediction",
+    "genes_clustering": "genes_clustering",
+    "graphs_construction": "graphs_construction",
+    "concat_graphs": "concat_graphs",
+    "json2csv": "json2csv",
+    "compute_strains_abundance": "compute_strains_abundance",
+    "pipeline": "pipeline"
+}
+
+def run(subcommand):
+    module = importlib.import_module(f"strainflair.{subcommands[subcommand]}")
+    getattr(module, f"{subcommand}_main")()
+
+def usage():
+    print("Usage: strainflair subcommand [options]")
+    print(f"\tsubcommands: {', '.join(subcommands)}")
+    print("\tstrainflair subcommand -h: options of a subcommand")
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in subcommands:
+        usage()
+        sys.exit(1)
+    subcommand = sys.argv[1]
+    sys.argv = [f"strainflair {subcommand}"] + sys.argv[2:]
+    run(subcommand)
+
+# console scripts of each subcommand
+def compute_strains_abundance_main():
+    run("compute_strains_abundance")
+
+def concat_graphs_main():
+    run("concat_graphs")
+
+def genes_prediction_main():
+    run("genes_prediction")
+
+def genes_clustering_main():
+    run("genes_clustering")
+
+def graphs_construction_main():
+    run("graphs_construction")
+
+def json2csv_main():
+    run("json2csv")
+
+def pipeline_main():
+    run("pipeline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3 # indexed clusters map
+import pickle # former dictionary of clusters (dict_clusters.pickle)
+import os # remove a previous index
+import re # accession numbers
+from urllib.parse import quote # path of the index in a sqlite uri
+
+sqlite_header = b"SQLite format 3\x00"
+
+def get_cluster_int_id(cluster_name: str):
+    """
+    Cluster_12 -> 12
+    """
+    return int(cluster_name.split("_")[-1])
+
+def get_accession_number(line: str):
+    accession_number = None
+    line = '_'.join(line.split("_")[:-1]) # delete gene id
+    line = line.split("|")
+    for element in line:
+        if re.match("[a-zA-Z]+_?[a-zA-Z]*[0-9]+", element):
+            accession_number = element
+            break
+    return accession_number
+
+def is_clusters_index(clusters_file: str):
+    """
+    True if the file is a clusters index (SQLite), False if it is a pickled dictionary of clusters
+    """
+    with open(clusters_file, "rb") as f:
+        return f.read(len(sqlite_header)) == sqlite_header
+
+class ClustersIndexWriter:
+    """
+    Store clusters in a SQLite file, one cluster at a time:
+    table clusters: cluster id (int), length of the representative sequence, number of genes, min and max length of the genes
+    table genes: gene name, cluster id (int), indexed by gene name
+    table strains: cluster id (int), strain (accession number) having at least one gene in this cluster
+    table duplicates: gene name, name of a gene with the same sequence, not in the graph (see genes_prediction -u)
+    """
+    def __init__(self, index_file: str):
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        self.con = sqlite3.connect(index_file)
+        # the index is written once and can be rebuilt, no need for a journal
+        self.con.execute("PRAGMA journal_mode = OFF")
+        self.con.execute("PRAGMA synchronous = OFF")
+        self.con.execute("CREATE TABLE clusters (cluster_id INTEGER PRIMARY KEY, len_rep INTEGER, nb_genes INTEGER, min_len INTEGER, max_len INTEGER)")
+        self.con.execute("CREATE TABLE genes (name TEXT PRIMARY KEY, cluster_id INTEGER) WITHOUT ROWID")
+        self.con.execute("CREATE TABLE strains (cluster_id INTEGER, strain TEXT)")
+        self.con.execute("CREATE TABLE duplicates (name TEXT, duplicate TEXT)")
+
+    def add_cluster(self, cluster_name: str, cluster):
+        """
+        cluster: dict with genes_list, len_rep and optionally genes_len (length of each gene, see graphs_construction.iter_clusters)
+        """
+        cluster_id = get_cluster_int_id(cluster_name)
+        genes_len = cluster.get('genes_len')
+        min_len = min(genes_len) if genes_len else None
+        max_len = max(genes_len) if genes_len else None
+        self.con.execute("INSERT INTO clusters VALUES (?,?,?,?,?)", (cluster_id, cluster.get('len_rep'), len(cluster['genes_list']), min_len, max_len))
+        self.con.executemany("INSERT INTO genes VALUES (?,?)", ((gene_name, cluster_id) for gene_name in cluster['genes_list']))
+        strains = dict.fromkeys(get_accession_number(gene_name) for gene_name in cluster['genes_list'])
+        self.con.executemany("INSERT INTO strains VALUES (?,?)", ((cluster_id, strain) for strain in strains))
+
+    def add_duplicates(self, gene_name: str, duplicates):
+        """
+        duplicates: names of the genes with the same sequence as gene_name. They must also be in the genes_list of its cluster
+        """
+        self.con.executemany("INSERT INTO duplicates VALUES (?,?)", ((gene_name, duplicate) for duplicate in duplicates))
+
+    def close(self):
+        self.con.execute("CREATE INDEX strains_cluster_id ON strains (cluster_id)")
+        self.con.commit()
+        self.con.close()
+
+def write_clusters_index(d_clusters, index_file: str):
+    """
+    d_clusters: key = cluster name, value = dict with genes_list and len_rep
+    """
+    writer = ClustersIndexWriter(index_file)
+    for cluster_name, cluster in d_clusters.items():
+        writer.add_cluster(cluster_name, cluster)
+    writer.close()
+
+def open_clusters_index(index_file: str):
+    """
+    read only connection to a clusters index, memory mapped
+    """
+    con = sqlite3.connect(f"file:{quote(index_file)}?mode=ro", uri=True)
+    con.execute(f"PRAGMA mmap_size = {os.path.getsize(index_file)}")
+    return con
+
+def get_cluster_of_gene(con, gene_name: str):
+    """
+    cluster id (int) of a gene, None if the gene is not in the index
+    """
+    row = con.execute("SELECT cluster_id FROM genes WHERE name = ?", (gene_name,)).fetchone()
+    return row[0] if row else None
+
+def get_cluster_stats(con, cluster_id: int):
+    """
+    returns a dict with len_rep, nb_genes, min_len, max_len and strains of a cluster, None if the cluster is not in the index
+    """
+    row = con.execute("SELECT len_rep, nb_genes, min_len, max_len FROM clusters WHERE cluster_id = ?", (cluster_id,)).fetchone()
+    if not row:
+        return None
+    stats = dict(zip(("len_rep", "nb_genes", "min_len", "max_len"), row))
+    stats["strains"] = [strain for strain, in con.execute("SELECT strain FROM strains WHERE cluster_id = ?", (cluster_id,))]
+    return stats
+
+def iter_duplicate_genes(clusters_file: str):
+    """
+    yields (gene name, duplicate gene name) for each duplicate of a clusters index.
+    Pickled dictionaries of clusters and indexes written before duplicates were collapsed have none
+    """
+    if not is_clusters_index(clusters_file):
+        return
+    con = open_clusters_index(clusters_file)
+    try:
+        if con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'duplicates'").fetchone():
+            yield from con.execute("SELECT name, duplicate FROM duplicates")
+    finally:
+        con.close()
+
+def get_duplicate_genes(clusters_file: str):
+    """
+    returns a dictionary: key = gene name, value = names of the genes with the same sequence
+    """
+    duplicates = {}
+    for gene_name, duplicate in iter_duplicate_genes(clusters_file):
+        if gene_name not in duplicates:
+            duplicates[gene_name] = []
+        duplicates[gene_name].append(duplicate)
+    return duplicates
+
+def iter_genes_clusters(clusters_file: str):
+    """
+    yields (gene name, cluster id (int)) for each gene of a clusters index or of a pickled dictionary of clusters
+    """
+    if is_clusters_index(clusters_file):
+        con = open_clusters_index(clusters_file)
+        try:
+            yield from con.execute("SELECT name, cluster_id FROM genes")
+        finally:
+            con.close()
+    else:
+        with open(clusters_file, "rb") as f:
+            d_clusters = pickle.load(f)
+        # Cluster_1: ['gi|407479587|ref|NC_...58.1|_3137', 'gi|1447699251|ref|NC...95.2|_1209']
+        for cluster_name, cluster in d_clusters.items():
+            cluster_id = get_cluster_int_id(cluster_name)
+            for gene_name in cluster['genes_list']:
+                yield gene_name, cluster_id
@@ -5,6 +5,37 @@ import sys # manage arguments
 import getopt # manage arguments
 import pandas as pd # read csv and manipulate dataframes
 import numpy as np # basic operations
+from .telemetry import Timer, start_report # run report
+
+def compute_strains_profile(input_df, thr=0.5):
+    """
+    input_df: gene-level abundances (as output by json2csv)
+    thr: threshold on the proportion of detected specific genes
+    returns the strain-level abundances
+    """
+    # replace NaN with zeros
+    input_df.fillna(0,inplace=True)
+    # working only on specific genes
+    input_df = input_df.drop( input_df[(input_df.iloc[:,0:(len(input_df.columns)-12)] > 0).sum(axis=1) != 1].index )
+
+    # strain-level computation
+
+    # empty dataframe
+    strains_profile = pd.DataFrame(index=list((input_df.iloc[:,0:(len(input_df.columns)-12)]).columns) , columns=["detected_genes", "mean_abund", "mean_abund_nz", "median_abund", "median_abund_nz"])
+    strains_profile.fillna(0,inplace=True)
+    # detected genes
+    strains_profile["detected_genes"] = [ input_df.loc[input_df["ratio_covered_nodes"] > 0,columnName].sum()/input_df.loc[:,columnName].sum() for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).items() ]
+    # abundances
+    strains_profile["mean_abund"] = [ np.mean(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).items() ]
+    if strains_profile["mean_abund"].sum() != 0: strains_profile["mean_abund"] /= strains_profile["mean_abund"].sum()/100
+    strains_profile["mean_abund_nz"] = [ np.mean(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple_nz"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).items() ]
+    if strains_profile["mean_abund_nz"].sum() != 0: strains_profile["mean_abund_nz"] /= strains_profile["mean_abund_nz"].sum()/100
+    strains_profile["median_abund"] = [ np.median(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).items() ]
+    if strains_profile["median_abund"].sum() != 0: strains_profile["median_abund"] /= strains_profile["median_abund"].sum()/100
+    strains_profile["median_abund_nz"] = [ np.median(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple_nz"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).items() ]
+    if strains_profile["median_abund_nz"].sum() != 0: strains_profile["median_abund_nz"] /= strains_profile["median_abund_nz"].sum()/100
+
+    return strains_profile
 
 def usage():
     print(f"Usage: python {sys.argv[0]} -i input_file (csv) -o out_file -t thr")
@@ -44,30 +75,14 @@ def compute_strains_abundance_main():
         exit()
 
     # start
+    start_report("compute_strains_abundance", f"{out_file}_report.json")
 
     # read csv
-    input_df = pd.read_csv(input_file, sep=";")
-    # replace NaN with zeros
-    input_df.fillna(0,inplace=True)
-    # working only on specific genes
-    input_df = input_df.drop( input_df[(input_df.iloc[:,0:(len(input_df.columns)-12)] > 0).sum(axis=1) != 1].index )
-
-    # strain-level computation
-
-    # empty dataframe
-    strains_profile = pd.DataFrame(index=list((input_df.iloc[:,0:(len(input_df.columns)-12)]).columns) , columns=["detected_genes", "mean_abund", "mean_abund_nz", "median_abund", "median_abund_nz"])
-    strains_profile.fillna(0,inplace=True)
-    # detected genes
-    strains_profile["detected_genes"] = [ input_df.loc[input_df["ratio_covered_nodes"] > 0,columnName].sum()/input_df.loc[:,columnName].sum() for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).iteritems() ]
-    # abundances
-    strains_profile["mean_abund"] = [ np.mean(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).iteritems() ]
-    if strains_profile["mean_abund"].sum() != 0: strains_profile["mean_abund"] /= strains_profile["mean_abund"].sum()/100
-    strains_profile["mean_abund_nz"] = [ np.mean(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple_nz"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).iteritems() ]
-    if strains_profile["mean_abund_nz"].sum() != 0: strains_profile["mean_abund_nz"] /= strains_profile["mean_abund_nz"].sum()/100
-    strains_profile["median_abund"] = [ np.median(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).iteritems() ]
-    if strains_profile["median_abund"].sum() != 0: strains_profile["median_abund"] /= strains_profile["median_abund"].sum()/100
-    strains_profile["median_abund_nz"] = [ np.median(input_df.loc[input_df[columnName] > 0,"mean_abund_multiple_nz"]/input_df.loc[input_df[columnName] > 0,columnName]) if strains_profile.loc[columnName,"detected_genes"] > thr else 0 for (columnName, columnData) in (input_df.iloc[:,0:(len(input_df.columns)-12)]).iteritems() ]
-    if strains_profile["median_abund_nz"].sum() != 0: strains_profile["median_abund_nz"] /= strains_profile["median_abund_nz"].sum()/100
+    with Timer("csv reading"):
+        input_df = pd.read_csv(input_file, sep=";")
+    with Timer("strains profile"):
+        strains_profile = compute_strains_profile(input_df, thr)
 
     # output
-    strains_profile.to_csv(f"{out_file}.csv")
\ No newline at end of file
+    with Timer("csv writing"):
+        strains_profile.to_csv(f"{out_file}.csv")
\ No newline at end of file
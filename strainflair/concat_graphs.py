@@ -5,47 +5,77 @@ import subprocess
 import sys
 import getopt
 import logging # log.txt with times
-import time
+from .telemetry import Timer, setup_logger, start_report, run # times and resources stored in log and run report
 import os
 import tempfile
-from multiprocessing import Queue, Process, Pool, Lock, cpu_count, Manager # multiprocessing
-
-
-class Timer:
-    def __enter__(self):
-        self.t1 = time.time()
-        return self
-    
-    def __exit__(self, *args):
-        self.t2 = time.time()
-        hours, rem = divmod(self.t2-self.t1, 3600)
-        minutes, seconds = divmod(rem, 60)
-        self.t = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
-
-def setup_logger(name, log_path):
-    l = logging.getLogger(name)
-    formatter = logging.Formatter("%(asctime)s -- %(levelname)s -- %(message)s")
-    fileHandler = logging.FileHandler(log_path, mode="w")
-    fileHandler.setFormatter(formatter)
-
-    l.setLevel(logging.DEBUG)
-    l.addHandler(fileHandler)
-
-def worker(q: Queue, input_dir: str):
-    while True:
-        l_clusters = q.get()
-        if not l_clusters:
-            q.put(None)
-            break
-        concat(l_clusters, input_dir)
-
-def concat(l_clusters: list, input_dir: str):
-
-    subprocess.run(['vg', 'ids', '-j', '-c']+l_clusters)
-    with tempfile.NamedTemporaryFile(dir=input_dir,delete=False,suffix=".vg") as out:
-        print(f"processing {out.name}")
-        subprocess.run(['vg','combine'] + l_clusters, stdout=out)
-    subprocess.run(['rm']+l_clusters)
+import shutil
+from .executor import Executor, Task # parallel combinations
+
+
+def remove_combined_graphs(manifest_file_name: str):
+    """
+    removes the graphs listed in the manifest of a combined graph (see concat), then the manifest
+    """
+    graphs_dir = os.path.dirname(manifest_file_name)
+    with open(manifest_file_name) as manifest:
+        for vg_file in manifest.read().split():
+            if os.path.exists(f"{graphs_dir}/{vg_file}"):
+                os.remove(f"{graphs_dir}/{vg_file}")
+    os.remove(manifest_file_name)
+
+def clean_batch(out_file_name: str):
+    """
+    removes the partial files of the batch combined in out_file_name (.vg.tmp).
+    If its combined graph was renamed, the graphs it combines are removed
+    """
+    manifest_file_name = f"{out_file_name[:-len('.tmp')]}.inputs"
+    if os.path.exists(manifest_file_name):
+        if os.path.exists(out_file_name[:-len(".tmp")]):
+            remove_combined_graphs(manifest_file_name)
+        else:
+            os.remove(manifest_file_name)
+    if os.path.exists(out_file_name):
+        os.remove(out_file_name)
+    shutil.rmtree(f"{out_file_name}.ids", ignore_errors=True)
+
+def concat(l_clusters: list, out_file_name: str):
+    """
+    combines the graphs of l_clusters in out_file_name (.vg.tmp), renamed .vg once complete.
+    If vg fails the graphs are kept, the step does not reduce the number of graphs
+    """
+    combined_file_name = out_file_name[:-len(".tmp")]
+    manifest_file_name = f"{combined_file_name}.inputs"
+    # a killed attempt may have renamed the combined graph before removing all the graphs
+    if os.path.exists(manifest_file_name) and os.path.exists(combined_file_name):
+        remove_combined_graphs(manifest_file_name)
+        return
+    clean_batch(out_file_name)
+    # vg ids rewrites its graphs, it renumbers copies so that a stopped attempt leaves the graphs intact
+    ids_dir = f"{out_file_name}.ids"
+    os.makedirs(ids_dir)
+    l_copies = []
+    for i, vg_file in enumerate(l_clusters):
+        l_copies.append(f"{ids_dir}/{i}.vg")
+        shutil.copyfile(vg_file, l_copies[-1])
+    run(['vg', 'ids', '-j', '-c']+l_copies, check=True)
+    # the combined graph is renamed .vg once complete, an interrupted run can be resumed with the remaining graphs
+    with open(out_file_name, 'wb') as out:
+        print(f"processing {out_file_name}")
+        run(['vg','combine'] + l_copies, stdout=out, check=True)
+    shutil.rmtree(ids_dir)
+    # the manifest, written before the rename, lets a resumed run remove the graphs already combined
+    with open(manifest_file_name, 'w') as manifest:
+        manifest.write("\n".join(os.path.basename(vg_file) for vg_file in l_clusters) + "\n")
+    os.rename(out_file_name, combined_file_name)
+    remove_combined_graphs(manifest_file_name)
+
+def get_out_file_name(input_dir: str):
+    """
+    new empty .vg.tmp file in input_dir, the combined graph of a batch
+    """
+    fd, out_file_name = tempfile.mkstemp(dir=input_dir, suffix=".vg.tmp")
+    os.close(fd)
+    return out_file_name
 
 def file_generator(input_dir):
     for entry in os.scandir(input_dir):
@@ -87,13 +117,22 @@ def concat_graphs_main():
     # logger
     setup_logger("logger", f"{input_dir}/concat_grahs_log.txt")
     logger = logging.getLogger("logger")
+    start_report("concat_graphs", f"{input_dir}/concat_graphs_report.json")
 
     # start
 
+    # partial graphs of an interrupted run, and graphs already combined but not removed
+    for f in os.listdir(input_dir):
+        for suffix in (".vg.inputs", ".vg.tmp", ".vg.tmp.ids"):
+            if f.endswith(suffix):
+                clean_batch(f"{input_dir}/{f[:-len(suffix)]}.vg.tmp")
+                break
+
     stage = 1
+    previous_nb_files = None
     while True:
 
-        with Timer() as _t:
+        with Timer(f"step {stage}") as _t:
             
             print(f"start step {stage}")
             nb_files = int(subprocess.check_output(f"find {input_dir} -maxdepth 1 -name '*.vg' | wc -l",shell=True))
@@ -101,31 +140,37 @@ def concat_graphs_main():
                 final_file = [f for f in os.listdir(input_dir) if f.endswith(".vg")][0]
                 os.rename(f"{input_dir}/{final_file}", f"{input_dir}/all_graphs.vg")
                 break
+            if nb_files == previous_nb_files:
+                logger.error(f"Step {stage} could not combine the graphs")
+                sys.exit(1)
+            previous_nb_files = nb_files
 
-            # queue initialization
-            q = Queue() 
-
-            # for each steps in parallel
-            processes = Pool(initializer=worker, initargs=(q,input_dir))
-
-            print("fill the queue")
-            # fill the queue with list of vg files
+            # lists of vg files
+            batches = []
             ct = 0
             l_clusters = []
             for vg_file in file_generator(input_dir):
                 l_clusters.append(f"{input_dir}/{vg_file}")
                 ct+=1
                 if ct==step:
-                    q.put(l_clusters)
+                    batches.append(l_clusters)
                     ct = 0
                     l_clusters = []
             if len(l_clusters)>1:
-                q.put(l_clusters)
-            q.put(None)
+                batches.append(l_clusters)
 
-            # end multiprocessing
-            processes.close()
-            processes.join()
+            # for each steps in parallel
+            executor = Executor()
+            out_files = {} # combined graph of each batch
+            def batches_tasks():
+                for i, l_clusters in enumerate(batches):
+                    name = f"step {stage} batch {i}"
+                    out_files[name] = get_out_file_name(input_dir)
+                    yield Task(name, concat, (l_clusters, out_files[name]), sum(os.path.getsize(f) for f in l_clusters))
+            for result in executor.run(batches_tasks()):
+                if result["returncode"] != 0:
+                    logger.error(f"{result['name']} failed (exit code {result['returncode']})")
+                    clean_batch(out_files[result['name']])
             print(f"end of step {stage}")
 
         logger.info(f"Step {stage} done in: {_t.t}")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time # durations of the tasks
+import signal # kill stragglers
+import traceback # errors of the tasks
+from multiprocessing import cpu_count
+from .telemetry import get_metrics, record_task # duration and resources of each task in the run report
+
+# Tasks running external tools (prodigal, cd-hit-est, minimap2, seqwish, vg), each in its own forked process,
+# session leader so that the tools it runs are killed with it. At most nb_workers tasks run at once.
+# A task lasting much longer than the others (straggler) is killed and retried: its timeout is straggler_factor times
+# the straggler_percentile of the durations of the tasks already done, per unit of size (eg. bases of a cluster),
+# times its size. Timeouts apply once min_samples tasks are done, and are at least min_timeout seconds.
+# The last attempt of a task has no straggler timeout, a slow task is not killed forever.
+
+class Task:
+    """
+    function(*args) run in a child process. The task fails if it raises an exception (or if the process is killed)
+    size: work of the task (eg. number of bases), the timeout of a task is proportional to its size
+    """
+    def __init__(self, name: str, function, args=(), size=1):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.size = max(size, 1)
+        self.attempts = 0
+        self.pid = None
+        self.start = None
+        self.timeout = None
+
+def run_task(task: Task):
+    """
+    runs the function of a task in the child process, exit code 1 if it raises an exception
+    """
+    os.setsid()
+    returncode = 0
+    try:
+        task.function(*task.args)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(returncode)
+
+class Executor:
+    def __init__(self, nb_workers=None, retries=1, straggler_factor=4.0, straggler_percentile=95, min_samples=20, min_timeout=60.0, poll_interval=0.05):
+        self.nb_workers = nb_workers or cpu_count()
+        self.retries = retries
+        self.straggler_factor = straggler_factor
+        self.straggler_percentile = straggler_percentile
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self.poll_interval = poll_interval
+        self.durations = [] # seconds per unit of size of the tasks done
+        self.results = []
+
+    def get_timeout(self, task: Task):
+        """
+        straggler timeout of a task (None if there are not enough tasks done, or for the last attempt)
+        """
+        if len(self.durations) < self.min_samples or task.attempts > self.retries:
+            return None
+        durations = sorted(self.durations)
+        percentile = durations[min(len(durations)-1, int(self.straggler_percentile/100*len(durations)))]
+        return max(self.min_timeout, self.straggler_factor*percentile*task.size)
+
+    def start(self, task: Task):
+        task.attempts += 1
+        task.timeout = self.get_timeout(task)
+        # buffered outputs would be written by both processes
+        sys.stdout.flush()
+        sys.stderr.flush()
+        task.start = time.time()
+        task.pid = os.fork()
+        if task.pid == 0:
+            run_task(task)
+
+    def reap(self, task: Task, status, rusage):
+        """
+        returns the result of a terminated task, None if it is retried
+        """
+        wall = time.time()-task.start
+        returncode = os.waitstatus_to_exitcode(status)
+        killed = returncode == -signal.SIGKILL and task.timeout is not None and wall >= task.timeout
+        result = {"name": task.name, "returncode": returncode, "wall": wall, "size": task.size, "attempts": task.attempts, "killed": killed}
+        result.update(get_metrics(rusage))
+        record_task(result)
+        if killed:
+            print(f"{task.name} killed after {wall:.1f}s (timeout {task.timeout:.1f}s), attempt {task.attempts}", file=sys.stderr)
+            self.start(task)
+            return None
+        if returncode == 0:
+            self.durations.append(wall/task.size)
+        self.results.append(result)
+        return result
+
+    def kill_stragglers(self, running):
+        now = time.time()
+        for task in running:
+            if task.timeout is not None and now-task.start > task.timeout:
+                try:
+                    os.killpg(task.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def run(self, tasks):
+        """
+        runs tasks (an iterable of Task, read as workers are free) and yields the result of each task as soon as it is done:
+        dict with name, returncode, wall, size, attempts, killed, and the CPU time, peak RSS and I/O bytes of the task and its tools
+        """
+        tasks = iter(tasks)
+        running = []
+        more_tasks = True
+        while running or more_tasks:
+            while more_tasks and len(running) < self.nb_workers:
+                task = next(tasks, None)
+                if task is None:
+                    more_tasks = False
+                    break
+                self.start(task)
+                running.append(task)
+            done = False
+            for task in list(running):
+                pid, status, rusage = os.wait4(task.pid, os.WNOHANG)
+                if pid == 0:
+                    continue
+                done = True
+                running.remove(task)
+                result = self.reap(task, status, rusage)
+                if result is None: # restarted
+                    running.append(task)
+                else:
+                    yield result
+            self.kill_stragglers(running)
+            if not done:
+                time.sleep(self.poll_interval)
+
+    def get_failures(self):
+        return [result for result in self.results if result["returncode"] != 0]
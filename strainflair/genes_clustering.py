@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys # manage arguments
+import getopt # manage arguments
+import os
+import shutil # remove the groups directory
+import heapq # balance the groups between the cd-hit-est runs
+import subprocess
+import logging # log.txt with times
+import numpy as np
+from multiprocessing import cpu_count # threads of cd-hit-est
+from .telemetry import Timer, setup_logger, start_report, run # times and resources stored in log and run report
+from .executor import Executor, Task # parallel cd-hit-est runs
+
+# cd-hit-est on groups of genes, run in parallel.
+# Genes are split into groups such that genes of distinct groups are unlikely to be similar above the cd-hit-est
+# identity threshold (-c): each gene is sketched by its canonical k-mers with a hash below max_hash/scaled
+# (FracMinHash), and a gene joins the groups sharing enough of its sketch with it (its expected fraction of conserved
+# k-mers, identity^k, times link_fraction). Groups are then packed into balanced bins, cd-hit-est clusters each bin
+# and the .clstr files of the bins are concatenated with consecutive cluster numbers, as a single cd-hit-est would
+# number them.
+# Genes are sketched while the fasta file is read: only their sketches, lengths and positions in the file are kept,
+# and the bins are copied from these positions.
+
+bases_codes = np.full(256, 255, dtype=np.uint8)
+for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        bases_codes[ord(base)] = code
+
+def hash64(values):
+    '''
+    splitmix64 finalizer of an array of uint64
+    '''
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+def get_sketch(sequence: bytes, k=16, scaled=100, min_hashes=8):
+    '''
+    hashes of the canonical k-mers of a sequence below 2^64/scaled, or its min_hashes smallest hashes if there are fewer
+    k-mers with a non ACGT base are ignored
+    '''
+    codes = bases_codes[np.frombuffer(sequence, dtype=np.uint8)]
+    nb_kmers = len(codes)-k+1
+    if nb_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 255)))
+    valid = invalid[k:] == invalid[:-k]
+    codes = np.where(codes == 255, 0, codes).astype(np.uint64)
+    forward = np.zeros(nb_kmers, dtype=np.uint64)
+    reverse = np.zeros(nb_kmers, dtype=np.uint64)
+    for i in range(k):
+        forward = (forward << np.uint64(2)) | codes[i:i+nb_kmers]
+        reverse = reverse | ((np.uint64(3) - codes[i:i+nb_kmers]) << np.uint64(2*i))
+    hashes = np.unique(hash64(np.minimum(forward, reverse)[valid]))
+    sketch = hashes[hashes < np.uint64((1<<64)//scaled)]
+    if len(sketch) < min_hashes:
+        sketch = hashes[:min_hashes]
+    return sketch
+
+def find(parents, group: int):
+    while parents[group] != group:
+        parents[group] = parents[parents[group]]
+        group = parents[group]
+    return group
+
+def iter_fasta_records(fasta_file: str):
+    '''
+    yields (id, offset, size, sequence) of each record of a fasta file: position and number of bytes of the record in the file
+    '''
+    idt = None
+    position = 0
+    with open(fasta_file, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if idt is not None:
+                    yield idt, offset, position-offset, b"".join(sequence)
+                idt = (line[1:].split() or [b""])[0].decode()
+                offset = position
+                sequence = []
+            elif idt is not None:
+                sequence.append(line.strip())
+            position += len(line)
+    if idt is not None:
+        yield idt, offset, position-offset, b"".join(sequence)
+
+def read_genes(genes_file: str, k=16, scaled=100, min_hashes=8):
+    '''
+    returns the genes of a fasta file, in the order of the file: list of (id, length, offset, size, sketch)
+    sequences are sketched while the file is read, they are not kept
+    '''
+    return [(idt, len(sequence), offset, size, get_sketch(sequence, k, scaled, min_hashes)) for idt, offset, size, sequence in iter_fasta_records(genes_file)]
+
+def get_groups(genes, identity: float, k=16, link_fraction=0.5):
+    '''
+    returns the group of each gene (see read_genes, list in the same order) and the number of bases of each group
+    genes are added from the longest, as cd-hit-est does
+    '''
+    parents = [] # union-find of the groups
+    hashes_group = {} # hash -> first group with this hash
+    genes_group = [None]*len(genes)
+    for i in sorted(range(len(genes)), key=lambda i: -genes[i][1]):
+        sketch = genes[i][4].tolist()
+        hits = {}
+        for h in sketch:
+            group = hashes_group.get(h)
+            if group is not None:
+                group = find(parents, group)
+                hits[group] = hits.get(group, 0)+1
+        min_hits = max(1, link_fraction*identity**k*len(sketch))
+        linked = [group for group, nb_hits in hits.items() if nb_hits >= min_hits]
+        if linked:
+            group = min(linked)
+            for other_group in linked:
+                parents[other_group] = group
+        else:
+            group = len(parents)
+            parents.append(group)
+        for h in sketch:
+            hashes_group.setdefault(h, group)
+        genes_group[i] = group
+    groups_len = {}
+    for i, gene in enumerate(genes):
+        group = genes_group[i] = find(parents, genes_group[i])
+        groups_len[group] = groups_len.get(group, 0)+gene[1]
+    return genes_group, groups_len
+
+def get_bins(groups_len, nb_bins: int):
+    '''
+    packs the groups into at most nb_bins bins balanced by their number of bases (largest groups first)
+    returns the bin of each group
+    '''
+    bins = [(0, i) for i in range(min(nb_bins, len(groups_len)))]
+    groups_bin = {}
+    for group, group_len in sorted(groups_len.items(), key=lambda item: -item[1]):
+        bin_len, i = heapq.heappop(bins)
+        groups_bin[group] = i
+        heapq.heappush(bins, (bin_len+group_len, i))
+    return groups_bin
+
+def write_bins(genes_file: str, genes, genes_bin, nb_bins: int, bins_dir: str):
+    '''
+    copies the records of the genes (see read_genes) of each bin (genes_bin: bin of each gene), in the order of the genes file
+    returns the bin files
+    '''
+    bins_files = [f"{bins_dir}/bin{i}.fasta" for i in range(nb_bins)]
+    handles = [open(bin_file, "wb") for bin_file in bins_files]
+    with open(genes_file, "rb") as f:
+        for (_, _, offset, size, _), i in zip(genes, genes_bin):
+            f.seek(offset)
+            handles[i].write(f.read(size))
+    for handle in handles:
+        handle.close()
+    return bins_files
+
+def cluster_bin(bin_file: str, cdhit_options: str):
+    run(f"cd-hit-est -i {bin_file} -o {bin_file[:-len('.fasta')]}_clusters {cdhit_options}",stdout=subprocess.PIPE,shell=True,check=True)
+
+def merge_bins(bins_files, out_prefix: str):
+    '''
+    concatenates the representatives and the .clstr files of the bins, clusters are renumbered
+    '''
+    nb_clusters = 0
+    with open(out_prefix, "w") as representatives_file, open(f"{out_prefix}.clstr", "w") as clstr_file:
+        for bin_file in bins_files:
+            bin_prefix = f"{bin_file[:-len('.fasta')]}_clusters"
+            if not os.path.exists(f"{bin_prefix}.clstr"):
+                sys.exit(f"cd-hit-est failed on {bin_file}")
+            with open(bin_prefix) as f:
+                shutil.copyfileobj(f, representatives_file)
+            with open(f"{bin_prefix}.clstr") as f:
+                for line in f:
+                    if line[0] == ">":
+                        line = f">Cluster {nb_clusters}\n"
+                        nb_clusters += 1
+                    clstr_file.write(line)
+    return nb_clusters
+
+def parse_cdhit_options(cdhit_options: str):
+    words = cdhit_options.split()
+    return dict(zip(words[::2], words[1::2]))
+
+def usage():
+    print(f"Usage: python3 {sys.argv[0]} -i genes (fasta) -o out_prefix [-x cd-hit-est_options] [-j nb_jobs] [-k k] [-S scaled] [-f link_fraction]")
+    print("\tcd-hit-est is run on groups of possibly similar genes, in parallel. The outputs are out_prefix (representatives) and out_prefix.clstr, as with cd-hit-est -o out_prefix")
+    print("\t-x: cd-hit-est options, quoted [default: \"-c 0.95 -aS 0.90 -g 1 -d 0 -M 0 -T 0 -G 0\"]")
+    print("\t-j: number of cd-hit-est run concurrently, sharing the threads of -T [default: 4]")
+    print("\t-k: length of the k-mers of the sketches [default: 16]")
+    print("\t-S: a sketch keeps one k-mer out of scaled [default: 100]")
+    print("\t-f: a gene joins a group sharing this fraction of the k-mers expected at the identity threshold (-c) [default: 0.5]")
+
+#if __name__ == "__main__":
+def genes_clustering_main():
+    # check arguments
+
+    genes_file = None
+    out_prefix = None
+    cdhit_options = "-c 0.95 -aS 0.90 -g 1 -d 0 -M 0 -T 0 -G 0"
+    nb_jobs = 4
+    k = 16
+    scaled = 100
+    link_fraction = 0.5
+
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hi:o:x:j:k:S:f:")
+
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(err) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o in ("-i"):
+            genes_file = a
+        elif o in ("-o"):
+            out_prefix = a
+        elif o in ("-x"):
+            cdhit_options = a
+        elif o in ("-j"):
+            nb_jobs = int(a)
+        elif o in ("-k"):
+            k = int(a)
+        elif o in ("-S"):
+            scaled = int(a)
+        elif o in ("-f"):
+            link_fraction = float(a)
+        else:
+            assert False, "unhandled option"
+    if not genes_file or not out_prefix or not 0 < k < 32:
+        usage()
+        exit()
+
+    os.makedirs(os.path.dirname(out_prefix) or ".", exist_ok=True)
+
+    # logger
+    setup_logger("logger", f"{out_prefix}_log.txt")
+    logger = logging.getLogger("logger")
+    start_report("genes_clustering", f"{out_prefix}_report.json")
+
+    options = parse_cdhit_options(cdhit_options)
+    identity = float(options.get("-c", 0.9))
+    # the threads are shared by the concurrent runs
+    nb_threads = int(options.get("-T", 1)) or cpu_count()
+    options["-T"] = str(max(1, nb_threads//nb_jobs))
+    cdhit_options = ' '.join(f"{option} {value}" for option, value in options.items())
+
+    with Timer("genes grouping") as _t:
+        genes = read_genes(genes_file, k, scaled)
+        genes_group, groups_len = get_groups(genes, identity, k, link_fraction)
+    logger.info(f"{len(genes_group)} genes in {len(groups_len)} groups (largest: {max(groups_len.values(), default=0)} bases out of {sum(groups_len.values())}) in: {_t.t}")
+
+    bins_dir = f"{out_prefix}_bins"
+    os.makedirs(bins_dir, exist_ok=True)
+    with Timer("bins writing"):
+        # more bins than jobs: a large bin does not delay the end of the others
+        groups_bin = get_bins(groups_len, 2*nb_jobs)
+        nb_bins = len(set(groups_bin.values()))
+        bins_files = write_bins(genes_file, genes, [groups_bin[group] for group in genes_group], nb_bins, bins_dir)
+
+    with Timer("clustering") as _t:
+        # cluster each bin in parallel
+        executor = Executor(nb_jobs)
+        for result in executor.run(Task(bin_file, cluster_bin, (bin_file, cdhit_options), os.path.getsize(bin_file)) for bin_file in bins_files):
+            if result["returncode"] != 0:
+                logger.error(f"cd-hit-est failed on {result['name']} (exit code {result['returncode']})")
+    logger.info(f"Multiprocessed clustering of {nb_bins} bins done in: {_t.t}")
+
+    with Timer("bins merging"):
+        nb_clusters = merge_bins(bins_files, out_prefix)
+    shutil.rmtree(bins_dir)
+    logger.info(f"{nb_clusters} clusters")
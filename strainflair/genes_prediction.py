@@ -6,63 +6,203 @@ import os
 from Bio import SeqIO # conversion to dict and to sequence
 import sys # manage arguments
 import getopt # manage arguments
-from multiprocessing import Queue, Process, Pool, Lock, cpu_count # multiprocessing
-import time # times stored in log
+from multiprocessing import cpu_count # number of chunks
 import logging # log.txt with times
+from .telemetry import Timer, setup_logger, start_report, run # times and resources stored in log and run report
+from .executor import Executor, Task # parallel genes prediction
+import re # renumber sequences in prodigal outputs
+import shutil # remove chunks of fasta files
+import hashlib # identical genes
+from .clusters_index import get_accession_number # strain of the duplicate genes
 
-class Timer:
-    def __enter__(self):
-        self.t1 = time.time()
-        return self
-    
-    def __exit__(self, *args):
-        self.t2 = time.time()
-        hours, rem = divmod(self.t2-self.t1, 3600)
-        minutes, seconds = divmod(rem, 60)
-        self.t = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
-
-def setup_logger(name, log_path):
-    l = logging.getLogger(name)
-    formatter = logging.Formatter("%(asctime)s -- %(levelname)s -- %(message)s")
-    fileHandler = logging.FileHandler(log_path, mode="w")
-    fileHandler.setFormatter(formatter)
-
-    l.setLevel(logging.DEBUG)
-    l.addHandler(fileHandler)
-
-def worker(q: Queue, out_dir: str, len_extend: int):
-    while True:
-        fasta_file = q.get()
-        if not fasta_file:
-            q.put(None)
-            break
-        predict_genes(fasta_file, out_dir, len_extend)
-
-
-def predict_genes(fasta_file: str, out_dir: str, len_extend: int):
+def predict_genes(fasta_file: str, out_dir: str, len_extend: int, training_file=None):
     print(f"out_dir is {out_dir}")
     fasta_basename = os.path.basename(os.path.splitext(fasta_file)[0])
-    subprocess.check_call(f"prodigal -i {fasta_file} -o {out_dir}/predGenes_{fasta_basename}.txt -d {out_dir}/predGenes_{fasta_basename}.fasta",shell=True)
-    p1 = subprocess.Popen(["grep",">",f"{out_dir}/predGenes_{fasta_basename}.fasta"], stdout=subprocess.PIPE)
-    id_genes = p1.communicate()[0]
-    id_genes = id_genes.decode().strip().split("\n")
+    # with a training file, prodigal uses its model instead of training on fasta_file
+    training_option = f" -t {training_file}" if training_file else ""
+    run(f"prodigal -i {fasta_file} -o {out_dir}/predGenes_{fasta_basename}.txt -d {out_dir}/predGenes_{fasta_basename}.fasta{training_option}",shell=True,check=True)
+
+    if len_extend != 0:
+        extend_genes(fasta_file, f"{out_dir}/predGenes_{fasta_basename}.fasta", f"{out_dir}/predGenes_{fasta_basename}_extended{len_extend}bp.fasta", len_extend)
+
+def extend_genes(fasta_file: str, genes_file: str, extended_file: str, len_extend: int):
+    '''
+    Write the genes predicted by prodigal extended by len_extend bases on both sides (within their contig)
+    The coordinates of the genes are read from the headers of the prodigal fasta output, each contig is read once
+    '''
+    # genes of each contig, in the prodigal order
+    # header: >contig_1 # start # end # strand # ID=...
+    contigs_genes = {}
+    with open(genes_file) as f:
+        for line in f:
+            if line.startswith(">"):
+                gene = line[1:].rstrip("\n").split("#")
+                idt = '_'.join(gene[0].split("_")[:-1])
+                if idt not in contigs_genes:
+                    contigs_genes[idt] = []
+                contigs_genes[idt].append(gene)
+
+    with open(extended_file, "w") as output_handle:
+        for record in SeqIO.parse(fasta_file, "fasta"):
+            if record.id not in contigs_genes:
+                continue
+            sequence = str(record.seq)
+            for gene in contigs_genes[record.id]:
+                start = int(gene[1])-len_extend
+                if start < 1: start = 1
+                end = int(gene[2])+len_extend
+                if end > len(sequence): end = len(sequence)
+                output_handle.write(">"+' # '.join([gene[0],str(start),str(end)]+gene[3:])+"\n")
+                # fasta lines of 60 bases, as written by SeqIO
+                for i in range(start-1, end, 60):
+                    output_handle.write(sequence[i:min(i+60, end)]+"\n")
+
+def get_fasta_chunks(fasta_file: str, nb_chunks: int, min_chunk_size=1000000):
+    '''
+    Split the records of a fasta file into at most nb_chunks chunks of consecutive records, balanced by their number of bases
+    A chunk has at least min_chunk_size bases (except if the whole file is smaller), smaller chunks are not worth a prodigal run
+    returns the number of records of each chunk
+    '''
+    records_len = []
+    with open(fasta_file) as f:
+        for line in f:
+            if line.startswith(">"):
+                records_len.append(0)
+            elif records_len:
+                records_len[-1] += len(line.rstrip())
+    chunk_size = max(min_chunk_size, sum(records_len) / nb_chunks)
+    chunks_nb_records = []
+    nb_records = 0
+    nb_bases = 0
+    for record_len in records_len:
+        nb_records += 1
+        nb_bases += record_len
+        if nb_bases >= chunk_size:
+            chunks_nb_records.append(nb_records)
+            nb_records = 0
+            nb_bases = 0
+    if nb_records:
+        # the last records are too few to be predicted alone, they go with the previous chunk
+        if chunks_nb_records and nb_bases < min_chunk_size:
+            chunks_nb_records[-1] += nb_records
+        else:
+            chunks_nb_records.append(nb_records)
+    return chunks_nb_records
+
+def write_fasta_chunks(fasta_file: str, chunks_nb_records, chunks_dir: str):
+    '''
+    Write the chunks of a fasta file (see get_fasta_chunks) in chunks_dir
+    returns the chunk files
+    '''
+    fasta_basename = os.path.basename(os.path.splitext(fasta_file)[0])
+    chunks_files = [f"{chunks_dir}/{fasta_basename}_chunk{i}.fasta" for i in range(len(chunks_nb_records))]
+    os.makedirs(chunks_dir, exist_ok=True)
+    chunk = -1
+    nb_records_left = 0
+    chunk_file = None
+    with open(fasta_file) as f:
+        for line in f:
+            if line.startswith(">"):
+                if not nb_records_left:
+                    chunk += 1
+                    nb_records_left = chunks_nb_records[chunk]
+                    if chunk_file: chunk_file.close()
+                    chunk_file = open(chunks_files[chunk], "w")
+                nb_records_left -= 1
+            if chunk_file:
+                chunk_file.write(line)
+    if chunk_file: chunk_file.close()
+    return chunks_files
+
+prodigal_seqnum_regex = re.compile(r"\b(ID=|seqnum=)([0-9]+)")
 
+def merge_chunks_predictions(fasta_file: str, chunks_files, chunks_nb_records, chunks_dir: str, out_dir: str, len_extend: int):
+    '''
+    Concatenate, in the order of the chunks, the predictions of the chunks of a fasta file
+    prodigal numbers the sequences of its input (ID=seqnum_genenum), they are renumbered as if the whole fasta file was given to prodigal
+    '''
+    fasta_basename = os.path.basename(os.path.splitext(fasta_file)[0])
+    suffixes = [".txt", ".fasta"]
     if len_extend != 0:
-        record_dict = SeqIO.to_dict(SeqIO.parse(fasta_file, "fasta"))
-        for gene in id_genes:
-            gene = gene.split("#")
-            idt = '_'.join(gene[0].split("_")[:-1])[1:]
-            start = int(gene[1])-len_extend
-            if start < 1: start = 1
-            end = int(gene[2])+len_extend
-            if end > len(record_dict[idt]): end = len(record_dict[idt])
-            with open(f"{out_dir}/predGenes_{fasta_basename}_extended{len_extend}bp.fasta", "a") as output_handle:
-                record_dict[idt].id = ' # '.join([gene[0],str(start),str(end)]+gene[3:])[1:]
-                record_dict[idt].description = ""
-                SeqIO.write(record_dict[idt][start-1:end], output_handle, "fasta")
+        suffixes.append(f"_extended{len_extend}bp.fasta")
+    for suffix in suffixes:
+        with open(f"{out_dir}/predGenes_{fasta_basename}{suffix}", "w") as output_handle:
+            offset = 0
+            for chunk_file, nb_records in zip(chunks_files, chunks_nb_records):
+                chunk_basename = os.path.basename(os.path.splitext(chunk_file)[0])
+                chunk_prediction = f"{chunks_dir}/predGenes_{chunk_basename}{suffix}"
+                # no extended file if no gene was predicted
+                if os.path.exists(chunk_prediction):
+                    with open(chunk_prediction) as f:
+                        for line in f:
+                            if offset and "=" in line:
+                                line = prodigal_seqnum_regex.sub(lambda match: f"{match.group(1)}{int(match.group(2))+offset}", line)
+                            output_handle.write(line)
+                offset += nb_records
+
+def natural_sort_key(file_name: str):
+    '''
+    sort file names in natural order (as ls -v): predGenes_2 before predGenes_10
+    '''
+    return [int(token) if token.isdigit() else token for token in re.split("([0-9]+)", file_name)]
+
+def concatenate_fasta_files(fasta_files, out_file: str, block_size=1<<20):
+    '''
+    Concatenate fasta files by blocks of bytes, counting the sequences (headers) of each file while copying
+    returns the number of sequences of each file
+    '''
+    files_nb_sequences = []
+    with open(out_file, "wb") as output_handle:
+        for fasta_file in fasta_files:
+            nb_sequences = 0
+            previous_block = b"\n"
+            with open(fasta_file, "rb") as f:
+                while True:
+                    block = f.read(block_size)
+                    if not block:
+                        break
+                    # headers inside the block, plus a header starting the block
+                    nb_sequences += block.count(b"\n>")
+                    if block[:1] == b">" and previous_block[-1:] == b"\n":
+                        nb_sequences += 1
+                    previous_block = block
+                    output_handle.write(block)
+            files_nb_sequences.append(nb_sequences)
+    return files_nb_sequences
+
+def collapse_duplicate_genes(genes_file: str, extended_file: str, duplicates_file: str):
+    '''
+    Keep only the first gene of the genes having the same sequence and the same extended sequence, in both fasta files
+    The other genes are written in duplicates_file (gene kept, duplicate gene, strain of the duplicate)
+    returns the number of genes removed
+    '''
+    # the extended file is empty without extension
+    extended_records = SeqIO.parse(extended_file, "fasta") if os.path.getsize(extended_file) else None
+    first_genes = {}
+    nb_duplicates = 0
+    with open(genes_file+".tmp", "w") as genes_handle, open(extended_file+".tmp", "w") as extended_handle, open(duplicates_file, "w") as duplicates_handle:
+        duplicates_handle.write("gene\tduplicate\tstrain\n")
+        for record in SeqIO.parse(genes_file, "fasta"):
+            extended_record = next(extended_records) if extended_records else None
+            if extended_record and extended_record.id != record.id:
+                sys.exit(f"{genes_file} and {extended_file} do not list the same genes ({record.id}, {extended_record.id})")
+            sequences = str(record.seq).upper() + ("\n"+str(extended_record.seq).upper() if extended_record else "")
+            key = hashlib.blake2b(sequences.encode(), digest_size=16).digest()
+            if key in first_genes:
+                duplicates_handle.write(f"{first_genes[key]}\t{record.id}\t{get_accession_number(record.id)}\n")
+                nb_duplicates += 1
+                continue
+            first_genes[key] = record.id
+            SeqIO.write([record], genes_handle, "fasta")
+            if extended_record:
+                SeqIO.write([extended_record], extended_handle, "fasta")
+    os.replace(genes_file+".tmp", genes_file)
+    os.replace(extended_file+".tmp", extended_file)
+    return nb_duplicates
 
 def usage():
-    print(f"Usage: python {sys.argv[0]} -s in_sequences (fasta or txt) -o out_dir -l len_extend (int)")
+    print(f"Usage: python {sys.argv[0]} -s in_sequences (fasta or txt) -o out_dir -l len_extend (int) [-u]")
+    print("\t-u: genes with the same sequence (and extended sequence) are written once, the others are listed in out_dir/all_genes_duplicates.tsv (see graphs_construction -u)")
 
 #if __name__ == "__main__":
 def genes_prediction_main():
@@ -71,9 +211,10 @@ def genes_prediction_main():
     in_sequences = None 
     out_dir = None 
     len_extend = 0
+    collapse_duplicates = False
     
     try:
-        opts, _ = getopt.getopt(sys.argv[1:], "hs:o:l:")
+        opts, _ = getopt.getopt(sys.argv[1:], "hs:o:l:u")
     
     except getopt.GetoptError as err:
         # print help information and exit:
@@ -90,6 +231,8 @@ def genes_prediction_main():
             out_dir = a
         elif o in ("-l"):
             len_extend = int(a)
+        elif o in ("-u"):
+            collapse_duplicates = True
         
         else:
             assert False, "unhandled option"
@@ -106,37 +249,68 @@ def genes_prediction_main():
     # setup logger
     setup_logger("logger", f"{out_dir}/genes_prediction_log.txt")
     logger = logging.getLogger("logger")
+    start_report("genes_prediction", f"{out_dir}/genes_prediction_report.json")
 
     # genes prediction
-    with Timer() as _t:
-        # queue initialization (for files)
-        q = Queue() 
-
-        # predict genes for each fasta in parallel
-        processes = Pool(initializer=worker, initargs=(q, out_dir, len_extend))
-
-        # fill the queue with the files to process
+    with Timer("genes prediction") as _t:
+        # files to process
+        tasks = []
+        chunks = None
         if in_sequences.endswith(".fasta") or in_sequences.endswith(".fna"):
-            q.put(in_sequences)
+            # the genomes of a single fasta file are split into chunks predicted in parallel
+            chunks_nb_records = get_fasta_chunks(in_sequences, cpu_count())
+            if len(chunks_nb_records) > 1:
+                chunks_dir = f"{out_dir}/chunks_{os.path.basename(os.path.splitext(in_sequences)[0])}"
+                chunks_files = write_fasta_chunks(in_sequences, chunks_nb_records, chunks_dir)
+                chunks = (chunks_files, chunks_nb_records, chunks_dir)
+                # prodigal is trained once on the whole file and each chunk is predicted with this model,
+                # as prodigal would predict the whole file (same genes, same gene numbers)
+                training_file = f"{chunks_dir}/{os.path.basename(os.path.splitext(in_sequences)[0])}.trn"
+                if os.path.exists(training_file):
+                    os.remove(training_file)
+                run(f"prodigal -i {in_sequences} -t {training_file}",stdout=subprocess.PIPE,shell=True,check=True)
+                tasks = [(chunk_file, chunks_dir, training_file) for chunk_file in chunks_files]
+            else:
+                tasks = [(in_sequences, out_dir, None)]
         else:
             with open(in_sequences) as f:
-                for fasta_file in f:
-                    q.put(fasta_file.rstrip("\n"))
-        q.put(None)
+                tasks = [(fasta_file.rstrip("\n"), out_dir, None) for fasta_file in f]
+
+        # predict genes for each fasta in parallel
+        executor = Executor()
+        for result in executor.run(Task(fasta_file, predict_genes, (fasta_file, task_out_dir, len_extend, training_file), os.path.getsize(fasta_file)) for fasta_file, task_out_dir, training_file in tasks):
+            if result["returncode"] != 0:
+                logger.error(f"Genes prediction of {result['name']} failed (exit code {result['returncode']})")
+        if executor.get_failures():
+            sys.exit(1)
 
-        # end multiprocessing
-        processes.close()
-        processes.join()
+        if chunks:
+            merge_chunks_predictions(in_sequences, *chunks, out_dir, len_extend)
+            shutil.rmtree(chunks[2])
     
-    # concatenate
-    subprocess.run(f"cat `ls -v {out_dir}/*.fasta | grep -v 'extended'` > {out_dir}/all_genes.fasta",shell=True)
-    subprocess.run(f"cat $(ls -v {out_dir}/*extended*.fasta) > {out_dir}/all_genes_extended.fasta",shell=True)
+    # concatenate the genes of all genomes, in natural order of the files (as ls -v)
+    with Timer("concatenation"):
+        predictions_files = sorted((file_name for file_name in os.listdir(out_dir) if file_name.startswith("predGenes_") and file_name.endswith(".fasta")), key=natural_sort_key)
+        # extended genes of predGenes_X.fasta are in predGenes_X_extended{len_extend}bp.fasta (X may contain "extended").
+        # They are listed in the order of the genes files, as collapse_duplicate_genes reads both files side by side
+        extended_suffix = f"_extended{len_extend}bp.fasta"
+        get_extended_file = lambda file_name: file_name[:-len(".fasta")]+extended_suffix
+        is_extended_file = lambda file_name: len_extend != 0 and file_name.endswith(extended_suffix) and f"{file_name[:-len(extended_suffix)]}.fasta" in predictions_files
+        genes_files = [file_name for file_name in predictions_files if not is_extended_file(file_name)]
+        extended_files = [get_extended_file(file_name) for file_name in genes_files if len_extend != 0 and get_extended_file(file_name) in predictions_files]
+        genomes_nb_genes = concatenate_fasta_files([f"{out_dir}/{file_name}" for file_name in genes_files], f"{out_dir}/all_genes.fasta")
+        concatenate_fasta_files([f"{out_dir}/{file_name}" for file_name in extended_files], f"{out_dir}/all_genes_extended.fasta")
 
     logger.info(f"Multiprocessed genes prediction done in: {_t.t}")
 
-    nb_genes = 0
-    with open(f"{out_dir}/all_genes.fasta","r") as f:
-        for line in f:
-            if line.startswith(">"):
-                nb_genes += 1
-    logger.info(f"Total number of predicted genes: {nb_genes}")
\ No newline at end of file
+    # number of genes of each genome
+    with open(f"{out_dir}/genes_counts.tsv", "w") as f:
+        f.write("genome\tnb_genes\n")
+        for file_name, nb_genes in zip(genes_files, genomes_nb_genes):
+            f.write(f"{file_name[len('predGenes_'):-len('.fasta')]}\t{nb_genes}\n")
+    logger.info(f"Total number of predicted genes: {sum(genomes_nb_genes)}")
+
+    if collapse_duplicates:
+        with Timer("duplicates collapsing") as _t:
+            nb_duplicates = collapse_duplicate_genes(f"{out_dir}/all_genes.fasta", f"{out_dir}/all_genes_extended.fasta", f"{out_dir}/all_genes_duplicates.tsv")
+        logger.info(f"{nb_duplicates} duplicate genes collapsed in: {_t.t}")
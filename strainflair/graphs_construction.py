@@ -5,68 +5,77 @@ import subprocess # execute vg
 from Bio import SeqIO # conversion to dict and to sequence
 import sys # manage arguments
 import getopt # manage arguments
-from multiprocessing import Queue, Process, Pool, Lock, cpu_count # multiprocessing
 from tempfile import TemporaryDirectory # temporary fasta and paf file for each cluster
-import time # times stored in log
 import logging # log.txt with times
-import pickle # save d_clusters
+from .telemetry import Timer, setup_logger, start_report, run # times and resources stored in log and run report
+import os # graphs already built
+from .clusters_index import ClustersIndexWriter # save the clusters
+from .executor import Executor, Task # parallel graphs building
 
-class Timer:
-    def __enter__(self):
-        self.t1 = time.time()
-        return self
-    
-    def __exit__(self, *args):
-        self.t2 = time.time()
-        hours, rem = divmod(self.t2-self.t1, 3600)
-        minutes, seconds = divmod(rem, 60)
-        self.t = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
-
-def setup_logger(name, log_path):
-    l = logging.getLogger(name)
-    formatter = logging.Formatter("%(asctime)s -- %(levelname)s -- %(message)s")
-    fileHandler = logging.FileHandler(log_path, mode="w")
-    fileHandler.setFormatter(formatter)
-
-    l.setLevel(logging.DEBUG)
-    l.addHandler(fileHandler)
-
-def clstr2dict(clstr_file: str):
+def iter_clusters(clstr_file: str):
     '''
-    Convert cluster file into dictionary 
-    key = cluster id
-    value = dict with gene_list and length of representative
+    Stream the clusters of a cluster file, each cluster is yielded as soon as it is read
+    yields (cluster id, dict with gene_list, length of each gene and length of representative)
     '''
-    d_clusters = {}
+    cluster_name = None
     with open(clstr_file) as f:
         for line in f:
             line = line.strip()
+            if not line:
+                continue
             if line[0] == ">":
+                if cluster_name is not None:
+                    yield cluster_name, cluster
                 cluster_name = line[1:].replace(" ","_")
-                d_clusters[cluster_name] = {}
-                d_clusters[cluster_name]['genes_list'] = []
+                cluster = {'genes_list': [], 'genes_len': []}
             else:
                 split_line = line.split()
                 id_seq = split_line[2][1:-3] # delete > and ...
-                d_clusters[cluster_name]['genes_list'].append(id_seq)
+                cluster['genes_list'].append(id_seq)
+                cluster['genes_len'].append(int(split_line[1][:-3]))
                 # get the length of the representative sequence
                 if split_line[-1] == '*':
-                    d_clusters[cluster_name]['len_rep'] = int(split_line[1][:-3])
-    return d_clusters
+                    cluster['len_rep'] = cluster['genes_len'][-1]
+    if cluster_name is not None:
+        yield cluster_name, cluster
+
+def read_duplicates(duplicates_file: str):
+    '''
+    genes with the same sequence as a gene of the clusters (see genes_prediction -u)
+    returns a dict (gene -> its duplicates)
+    '''
+    duplicates = {}
+    with open(duplicates_file) as f:
+        next(f) # header
+        for line in f:
+            gene, duplicate = line.split("\t")[:2]
+            if gene not in duplicates:
+                duplicates[gene] = []
+            duplicates[gene].append(duplicate)
+    return duplicates
+
+def add_duplicates(cluster, duplicates):
+    '''
+    cluster with the duplicates of its genes (same length), stored in the clusters index as the other genes
+    '''
+    genes_list = list(cluster['genes_list'])
+    genes_len = list(cluster['genes_len'])
+    for idt, gene_len in zip(cluster['genes_list'], cluster['genes_len']):
+        genes_list += duplicates.get(idt, [])
+        genes_len += [gene_len]*len(duplicates.get(idt, []))
+    return dict(cluster, genes_list=genes_list, genes_len=genes_len)
 
-def worker(q: Queue, d_clusters, d_IdToSeq, out_dir: str):
-    while True:
-        cluster_name = q.get()
-        if not cluster_name:
-            q.put(None)
-            break
-        cluster2graph(cluster_name, d_clusters, d_IdToSeq, out_dir)
+def build_graph(cluster_name: str, genes_list, d_IdToSeq, out_dir: str, large_cluster_size=1000, nb_representatives=20):
+    if len(genes_list) > large_cluster_size:
+        large_cluster2graph(cluster_name, genes_list, d_IdToSeq, out_dir, nb_representatives)
+    else:
+        cluster2graph(cluster_name, genes_list, d_IdToSeq, out_dir)
 
-def cluster2graph(cluster_name: str, d_clusters, d_IdToSeq, out_dir: str):
+def cluster2graph(cluster_name: str, genes_list, d_IdToSeq, out_dir: str):
 
     '''
     graph construction
-    input = cluster_name
+    input = cluster_name and its genes
     '''
 
     # creating temporary files in a temporary folder
@@ -74,24 +83,103 @@ def cluster2graph(cluster_name: str, d_clusters, d_IdToSeq, out_dir: str):
 
         # create temporary merged fasta for all sequences of the cluster
         with open(f"{temp_dir}/cluster_temp.fasta", "w") as f:
-            for idt in d_clusters[cluster_name]['genes_list']:
+            for idt in genes_list:
                 SeqIO.write([d_IdToSeq[idt]], f, "fasta")   
     
-        # build the graph
-        if len(d_clusters[cluster_name]['genes_list']) == 1: # if only one sequence in the cluster, just build a linear graph with vg construct
-            subprocess.run(f"vg construct -r {temp_dir}/cluster_temp.fasta -m 256 > {out_dir}/{cluster_name}.vg",stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
+        # build the graph in a temporary file, renamed once the graph is complete (an interrupted run leaves no partial graph)
+        graph_file = f"{out_dir}/{cluster_name}.vg"
+        if len(genes_list) == 1: # if only one sequence in the cluster, just build a linear graph with vg construct
+            run(f"vg construct -r {temp_dir}/cluster_temp.fasta -m 256 > {graph_file}.tmp",stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,check=True)
         else:
-            subprocess.run(f"minimap2 -cx asm20 -X -t 8 {temp_dir}/cluster_temp.fasta {temp_dir}/cluster_temp.fasta | gzip > {temp_dir}/cluster_temp.paf.gz",stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
-            subprocess.run(f"seqwish -s {temp_dir}/cluster_temp.fasta -p {temp_dir}/cluster_temp.paf.gz -b {temp_dir}/cluster_temp.work -g {temp_dir}/cluster_temp.gfa",shell=True)
-            subprocess.run(f"vg view -Fv {temp_dir}/cluster_temp.gfa | vg mod -n -X 256 - | vg sort - > {out_dir}/{cluster_name}.vg",shell=True)
+            run(f"minimap2 -cx asm20 -X -t 8 {temp_dir}/cluster_temp.fasta {temp_dir}/cluster_temp.fasta | gzip > {temp_dir}/cluster_temp.paf.gz",stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
+            run(f"seqwish -s {temp_dir}/cluster_temp.fasta -p {temp_dir}/cluster_temp.paf.gz -b {temp_dir}/cluster_temp.work -g {temp_dir}/cluster_temp.gfa",shell=True,check=True)
+            run(f"vg view -Fv {temp_dir}/cluster_temp.gfa | vg mod -n -X 256 - | vg sort - > {graph_file}.tmp",shell=True)
             # -n can mess up the graph, check for its integrity otherwise redo the graph without -n
-            p1 = subprocess.Popen(["vg","validate",f"{out_dir}/{cluster_name}.vg"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out,err = p1.communicate()
+            err = run(["vg","validate",f"{graph_file}.tmp"], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stderr
             if err.decode() != "":
-                subprocess.run(f"vg view -Fv {temp_dir}/cluster_temp.gfa | vg mod -X 256 - | vg sort - > {out_dir}/{cluster_name}.vg",shell=True)
+                run(f"vg view -Fv {temp_dir}/cluster_temp.gfa | vg mod -X 256 - | vg sort - > {graph_file}.tmp",shell=True,check=True)
+        os.replace(f"{graph_file}.tmp", graph_file)
+
+# Large clusters (thousands of near identical genes): an all-vs-all minimap2 is quadratic in the number of genes.
+# Identical sequences are aligned once, and the distinct sequences are only aligned against a few representatives
+# (and the representatives all-vs-all). The graph has a path for each gene, spelling its sequence, as with cluster2graph,
+# but sequences aligned to no representative are not merged with the others.
+
+def group_identical_genes(genes_list, d_IdToSeq):
+    '''
+    returns the distinct sequences of the genes, as a dict (first gene with this sequence -> other genes with this sequence)
+    '''
+    first_gene = {}
+    duplicates = {}
+    for idt in genes_list:
+        sequence = str(d_IdToSeq[idt].seq).upper()
+        if sequence in first_gene:
+            duplicates[first_gene[sequence]].append(idt)
+        else:
+            first_gene[sequence] = idt
+            duplicates[idt] = []
+    return duplicates
+
+def add_duplicate_paths(gfa_file_name: str, duplicates, out_file_name: str):
+    '''
+    copy a gfa, adding after the path of each gene the paths of the genes with the same sequence (same walk)
+    '''
+    with open(gfa_file_name) as gfa_file, open(out_file_name, "w") as out_file:
+        for line in gfa_file:
+            out_file.write(line)
+            if line[0] == "P":
+                name, walk = line.split("\t", 2)[1:]
+                for idt in duplicates.get(name, []):
+                    out_file.write(f"P\t{idt}\t{walk}")
+
+def large_cluster2graph(cluster_name: str, genes_list, d_IdToSeq, out_dir: str, nb_representatives=20):
+
+    '''
+    graph construction of a large cluster
+    input = cluster_name and its genes
+    '''
+
+    duplicates = group_identical_genes(genes_list, d_IdToSeq)
+    # representatives: the most frequent sequences, then the longest
+    distinct_genes = sorted(duplicates, key=lambda idt: (-len(duplicates[idt]), -len(d_IdToSeq[idt].seq)))
+    representatives = distinct_genes[:nb_representatives]
+    others = distinct_genes[nb_representatives:]
+    logging.getLogger("logger").info(f"{cluster_name}: {len(genes_list)} genes, {len(distinct_genes)} distinct sequences aligned against {len(representatives)} representatives")
+
+    with TemporaryDirectory() as temp_dir:
+
+        with open(f"{temp_dir}/representatives.fasta", "w") as f:
+            SeqIO.write([d_IdToSeq[idt] for idt in representatives], f, "fasta")
+        with open(f"{temp_dir}/others.fasta", "w") as f:
+            SeqIO.write([d_IdToSeq[idt] for idt in others], f, "fasta")
+        with open(f"{temp_dir}/cluster_temp.fasta", "w") as f:
+            SeqIO.write([d_IdToSeq[idt] for idt in distinct_genes], f, "fasta")
+
+        graph_file = f"{out_dir}/{cluster_name}.vg"
+        if len(distinct_genes) == 1:
+            # a single sequence: one node, chopped by vg mod
+            with open(f"{temp_dir}/cluster_temp.gfa", "w") as f:
+                f.write(f"H\tVN:Z:1.0\nS\t1\t{str(d_IdToSeq[representatives[0]].seq)}\nP\t{representatives[0]}\t1+\t*\n")
+        else:
+            alignments = f"minimap2 -cx asm20 -X -t 8 {temp_dir}/representatives.fasta {temp_dir}/representatives.fasta"
+            if others:
+                alignments = f"({alignments}; minimap2 -cx asm20 -t 8 {temp_dir}/representatives.fasta {temp_dir}/others.fasta)"
+            run(f"{alignments} | gzip > {temp_dir}/cluster_temp.paf.gz",stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
+            run(f"seqwish -s {temp_dir}/cluster_temp.fasta -p {temp_dir}/cluster_temp.paf.gz -b {temp_dir}/cluster_temp.work -g {temp_dir}/cluster_temp.gfa",shell=True,check=True)
+        add_duplicate_paths(f"{temp_dir}/cluster_temp.gfa", duplicates, f"{temp_dir}/cluster_all.gfa")
+        run(f"vg view -Fv {temp_dir}/cluster_all.gfa | vg mod -n -X 256 - | vg sort - > {graph_file}.tmp",shell=True)
+        # -n can mess up the graph, check for its integrity otherwise redo the graph without -n
+        err = run(["vg","validate",f"{graph_file}.tmp"], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stderr
+        if err.decode() != "":
+            run(f"vg view -Fv {temp_dir}/cluster_all.gfa | vg mod -X 256 - | vg sort - > {graph_file}.tmp",shell=True,check=True)
+        os.replace(f"{graph_file}.tmp", graph_file)
 
 def usage():
-    print(f"Usage: python3 {sys.argv[0]} -s in_sequences (fasta) -c in_clusters -o out_dir -l min_length (float)")
+    print(f"Usage: python3 {sys.argv[0]} -s in_sequences (fasta) -c in_clusters -o out_dir -l min_length (float) [-r] [-L large_cluster_size] [-n nb_representatives] [-u duplicates_file]")
+    print("\t-r: resume an interrupted run, the graphs of clusters already built in out_dir are kept")
+    print("\t-L: clusters with more genes are built without all-vs-all alignment: identical sequences are aligned once, and the others against representatives [default: 1000]")
+    print("\t-n: number of representatives of the large clusters [default: 20]")
+    print("\t-u: duplicate genes of the clusters (see genes_prediction -u). They are stored in the clusters index, with the gene of the graph having the same sequence")
 
 
 #if __name__ == "__main__":
@@ -102,9 +190,13 @@ def graphs_construction_main():
     in_clusters = None 
     out_dir = None 
     min_length = 0
+    resume = False
+    large_cluster_size = 1000
+    nb_representatives = 20
+    duplicates_file = None
     
     try:
-        opts, _ = getopt.getopt(sys.argv[1:], "hs:c:o:l:")
+        opts, _ = getopt.getopt(sys.argv[1:], "hs:c:o:l:rL:n:u:")
     
     except getopt.GetoptError as err:
         # print help information and exit:
@@ -123,6 +215,14 @@ def graphs_construction_main():
             out_dir = a
         elif o in ("-l"):
             min_length = float(a)
+        elif o in ("-r"):
+            resume = True
+        elif o in ("-L"):
+            large_cluster_size = int(a)
+        elif o in ("-n"):
+            nb_representatives = int(a)
+        elif o in ("-u"):
+            duplicates_file = a
         
         else:
             assert False, "unhandled option"
@@ -133,33 +233,41 @@ def graphs_construction_main():
     # logger
     setup_logger("logger", f"{out_dir}/graph_construction_log.txt")
     logger = logging.getLogger("logger")
+    start_report("graphs_construction", f"{out_dir}/graphs_construction_report.json")
 
     # start pipeline
 
     # sequence file into dictionary (key = sequence Id, value = sequence)
-    d_IdToSeq = SeqIO.to_dict(SeqIO.parse(in_sequences, "fasta"))
+    with Timer("sequences loading"):
+        d_IdToSeq = SeqIO.to_dict(SeqIO.parse(in_sequences, "fasta"))
+        duplicates = read_duplicates(duplicates_file) if duplicates_file else {}
 
-    # cluster file into dictionary (key = cluster id, value = gene list + length of representative sequence)
-    d_clusters = clstr2dict(in_clusters)
-    pickle_out = open(out_dir+"/dict_clusters.pickle","wb")
-    pickle.dump(d_clusters, pickle_out)
-    pickle_out.close()
-
-    with Timer() as _t:
-        # queue initialization (for clusters)
-        q = Queue() 
+    with Timer("graphs building") as _t:
+        # stream the cluster file: each cluster is built as soon as it is read (and a worker is free), and stored in the clusters index (gene name -> cluster id + cluster statistics), used by json2csv -p
+        clusters_index = ClustersIndexWriter(out_dir+"/clusters_index.db")
+        def clusters_tasks():
+            for cluster_name, cluster in iter_clusters(in_clusters):
+                if duplicates:
+                    # only one gene of each sequence has a path in the graph
+                    clusters_index.add_cluster(cluster_name, add_duplicates(cluster, duplicates))
+                    for idt in cluster['genes_list']:
+                        if idt in duplicates:
+                            clusters_index.add_duplicates(idt, duplicates[idt])
+                else:
+                    clusters_index.add_cluster(cluster_name, cluster)
+                if cluster['len_rep'] >= min_length and not (resume and os.path.exists(f"{out_dir}/{cluster_name}.vg")):
+                    yield Task(cluster_name, build_graph, (cluster_name, cluster['genes_list'], d_IdToSeq, out_dir, large_cluster_size, nb_representatives), sum(cluster['genes_len']))
 
         # construct graph for each cluster in parallel
-        processes = Pool(initializer=worker, initargs=(q, d_clusters, d_IdToSeq, out_dir))
-
-        # fill the queue with the clusters to process
-        for cluster_name in d_clusters:
-            if d_clusters[cluster_name]['len_rep'] >= min_length:
-                q.put(cluster_name)
-        q.put(None)
-
-        # end multiprocessing
-        processes.close()
-        processes.join()
+        executor = Executor()
+        for result in executor.run(clusters_tasks()):
+            if result["returncode"] != 0:
+                logger.error(f"Graph of {result['name']} failed (exit code {result['returncode']})")
+        clusters_index.close()
     logger.info(f"Multiprocessed graphs building done in: {_t.t}")
+    failures = executor.get_failures()
+    if failures:
+        # graphs not built are built again with -r
+        logger.error(f"{len(failures)} graphs failed")
+        sys.exit(1)
 
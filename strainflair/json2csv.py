@@ -9,6 +9,15 @@ import sys
 import getopt
 import os # for size files 
 import re
+import shutil # for concatenating shard outputs
+import time # profiling
+import io # in memory gene-level results (preview)
+import random # random subsample of the reads (preview)
+import atexit # profiling reports are written when json2csv exits
+from .clusters_index import iter_genes_clusters, get_duplicate_genes, get_accession_number
+from .telemetry import Timer, start_report # run report
+from multiprocessing import Process, Queue # cluster-sharded query
+import queue # full queues of the shards
 
 # update_progress() : Displays or updates a console progress bar
 ## Accepts a float between 0 and 1. Any int will be converted to a float.
@@ -35,12 +44,62 @@ def update_progress(progress):
     sys.stderr.flush()
     
 def file_size(f):
+    """
+    None if the file is not seekable (pipe)
+    """
+    if not f.seekable():
+        return None
     old_file_position = f.tell()
     f.seek(0, os.SEEK_END)
     size = f.tell()
     f.seek(old_file_position, os.SEEK_SET)
     return size
 
+def iter_gfa(gfa_file_name: str, progress=True, block_size=1<<24):
+    """
+    PARSE GFA FILE (S and P lines), read in binary mode by blocks of block_size bytes
+    yields ('S', node id (int), length of the sequence) and ('P', path name, node list (eg 684619+,684620+,684618+)).
+    Sequences are not decoded, only their length is computed. The progress is the number of bytes read
+    """
+    size_file = os.path.getsize(gfa_file_name)
+    read = 0
+    rest = b""  # incomplete last line of the previous block
+    with open(gfa_file_name, 'rb') as gfa_file:
+        while True:
+            block = gfa_file.read(block_size)
+            read += len(block)
+            if block:
+                buffer = rest + block
+                end = buffer.rfind(b"\n") + 1
+                rest = buffer[end:]
+            else:
+                # last line without end of line
+                buffer, end, rest = rest, len(rest), b""
+            start = 0
+            while start < end:
+                line_end = buffer.find(b"\n", start, end)
+                if line_end == -1:
+                    line_end = end
+                # first field is S or P
+                if buffer[start+1:start+2] == b"\t" and buffer[start] in (83, 80):
+                    name_end = buffer.find(b"\t", start+2, line_end)
+                    field_end = buffer.find(b"\t", name_end+1, line_end)
+                    if field_end == -1:
+                        # last field: trailing spaces and \r are not part of it
+                        field_end = line_end
+                        while field_end > name_end+1 and buffer[field_end-1] in (13, 32):
+                            field_end -= 1
+                    if buffer[start] == 83:
+                        # S       1       ACCACGATTACGCTGGCGCTTA
+                        yield 'S', int(buffer[start+2:name_end]), field_end-name_end-1
+                    else:
+                        # P       gi|1388876906|ref|NZ_CP028116.1|_1000   684619+,684620+,684618+ 187M,187M,1M 
+                        yield 'P', buffer[start+2:name_end].decode(), buffer[name_end+1:field_end].decode()
+                start = line_end+1
+            if progress and size_file: update_progress(read/size_file)
+            if not block:
+                break
+
 reverse_sign = lambda x: '-' if (x=='+') else '+'
 
 def canonical(node_list: str):
@@ -60,19 +119,9 @@ def canonical(node_list: str):
         rev_list = ','.join([val[:-1]+reverse_sign(val[-1]) for val in reversed(splitted_node_list)])
         return rev_list
 
-def get_accession_number(line: str):
-    accession_number = None
-    line = '_'.join(line.split("_")[:-1]) # delete gene id
-    line = line.split("|")
-    for element in line:
-        if re.match("[a-zA-Z]+_?[a-zA-Z]*[0-9]+", element):
-            accession_number = element
-            break
-    return accession_number
-
 class Node:
-    def __init__(self, sequence: str):
-        self.len_sequence = len(sequence)   # we need to remind the length of the sequence of each node for statistical computations
+    def __init__(self, len_sequence: int):
+        self.len_sequence = len_sequence    # we need to remind the length of the sequence of each node for statistical computations
         self.traversed_path = []            # ids (int) of the traversed paths. This corresponds to indexes in the Pangenome.paths list
 
 
@@ -80,17 +129,24 @@ class Path:
     def __init__(self):
         self.node_ids   = []                # a set of node ids (ints)
         self.cluster_id = None              # id (string) of the cluster this path belongs to 
-        self.strain_ids = {}                # ids of the genes that generated this path with their counts. 
+        self.strain_ids = {}                # ids (int, see Pangenome.strain_names) of the strains of the genes that generated this path with their counts. 
         #----
-        self.unique_mapped_abundances  = [] # for each node of the path (ordered as `self.nodes`), store the coverage of mapped reads (each node of a mapped path is set to one, except the two extreme than are usually not 100% covered by the mapped sequence)
+        self.len_sequence = 0               # length of the sequence of the path (sum of the lengths of its nodes)
+        self.unique_mapped_abundances  = [] # for each node of the path (ordered as `self.nodes`), store the coverage of mapped reads (each node of a mapped path is set to one, except the two extreme than are usually not 100% covered by the mapped sequence). View of Pangenome.unique_mapped_abundances
         self.total_mapped_unique_reads = 0  #  number of reads with unique mapping on this path. 
         self.total_mapped_unique_reads_normalized = 0 # number of coverage ratio reads with unique mapping on this path. Coverage ratio is the length of the read / the len of the sequence of the path
         # self.hamming_distance   = []        # for each node of the path (ordered as `self.nodes`), store the number of substitutions when mapping reads
-        self.multiple_mapped_abundances = []# for each node of the path (ordered as `self.nodes`), store the coverage of multiple mapped reads (normalized wrt their repartition in other paths)
+        self.multiple_mapped_abundances = []# for each node of the path (ordered as `self.nodes`), store the coverage of multiple mapped reads (normalized wrt their repartition in other paths). View of Pangenome.multiple_mapped_abundances
         self.total_mapped_mult_reads = 0    #  number of reads with corrected multiple mapping on this path. 
         self.total_mapped_mult_reads_normalized = 0
         
 
+def write_csv_header(cvs_file, species_names):
+    for species_name in species_names:
+        cvs_file.write(f"{species_name};")
+    cvs_file.write(f"hamming;cluster;seq_len;nb_uniq_mapped;nb_uniq_mapped_normalized;nb_multimapped;nb_multimapped_normalized;mean_abund_uniq;mean_abund_uniq_nz;mean_abund_multiple;mean_abund_multiple_nz;ratio_covered_nodes\n")
+
+
 class Pangenome:
     def __init__(self):
         """ 
@@ -98,107 +154,208 @@ class Pangenome:
         """
         self.nodes = {}                     # key: id (unsigned int), value: node 
         self.paths = []                     # a list of ordered paths (id of a path is its ranks in this list)
-        self.paths_name_to_ids = {}         # no choice: each path has a string name, eg gi|1388876906|ref|NZ_CP028116.1|_1000. Two identical paths (eg 684619+,684620+,684618+) may have distinct occurrences and thus names (as comming from distinct genes). Hence one storesfor each path name its unique path id.
-        self.paths_content_to_ids = {}      # no choice: each path has a content, eg 684619+,684620+,684618+. This is the key to know its UNIQUE id (int) that is also the rank in the self.paths list
+        self.paths_name_to_ids = {}         # each path has a string name, eg gi|1388876906|ref|NZ_CP028116.1|_1000. Two identical paths (eg 684619+,684620+,684618+) may have distinct occurrences and thus names (as comming from distinct genes). Hence one storesfor each path name its unique path id. Only used for filling the clusters, then emptied.
+        self.paths_content_to_ids = {}      # each path has a content, eg 684619+,684620+,684618+. The 64-bit hash of the content is the key to know its UNIQUE id (int) that is also the rank in the self.paths list
+        self.paths_content_collisions = {}  # contents whose hash is already used by another content (key: content, value: path id)
+        self.paths_orientations = []        # orientations of the nodes of each path (eg "++-"), with node_ids they tell the content of a path. Only used for filling the pangenome, then emptied.
         self.species_names = set()          # store all species ids NZ_CP007592.1, NC_013654.1, ...
-        self.hamming_freq = {}              # for each species, store the hamming frequence (eg. hamming_freq["NZ_CP007592.1"][3] = 12 (12 reads mapped with 3 substitutions))
+        self.strain_index = {}              # key: species id, value: its int id, also its row in self.hamming_freq
+        self.strain_names = []              # species id of each strain int id
+        self.hamming_freq = np.zeros((0,1), dtype=np.int64) # for each species (row), store the hamming frequence (eg. hamming_freq[strain_index["NZ_CP007592.1"],3] = 12 (12 reads mapped with 3 substitutions))
+        self.errors_path_ids = []           # mapping errors not yet added to hamming_freq: path ids,
+        self.errors_nb_errors = []          # numbers of errors 
+        self.errors_nb_reads = []           # and numbers of reads
+        self.paths_strains = None           # strain indexes of all paths, concatenated (built when adding the first errors) 
+        self.paths_strains_start = None     # position of the strain indexes of each path in self.paths_strains
+        self.paths_start = np.zeros(1, dtype=np.int64) # position of the nodes of each path in the flat abundances arrays (see init_abundances)
+        self.unique_mapped_abundances = np.zeros(0)     # node abundances of all paths, path after path
+        self.multiple_mapped_abundances = np.zeros(0)
+        self.abundances_starts = []         # unique mapped node abundances not yet added to unique_mapped_abundances: positions of their first node,
+        self.abundances_counts = []         # numbers of nodes
+        self.abundances_values = []         # and abundances of each node
+        self.found_gene_paths_cache = {}    # key: node ids of an alignment (tuple), value: the paths matching it (see get_found_gene_paths)
+        self.found_gene_paths_cache_size = 100000 # the cache is emptied when it reaches this number of alignments
 
     
+    def reset_abundances(self):
+        """
+        reset all the mapping results, the graph is kept
+        """
+        for path in self.paths:
+            path.total_mapped_unique_reads = 0
+            path.total_mapped_unique_reads_normalized = 0
+        self.unique_mapped_abundances[:] = 0
+        self.abundances_starts, self.abundances_counts, self.abundances_values = [], [], []
+        self.reset_multi_mapped_abundances()
+        self.hamming_freq[:] = 0
+        self.errors_path_ids, self.errors_nb_errors, self.errors_nb_reads = [], [], []
+
+    def reset_multi_mapped_abundances(self):
+        """
+        reset the results of the second pass (see add_multi_mapped_reads)
+        """
+        self.multiple_mapped_abundances[:] = 0
+        for path in self.paths:
+            path.total_mapped_mult_reads = 0
+            path.total_mapped_mult_reads_normalized = 0
+
     def get_sequence_length(self, path):
-        sum_seq_len = 0
-        for node_id in path.node_ids:
-            sum_seq_len+=self.nodes[node_id].len_sequence
-        return sum_seq_len
+        return path.len_sequence
 
-    def fill_pangenome(self, gfa_file_name: str):
+    def init_abundances(self):
+        """
+        node abundances of all paths are stored in two flat arrays, path after path. The abundances of a path are views of these arrays.
+        Also computes the sequence length of each path
+        """
+        self.paths_start = np.cumsum([0]+[len(path.node_ids) for path in self.paths], dtype=np.int64)
+        self.unique_mapped_abundances = np.zeros(self.paths_start[-1])
+        self.multiple_mapped_abundances = np.zeros(self.paths_start[-1])
+        for path_id, path in enumerate(self.paths):
+            start, end = self.paths_start[path_id], self.paths_start[path_id+1]
+            path.unique_mapped_abundances = self.unique_mapped_abundances[start:end]
+            path.multiple_mapped_abundances = self.multiple_mapped_abundances[start:end]
+            path.len_sequence = sum(self.nodes[node_id].len_sequence for node_id in path.node_ids)
+
+    def add_abundances(self, path_id: int, starting_node_id: int, nodes_cov, batch_size=100000):
+        """
+        add the coverages of the nodes of a unique mapped read to a path, from its starting node.
+        Coverages are added to unique_mapped_abundances by batches of batch_size reads (see flush_abundances)
+        """
+        self.abundances_starts.append(self.paths_start[path_id]+starting_node_id)
+        self.abundances_counts.append(len(nodes_cov))
+        self.abundances_values.extend(nodes_cov)
+        if len(self.abundances_starts) >= batch_size:
+            self.flush_abundances()
+
+    def flush_abundances(self):
+        """
+        add the buffered coverages to unique_mapped_abundances. np.add.at adds them in order, as one by one additions would
+        """
+        if not self.abundances_starts:
+            return
+        starts = np.array(self.abundances_starts, dtype=np.int64)
+        counts = np.array(self.abundances_counts, dtype=np.int64)
+        # position of each node: concatenation of the ranges starts[i]:starts[i]+counts[i]
+        slots = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        np.add.at(self.unique_mapped_abundances, slots, np.array(self.abundances_values, dtype=float))
+        self.abundances_starts, self.abundances_counts, self.abundances_values = [], [], []
+
+    def add_duplicate_genes(self, path_id: int, gene_names):
+        """
+        genes with the same sequence as a gene of the path, not in the graph (see genes_prediction -u): their strains are counted as if
+        the graph had a P line for each of them
+        """
+        path = self.paths[path_id]
+        for gene_name in gene_names:
+            strain_id = self.add_strain(get_accession_number(gene_name))
+            self.species_names.add(self.strain_names[strain_id])
+            if strain_id not in path.strain_ids:
+                path.strain_ids[strain_id]=0
+            path.strain_ids[strain_id]+=1
+            self.paths_name_to_ids[gene_name] = path_id
+
+    def fill_pangenome(self, gfa_file_name: str, keep_node=None, duplicates=None):
         """
         PARSE GFA FILE
         From the gfa file, create a dictionary of the nodes and the paths in the graph.
         S lines contain node ID and its sequence
         P lines contain path ID, list of node ID with orientation and cover of the nodes
         L lines contain links between nodes (we dont care)
+        keep_node: optional function taking a node id. S lines for which it returns False are ignored, as well as the P lines
+        traversing these nodes (used to load only the nodes and paths of one shard, see get_nodes_shard).
+        duplicates: optional dictionary, key = path name, value = names of the genes with the same sequence (see clusters_index.get_duplicate_genes)
         """
         print("Load the pangenome graph")
         path_id = 0
-        cpt = 0     # For upgrade process
-        with open(gfa_file_name, 'r') as gfa_file:
-            size_file = file_size(gfa_file)
-            while True:
-                cpt+=1
-                line = gfa_file.readline()
-
-                # end of the file
-                if not line:
-                    break
-
-                current_seek    = gfa_file.tell() 
-                if cpt%10000 == 0: update_progress(current_seek/size_file)
-      
-                line = line.strip().split('\t')
-                # if line S, create node
-                if line[0] == 'S':
-                    # S       1       ACCACGATTACGCTGGCGCTTA
-                    self.nodes[int(line[1])] = Node(line[2]) 
-                # if line P, create paths and add paths infos in nodes
-                elif line[0] == 'P':
-                    # P       gi|1388876906|ref|NZ_CP028116.1|_1000   684619+,684620+,684618+ 187M,187M,1M 
-                    # path_id = line[1]
-
-                    str_node_list = canonical(line[2])
-                    strain_id = get_accession_number(line[1])
-                    # If this path was already seen, we simply add this strain_id to the path.strain_ids
-                    if str_node_list in self.paths_content_to_ids:
-                        already_seen_path_id = self.paths_content_to_ids[str_node_list]
-                        if strain_id not in self.paths[already_seen_path_id].strain_ids:
-                            self.paths[already_seen_path_id].strain_ids[strain_id]=0
-                        self.paths[already_seen_path_id].strain_ids[strain_id]+=1
-                        self.paths_name_to_ids[line[1]] = already_seen_path_id
-                        continue # nothing more to do, no incrementation of path_id, as no new path was created
-                    # if first time this path is seen
-                    self.species_names.add(strain_id)
-                    if strain_id not in self.hamming_freq: 
-                        self.hamming_freq[strain_id] = {}
-                    path = Path()
-                    if strain_id not in path.strain_ids:
-                        path.strain_ids[strain_id]=0
-                    path.strain_ids[strain_id]+=1
-                    node_list = str_node_list.split(',')
-                    # seq = ""
-                    for node_info in node_list:
-                        node_id = int(node_info[:-1])
-                        node = self.nodes[node_id]
-                        # add the current path id to the traversed paths of this node
-                        # we could have used a set for traversed_path, but this requires more memory
-                        if path_id not in node.traversed_path:
-                            node.traversed_path.append(path_id)
-
-                        path.node_ids.append(node_id)
-                        path.unique_mapped_abundances.append(0)
-                        path.multiple_mapped_abundances.append(0)
-                        # path.hamming_distance.append(0)
-                    # assert line[1] not in self.paths_name_to_ids # todo: remove when tested that this path ids has never been seen before
-
-                    self.paths.append(path)                                 # store this new path
-                    self.paths_name_to_ids[line[1]] = path_id
-                    self.paths_content_to_ids[str_node_list] = path_id
-                    path_id+=1
+        for record in iter_gfa(gfa_file_name):
+            # if line S, create node
+            if record[0] == 'S':
+                # S       1       ACCACGATTACGCTGGCGCTTA
+                if keep_node and not keep_node(record[1]):
+                    continue
+                self.nodes[record[1]] = Node(record[2])
+            # if line P, create paths and add paths infos in nodes
+            else:
+                # P       gi|1388876906|ref|NZ_CP028116.1|_1000   684619+,684620+,684618+ 187M,187M,1M 
+                _, path_name, walk = record
+                str_node_list = canonical(walk)
+                node_infos = str_node_list.split(',')
+                node_ids = [int(node_info[:-1]) for node_info in node_infos]
+                # nodes of a path are all in the same shard
+                if keep_node and node_ids[0] not in self.nodes:
+                    continue
+                orientations = ''.join(node_info[-1] for node_info in node_infos)
+                strain_id = self.add_strain(get_accession_number(path_name))
+                # If this path was already seen, we simply add this strain_id to the path.strain_ids
+                already_seen_path_id = self.get_path_id_from_content(str_node_list, node_ids, orientations)
+                if already_seen_path_id is not None:
+                    if strain_id not in self.paths[already_seen_path_id].strain_ids:
+                        self.paths[already_seen_path_id].strain_ids[strain_id]=0
+                    self.paths[already_seen_path_id].strain_ids[strain_id]+=1
+                    self.paths_name_to_ids[path_name] = already_seen_path_id
+                    if duplicates and path_name in duplicates:
+                        self.add_duplicate_genes(already_seen_path_id, duplicates[path_name])
+                    continue # nothing more to do, no incrementation of path_id, as no new path was created
+                # if first time this path is seen
+                self.species_names.add(self.strain_names[strain_id])
+                path = Path()
+                if strain_id not in path.strain_ids:
+                    path.strain_ids[strain_id]=0
+                path.strain_ids[strain_id]+=1
+                for node_id in node_ids:
+                    node = self.nodes[node_id]
+                    # add the current path id to the traversed paths of this node
+                    # we could have used a set for traversed_path, but this requires more memory
+                    if path_id not in node.traversed_path:
+                        node.traversed_path.append(path_id)
+                path.node_ids = node_ids
+
+                self.paths.append(path)                                 # store this new path
+                self.paths_orientations.append(orientations)
+                self.paths_name_to_ids[path_name] = path_id
+                content_hash = hash(str_node_list)
+                if content_hash in self.paths_content_to_ids:
+                    self.paths_content_collisions[str_node_list] = path_id
+                else:
+                    self.paths_content_to_ids[content_hash] = path_id
+                if duplicates and path_name in duplicates:
+                    self.add_duplicate_genes(path_id, duplicates[path_name])
+                path_id+=1
+        self.paths_orientations = []
+        self.init_abundances()
         update_progress(1)
 
-    def fill_cluster_id_for_each_path(self, pickle_file):
+    def get_path_id_from_content(self, str_node_list: str, node_ids, orientations: str):
         """
-        d_clusters: key = cluster id, value = list of colored paths id
+        returns the id of the already seen path with this content (canonical node list, its node ids and orientations), None if this content is new.
+        In case of hash collision, the node ids or orientations of the paths differ and the content is searched among collisions.
         """
-        d_clusters = pickle.load( open( pickle_file, "rb" ) ) 
-        # Cluster_1: ['gi|407479587|ref|NC_...58.1|_3137', 'gi|1447699251|ref|NC...95.2|_1209']
+        path_id = self.paths_content_to_ids.get(hash(str_node_list))
+        if path_id is None:
+            return None
+        if self.paths_orientations[path_id] == orientations and self.paths[path_id].node_ids == node_ids:
+            return path_id
+        return self.paths_content_collisions.get(str_node_list)
+
+    def fill_cluster_id_for_each_path(self, clusters_file):
+        """
+        clusters_file: clusters index (see clusters_index.py) or pickled dictionary of clusters
+        """
+        self.set_clusters_of_paths(iter_genes_clusters(clusters_file))
 
-        for cluster_id, cluster in d_clusters.items():
-            for path_name in cluster['genes_list']:
-                # skip if the cluster in the pickle has no matching to path in graph
-                if path_name not in self.paths_name_to_ids:
-                    continue
-                path_id = self.paths_name_to_ids[path_name]
-                # assert not self.paths[path_id].cluster_id   # should not already be defined. A path belongs to a unique cluser
-                self.paths[path_id].cluster_id = int(cluster_id.split("_")[-1])
+    def set_clusters_of_paths(self, genes_clusters):
+        """
+        genes_clusters: iterable of (path name, cluster id (int))
+        """
+        for path_name, cluster_id in genes_clusters:
+            # skip if the cluster in the index has no matching to path in graph
+            if path_name not in self.paths_name_to_ids:
+                continue
+            path_id = self.paths_name_to_ids[path_name]
+            # assert not self.paths[path_id].cluster_id   # should not already be defined. A path belongs to a unique cluser
+            self.paths[path_id].cluster_id = cluster_id
+        # path names are not needed anymore
+        self.paths_name_to_ids = {}
 
     def get_matching_path2(self, path_as_node_list):
         """
@@ -211,6 +368,8 @@ class Pangenome:
         
         result = [] # (path_id, corresponding starting node_id, number of nodes mapped)
         start_node = path_as_node_list[0]
+        if start_node not in self.nodes: # node of another shard
+            return result
         paths_sel = self.nodes[start_node].traversed_path
 
         # for each path crossing the start node
@@ -235,6 +394,8 @@ class Pangenome:
         
         result = [] # (path_id, corresponding starting node_id, number of nodes mapped)
         start_node = path_as_node_list[0]
+        if start_node not in self.nodes: # node of another shard
+            return result
 
         paths_sel = self.nodes[start_node].traversed_path
         # for each path crossing the start node
@@ -258,41 +419,141 @@ class Pangenome:
 
         return result
 
-    def print_error_distribution(self, distribution_file_name):
+    def add_strain(self, strain_id):
+        """
+        returns the int id of a strain. A new strain gets the next int id and a row of the error distribution
+        """
+        if strain_id not in self.strain_index:
+            self.strain_index[strain_id] = len(self.strain_names)
+            self.strain_names.append(strain_id)
+            self.hamming_freq = np.vstack((self.hamming_freq, np.zeros((1,self.hamming_freq.shape[1]), dtype=np.int64)))
+        return self.strain_index[strain_id]
+
+    def add_errors(self, path_id: int, nb_errors: int, nb_reads=1, batch_size=100000):
+        """
+        add nb_reads reads mapped with nb_errors errors to the error distribution of each strain of a path.
+        Errors are added to hamming_freq by batches of batch_size alignments (see flush_errors)
+        """
+        self.errors_path_ids.append(path_id)
+        self.errors_nb_errors.append(nb_errors)
+        self.errors_nb_reads.append(nb_reads)
+        if len(self.errors_path_ids) >= batch_size:
+            self.flush_errors()
+
+    def flush_errors(self):
+        """
+        add the buffered errors to hamming_freq, each alignment being repeated for each strain of its path
+        """
+        if not self.errors_path_ids:
+            return
+        if self.paths_strains is None:
+            paths_strains = [list(path.strain_ids) for path in self.paths]
+            self.paths_strains_start = np.cumsum([0]+[len(strains) for strains in paths_strains])
+            self.paths_strains = np.array([strain for strains in paths_strains for strain in strains], dtype=np.int64)
+        path_ids = np.array(self.errors_path_ids, dtype=np.int64)
+        nb_errors = np.array(self.errors_nb_errors, dtype=np.int64)
+        nb_reads = np.array(self.errors_nb_reads, dtype=np.int64)
+        self.errors_path_ids, self.errors_nb_errors, self.errors_nb_reads = [], [], []
+
+        if nb_errors.max() >= self.hamming_freq.shape[1]:
+            self.hamming_freq = np.hstack((self.hamming_freq, np.zeros((self.hamming_freq.shape[0], nb_errors.max()+1-self.hamming_freq.shape[1]), dtype=np.int64)))
+        # strains of each alignment path: concatenation of the ranges paths_strains_start[path_id]:paths_strains_start[path_id+1]
+        nb_strains = self.paths_strains_start[path_ids+1] - self.paths_strains_start[path_ids]
+        range_starts = np.repeat(self.paths_strains_start[path_ids] - np.cumsum(nb_strains) + nb_strains, nb_strains)
+        strains = self.paths_strains[range_starts + np.arange(nb_strains.sum())]
+        cells = strains*self.hamming_freq.shape[1] + np.repeat(nb_errors, nb_strains)
+        self.hamming_freq += np.bincount(cells, weights=np.repeat(nb_reads, nb_strains), minlength=self.hamming_freq.size).astype(np.int64).reshape(self.hamming_freq.shape)
+
+    def get_error_distribution(self):
+        """
+        returns the strain ids (ordered as the rows) and the error distribution matrix
+        """
+        self.flush_errors()
+        return list(self.strain_names), self.hamming_freq
+
+    def add_error_distribution(self, strain_ids, hamming_freq):
+        """
+        add an error distribution computed elsewhere (eg on a shard or a chunk of reads), rows being strain_ids
+        """
+        self.flush_errors()
+        for strain_id in strain_ids:
+            self.add_strain(strain_id)
+        if hamming_freq.shape[1] > self.hamming_freq.shape[1]:
+            self.hamming_freq = np.hstack((self.hamming_freq, np.zeros((self.hamming_freq.shape[0], hamming_freq.shape[1]-self.hamming_freq.shape[1]), dtype=np.int64)))
+        rows = [self.strain_index[strain_id] for strain_id in strain_ids]
+        self.hamming_freq[rows, :hamming_freq.shape[1]] += hamming_freq
+
+    def print_error_distribution(self, distribution_file_name, binary=False):
+        """
+        for each strain, number of mapped reads for each number of errors, up to the maximal number of errors of the strain.
+        If binary, the strain ids and the matrix are also saved in numpy format (distribution_file_name.npz)
+        """
         print(f"Print distribution results to file {distribution_file_name}")
+        strain_ids, hamming_freq = self.get_error_distribution()
+        block = []
+        for strain_id, dist in zip(strain_ids, hamming_freq.tolist()):
+            block.append(f"Strain {strain_id}\n")
+            # get the maximal value
+            max_err = max((nb_err for nb_err, nb_reads in enumerate(dist) if nb_reads > 0), default=-1)
+            block.extend(f"{nb_err}: {dist[nb_err]}\n" for nb_err in range(max_err+1))
         with open(distribution_file_name, "w") as distribution_file:
+            distribution_file.write("".join(block))
+        if binary:
+            np.savez_compressed(distribution_file_name+".npz", strain_ids=np.array(strain_ids), hamming_freq=hamming_freq)
 
-            for strain_id, dist in self.hamming_freq.items():
-                distribution_file.write(f"Strain {strain_id}\n")
-                # get the maximal value: (we need this as the `dist` dictionary is not ordered)
-                max_err=-1
-                for err in dist:
-                    if max_err<err: max_err=err
-                for nb_err in range(max_err+1):
-                    if nb_err in dist: 
-                        distribution_file.write(f"{nb_err}: {dist[nb_err]}\n")
-                    else: 
-                        distribution_file.write(f"{nb_err}: 0\n")
-                
+    def get_node_coverage(self):
+        """
+        non zero node coverages of the paths: 
+        paths_index (entries of path i are paths_index[i]:paths_index[i+1], paths in the order of the csv),
+        node_offsets (position of the node in its path), unique_mapped and multiple_mapped abundances of the node (float32)
+        """
+        self.flush_abundances()
+        positions = np.flatnonzero((self.unique_mapped_abundances > 0) | (self.multiple_mapped_abundances > 0))
+        paths_index = np.searchsorted(positions, self.paths_start)
+        paths = np.repeat(np.arange(len(self.paths)), np.diff(paths_index))
+        return {
+            "paths_index": paths_index.astype(np.int64),
+            "node_offsets": (positions - self.paths_start[paths]).astype(np.uint32),
+            "unique_mapped": self.unique_mapped_abundances[positions].astype(np.float32),
+            "multiple_mapped": self.multiple_mapped_abundances[positions].astype(np.float32),
+        }
+
+    def print_node_coverage(self, node_coverage_file_name):
+        """
+        save the non zero node coverages of the paths (see get_node_coverage) in numpy compressed format
+        """
+        print(f"Print node coverages to file {node_coverage_file_name}")
+        np.savez_compressed(node_coverage_file_name, **self.get_node_coverage())
 
-    def print_to_csv(self, csv_file_name):
-        print(f"Print results to file {csv_file_name}")
-        cvs_file = open(csv_file_name, "w")
+    def print_to_csv(self, csv_file_name, species_names=None, print_header=True):
+        """
+        csv_file_name: file name, or an open file (eg. io.StringIO, left open, no progress bar)
+        species_names: ordered species columns to print (default: the species of this pangenome).
+        Shards of a same pangenome use the same species_names and no header so that their outputs can be concatenated.
+        """
+        to_file = isinstance(csv_file_name, str)
+        if to_file:
+            print(f"Print results to file {csv_file_name}")
+            cvs_file = open(csv_file_name, "w")
+        else:
+            cvs_file = csv_file_name
+        if species_names is None:
+            species_names = self.species_names
+        self.flush_abundances()
         presence_species = {} # id: species name (eg NZ_CP028116.1), value = bool present absent
-        for species_name in self.species_names:
+        for species_name in species_names:
             presence_species[species_name] = False
-        for species_name in presence_species:
-            cvs_file.write(f"{species_name};")
-        cvs_file.write(f"hamming;cluster;seq_len;nb_uniq_mapped;nb_uniq_mapped_normalized;nb_multimapped;nb_multimapped_normalized;mean_abund_uniq;mean_abund_uniq_nz;mean_abund_multiple;mean_abund_multiple_nz;ratio_covered_nodes\n")
+        if print_header:
+            write_csv_header(cvs_file, presence_species)
         
         for i,path in enumerate(self.paths):
-            if i%1000==0: 
+            if to_file and i%1000==0: 
                 update_progress(i/len(self.paths))
             #reset species:
             presence_species = dict.fromkeys(presence_species,0)
             for strain_id,nb_occ in path.strain_ids.items():
                 # gene id: gi|1388876906|ref|NZ_CP028116.1|_1
-                presence_species[strain_id] = nb_occ
+                presence_species[self.strain_names[strain_id]] = nb_occ
             #genes
             for _,nb_occ in presence_species.items():cvs_file.write(f"{nb_occ};")
             
@@ -332,28 +593,28 @@ class Pangenome:
             cvs_file.write(f"{path.total_mapped_unique_reads_normalized+path.total_mapped_mult_reads_normalized};")
 
             #mean_abund_uniq
-            cvs_file.write(f"{np.mean([mapped_abundance for mapped_abundance in path.unique_mapped_abundances])};")
+            unique_mapped_abundances = path.unique_mapped_abundances
+            cvs_file.write(f"{np.mean(unique_mapped_abundances)};")
             
             #mean_abund_uniq_nz
-            cvs_file.write(f"{np.mean([mapped_abundance for mapped_abundance in path.unique_mapped_abundances if mapped_abundance > 0])};")
+            cvs_file.write(f"{np.mean(unique_mapped_abundances[unique_mapped_abundances > 0])};")
 
             #mean_abund_multiple
-            cvs_file.write(f"{np.mean([mapped_abundance for mapped_abundance in map(sum,zip(path.unique_mapped_abundances,path.multiple_mapped_abundances))])};")
+            mapped_abundances = unique_mapped_abundances + path.multiple_mapped_abundances
+            cvs_file.write(f"{np.mean(mapped_abundances)};")
             
             #mean_abund_multiple_nz
-            cvs_file.write(f"{np.mean([mapped_abundance for mapped_abundance in map(sum,zip(path.unique_mapped_abundances,path.multiple_mapped_abundances)) if mapped_abundance > 0])};")
+            cvs_file.write(f"{np.mean(mapped_abundances[mapped_abundances > 0])};")
 
             # ratio of covered nodes
-            nb_covered_nodes = 0 # for printing the ratio of covered nodes
-            for i in range(len(path.unique_mapped_abundances)):
-                if path.unique_mapped_abundances[i]>0 or path.multiple_mapped_abundances[i]>0:
-                    nb_covered_nodes+=1
-            cvs_file.write(f"{nb_covered_nodes/float(len(path.unique_mapped_abundances))}")
+            nb_covered_nodes = np.count_nonzero((unique_mapped_abundances > 0) | (path.multiple_mapped_abundances > 0)) # for printing the ratio of covered nodes
+            cvs_file.write(f"{nb_covered_nodes/float(len(unique_mapped_abundances))}")
 
             #end path
             cvs_file.write("\n")
-        cvs_file.close()
-        update_progress(1)
+        if to_file:
+            cvs_file.close()
+            update_progress(1)
         
 
             
@@ -479,10 +740,13 @@ def BFS(aln, pangenome: Pangenome):
                 for node in subpath[ subpath_node ]['path']['mapping']: # for each node get abundance
                     nodeID = int(node['position']['node_id'])
                     abund = 0
-                    for edit in node["edit"]:
-                        from_len = int(edit.get("from_length", 0))
-                        to_len = int(edit.get("to_length", 0))
-                        abund += min(from_len,to_len)/pangenome.nodes[nodeID].len_sequence
+                    # nodes of the other shards are not loaded, an alignment on them matches no path of this shard
+                    if nodeID in pangenome.nodes:
+                        len_sequence = pangenome.nodes[nodeID].len_sequence
+                        for edit in node["edit"]:
+                            from_len = int(edit.get("from_length", 0))
+                            to_len = int(edit.get("to_length", 0))
+                            abund += min(from_len,to_len)/len_sequence
                     # if node already exists in the list, just add the abundance
                     current_node_list = [n[0] for n in alignment.mapped_node_ids_cov]
                     if nodeID in current_node_list:
@@ -497,41 +761,56 @@ def BFS(aln, pangenome: Pangenome):
             final_paths.append(alignment)
     return final_paths
 
-def get_all_alignments_one_read(json_file, pangenome: Pangenome, thr=0.95):
+mpmap_sequence_regex = re.compile(r'^\{"sequence":\s*"([^"]*)"')  # vg outputs the read sequence as first field
+mpmap_node_id_regex = re.compile(r'"node_id":\s*"?([0-9]+)')
+
+def get_read_sequence(line: str):
+    """ 
+    returns the read sequence of a json line, without decoding the whole line if possible
+    """
+    match = mpmap_sequence_regex.match(line)
+    if match:
+        return match.group(1)
+    return json.loads(line)['sequence']
+
+def open_mapping_file(json_file_name: str):
+    """
+    opens the mapping file, "-" for the standard input (eg. vg mpmap ... | vg view -j -K - | json2csv -m - ...)
+    """
+    if json_file_name == "-":
+        return open(sys.stdin.fileno(), 'r', closefd=False)
+    return open(json_file_name, 'r')
+
+def iter_read_groups(json_file):
+    """
+    yields the lines of each read: a read may occur on several successive lines.
+    Lines are read once, in order, the mapping file may be a pipe.
+    All the lines of a read are accounted together, once (they used to be reprocessed as new reads by the second pass)
+    """
+    read_group = []
+    read_sequence = None
+    for line in json_file:
+        sequence = get_read_sequence(line)
+        if sequence != read_sequence and read_group:
+            yield read_group
+            read_group = []
+        read_sequence = sequence
+        read_group.append(line)
+    if read_group:
+        yield read_group
+
+def get_all_alignments_one_read(read_lines, pangenome: Pangenome, thr=0.95):
     """ 
-    given a first read line, returns all alignemnts correponding to this read.
+    given the lines of a read (see iter_read_groups), returns all alignemnts correponding to this read.
     Sometimes a read may occur on several successive lines, hence we concatenate the 
     corresponding alignments
     """
-    line = json_file.readline()
-
-    # End of file EOF
-    if not line:
-        return None, None 
-    
-    aln = json.loads(line)
-    starting_read = aln['sequence']
+    starting_read = None
     mapped_paths = []
-    # parse only if the read has mapped
-    if "subpath" in aln: 
-        # get best path(s) for the alignement
-        current_mapped_paths = BFS(aln, pangenome) # needs pangenome only for getting node lengths
-        # final_paths is a list of Alignments [Alignments]
-
-        # store the mapped paths if the score is higher or equal to the threshold
-        if  current_mapped_paths[0].score/len(starting_read) >= thr: 
-            mapped_paths = current_mapped_paths
-
-    while True:
-        next_line_to_read_when_leaving_this_function = json_file.tell() 
-        line = json_file.readline()
-        if not line: 
-            json_file.seek(next_line_to_read_when_leaving_this_function)
-            break
+    for line in read_lines:
         aln = json.loads(line)
-        if aln['sequence'] != starting_read:
-            json_file.seek(next_line_to_read_when_leaving_this_function)
-            break
+        if starting_read is None:
+            starting_read = aln['sequence']
         # parse only if the read has mapped
         if "subpath" in aln: 
             # get best path(s) for the alignement
@@ -552,7 +831,110 @@ def get_all_alignments_one_read(json_file, pangenome: Pangenome, thr=0.95):
 
 
 
-def parse_vgmpmap(json_file_name:str, pangenome: Pangenome, thr=0.95):
+def match_gene_paths(pangenome: Pangenome, aligned_path_as_nodes):
+    """
+    returns the list of (path_id, starting node index) of the paths matching a list of node ids, in both orientations
+    """
+    found_gene_paths = pangenome.get_matching_path(aligned_path_as_nodes) 
+    # don't duplicate the result if the path has only one node
+    if len(aligned_path_as_nodes) > 1:
+        found_gene_paths += pangenome.get_matching_path(aligned_path_as_nodes[::-1])
+    return found_gene_paths
+
+def get_found_gene_paths(pangenome: Pangenome, aligned_path: Alignment):
+    """
+    returns the list of (path_id, starting node index) of the paths matching an alignment, in both orientations.
+    Reads of a same region often share the same walk in the graph: paths matching a walk are cached
+    """
+    aligned_path_as_nodes = tuple(n[0] for n in aligned_path.mapped_node_ids_cov)
+    found_gene_paths = pangenome.found_gene_paths_cache.get(aligned_path_as_nodes)
+    if found_gene_paths is None:
+        if len(pangenome.found_gene_paths_cache) >= pangenome.found_gene_paths_cache_size:
+            pangenome.found_gene_paths_cache.clear()
+        found_gene_paths = tuple(match_gene_paths(pangenome, aligned_path_as_nodes))
+        pangenome.found_gene_paths_cache[aligned_path_as_nodes] = found_gene_paths
+    return list(found_gene_paths)
+
+def resolve_alignments(pangenome: Pangenome, mapped_paths):
+    """
+    returns for each alignment of a read: (found gene paths, coverage of each mapped node, number of errors)
+    """
+    return [(get_found_gene_paths(pangenome, aligned_path), [n[1] for n in aligned_path.mapped_node_ids_cov], aligned_path.nb_errors) for aligned_path in mapped_paths]
+
+def add_mapped_read(pangenome: Pangenome, resolved_alignments, read_len: int, multi_mapped_reads):
+    """
+    First pass accounting of a read given its best alignments (see resolve_alignments).
+    A read with a unique alignment matching a unique path is counted on this path. 
+    Other reads are stored for the second pass.
+    """
+    if len(resolved_alignments) > 1: 
+        store_multi_mapped_read(pangenome, resolved_alignments, read_len, multi_mapped_reads)
+        return # Here we deal only with reads mapping exactly one path
+
+    found_gene_paths, nodes_cov, nb_errors = resolved_alignments[0]  # for clarity
+    # we may have several paths corresponding to a unique alignment
+    if len(found_gene_paths) > 1: 
+        store_multi_mapped_read(pangenome, resolved_alignments, read_len, multi_mapped_reads)
+        return
+    
+    for path_id, starting_node_id in found_gene_paths:
+        path = pangenome.paths[path_id]
+        path.total_mapped_unique_reads += 1
+        path.total_mapped_unique_reads_normalized += read_len/path.len_sequence
+        # Le comptage unique "normalisé" par chemin (incrémentation de (longueur du read)/(longueur du chemin))
+        pangenome.add_abundances(path_id, starting_node_id, nodes_cov)
+
+        # update the number of mapping errors for this path
+        pangenome.add_errors(path_id, nb_errors)
+
+def store_multi_mapped_read(pangenome: Pangenome, resolved_alignments, read_len: int, multi_mapped_reads):
+    """
+    First pass accounting of a read mapping several paths. 
+    Its alignments are collapsed into equivalence classes of alignments sharing the same found gene paths 
+    (with their starting nodes) and number of mapped nodes, hence the same walk on each path:
+    key = (found gene paths, number of mapped nodes), value = [number of reads, summed read lengths, summed node coverages (numpy array)]
+    The distribution of the class on its paths is done once in the second pass (see add_multi_mapped_reads).
+    The number of mapping errors does not depend on this distribution, it is updated here.
+    """
+    for found_gene_paths, nodes_cov, nb_errors in resolved_alignments:
+        if not found_gene_paths:
+            continue
+        key = (tuple(found_gene_paths), len(nodes_cov))
+        if key not in multi_mapped_reads:
+            multi_mapped_reads[key] = [0, 0, np.zeros(key[1])]
+        equivalence_class = multi_mapped_reads[key]
+        equivalence_class[0] += 1
+        equivalence_class[1] += read_len
+        equivalence_class[2] += nodes_cov
+
+        # update the number of mapping errors for the found paths
+        for found_gene_path in found_gene_paths:
+            pangenome.add_errors(found_gene_path[0], nb_errors)
+
+def add_multi_mapped_reads(pangenome: Pangenome, multi_mapped_reads):
+    """
+    Second pass accounting of the equivalence classes of multi mapped alignments (see store_multi_mapped_read).
+    Uses the total_mapped_unique_reads of the paths, that must be final.
+    """
+    total_mapped_unique_reads = np.array([path.total_mapped_unique_reads for path in pangenome.paths], dtype=float)
+    for (found_gene_paths, nb_mapped_nodes), (nb_reads, sum_read_len, sum_nodes_cov) in multi_mapped_reads.items():
+        path_ids = [found_gene_path[0] for found_gene_path in found_gene_paths]
+        # compute a+b+c (cf parse_vgmpmap comments)
+        covered_paths = total_mapped_unique_reads[path_ids]
+        sum_covered_paths = covered_paths.sum() # TODO: valider avec Kevin ce +1 (en cas de tout à zero)
+        if sum_covered_paths == 0: # if no unique mapped reads, equal repartition to the strains
+            ratios = np.full(len(path_ids), 1/len(path_ids))
+        else:
+            ratios = covered_paths/sum_covered_paths
+        
+        # fill corresponding nodes normalized abundances (a/(a+b+c) cf parse_vgmpmap comments
+        for (path_id, starting_node_id), ratio in zip(found_gene_paths, ratios.tolist()):
+            path = pangenome.paths[path_id]
+            path.total_mapped_mult_reads += ratio*nb_reads # TODO: valider avec Kevin
+            path.total_mapped_mult_reads_normalized += ratio*sum_read_len/path.len_sequence
+            path.multiple_mapped_abundances[starting_node_id:starting_node_id+nb_mapped_nodes] += sum_nodes_cov*ratio
+
+def parse_vgmpmap(json_file_name:str, pangenome: Pangenome, thr=0.95, multi_mapped_reads=None, summary_file_name=None, read_groups=None):
     
     """
     PARSE MAPPING JSON FILE
@@ -563,158 +945,740 @@ def parse_vgmpmap(json_file_name:str, pangenome: Pangenome, thr=0.95):
     score = scoring done by vg considering bonus for matches and penalty for mismatches and gap
     identity = Portion of aligned bases that are perfect matches, or 0 if no bases are aligned.
     errors = nb of non aligned bases
+
+    multi_mapped_reads: if a dictionary is given, the first pass stores in it the alignments of reads that map 
+    several paths (see store_multi_mapped_read) and the second pass is not done.
+    summary_file_name: if given, the best alignments of all reads, whatever their score, are stored in this 
+    file (see ReadsSummaryWriter), so that the results can be computed for other thresholds without parsing the json again.
+    read_groups: if given, iterable of the lines of each read (see iter_read_groups) parsed instead of the mapping file (eg. reads routed to a shard)
     """
-    
-    # Optimization: we detect positions in the file of reads with unique mapping. Thus they are not tested twice
-    do_not_recompute_line = set()
+    redistribute_multi_mapped_reads = multi_mapped_reads is None
+    if redistribute_multi_mapped_reads:
+        multi_mapped_reads = {}
     
     # DO TWICE THE JOB: Once for detecting the abundance of unique mapped reads 
     # FIRST PASS/ 
     # For each read that maps uniquely: fill the abundance of 
     #  1/ each node of the mapped path (extremities are increased <= 1 for each mapped read)
     #  2/ store the abundance of each path simply in term of fully mapped reads 
+    # Alignments of reads that map several paths are stored in equivalence classes for the second pass
     print("Parsing Alignment: first pass")
     steps = 0
-    with open(json_file_name, 'r') as json_file:
-        size_file = file_size(json_file)
-        while True:
-            steps += 1
-            current_seek = json_file.tell() 
-            if steps%1000 == 0: 
-                update_progress(current_seek/size_file)
-            mapped_paths, aligned_read = get_all_alignments_one_read(json_file, pangenome, thr)
-            
-            # end of file
-            if mapped_paths == None:
-                break
-
-            if len(mapped_paths) == 0: 
-                do_not_recompute_line.add(current_seek)
-                continue # no path found
-
-            if len(mapped_paths) > 1: 
-                continue # Here we deal only with reads mapping exactly one path
-
-            aligned_path = mapped_paths[0]  # for clarity
-            aligned_path_as_nodes = [n[0] for n in aligned_path.mapped_node_ids_cov]
-            found_gene_paths = pangenome.get_matching_path(aligned_path_as_nodes) 
-            # don't duplicate the result if the path has only one node
-            if len(aligned_path_as_nodes) > 1:
-                found_gene_paths += pangenome.get_matching_path(aligned_path_as_nodes[::-1])
-            # we may have several paths corresponding to a unique alignment
-            if len(found_gene_paths) > 1: 
+    summary = None
+    if summary_file_name:
+        summary = ReadsSummaryWriter(summary_file_name, pangenome)
+        summary_thr = thr
+        thr = float("-inf") # all reads are resolved in the summary, whatever their score
+    # reads of the mapping file, or given read groups
+    json_file = open_mapping_file(json_file_name) if read_groups is None else None
+    size_file = file_size(json_file) if json_file else 0
+    for read_lines in (iter_read_groups(json_file) if json_file else read_groups):
+        steps += 1
+        if steps%1000 == 0:
+            if size_file:
+                update_progress(json_file.buffer.tell()/size_file)
+            if profile:
+                profile.report_throughput()
+        mapped_paths, aligned_read = get_all_alignments_one_read(read_lines, pangenome, thr)
+
+        if len(mapped_paths) == 0: 
+            continue # no path found
+
+        resolved_alignments = resolve_alignments(pangenome, mapped_paths)
+        if summary:
+            best_score = mapped_paths[0].score/len(aligned_read)
+            summary.add(best_score, len(aligned_read), resolved_alignments)
+            if best_score < summary_thr:
                 continue
-            
-            do_not_recompute_line.add(current_seek) # we will not recompute those alignments during the second pass
-            for found_gene_path in found_gene_paths:
-                path_id = found_gene_path[0]
-                starting_node_id = found_gene_path[1]
-                nb_mapped_nodes = len(aligned_path.mapped_node_ids_cov)
-                path = pangenome.paths[path_id]
-                path.total_mapped_unique_reads += 1
-                path.total_mapped_unique_reads_normalized += len(aligned_read)/pangenome.get_sequence_length(path)
-                # Le comptage unique "normalisé" par chemin (incrémentation de (longueur du read)/(longueur du chemin))
-                for i in range(nb_mapped_nodes):
-                    path.unique_mapped_abundances[starting_node_id+i]+=aligned_path.mapped_node_ids_cov[i][1] 
-
-                # update the number of mapping errors for this path
-                for strain_id in path.strain_ids: 
-                    #if strain_id not in pangenome.hamming_freq: pangenome.hamming_freq[strain_id] = {}
-                    if aligned_path.nb_errors not in pangenome.hamming_freq[strain_id]:
-                        pangenome.hamming_freq[strain_id][aligned_path.nb_errors] = 0 
-                    pangenome.hamming_freq[strain_id][aligned_path.nb_errors]+=1
+        add_mapped_read(pangenome, resolved_alignments, len(aligned_read), multi_mapped_reads)
+    if json_file:
+        json_file.close()
     update_progress(1)
+    if summary:
+        summary.close()
 
-
+    if not redistribute_multi_mapped_reads:
+        return
 
     # DO TWICE THE JOB: Once for detecting the abundance of unique mapped reads 
     # Once for dealing with multimapped reads
     # SECOND PASS/ 
-    # For each read that maps on several paths
+    # For each equivalence class of alignments of reads that map on several paths
     # detect the total_mapped_unique_reads of each of the mapped paths
     # This provides an abundance a,b,c eg for 3 mapped paths respectively A, B, C. 
     # For path 'A', add in each node A.multiple_mapped_abundances[node] a/(a+b+c)
     # For path 'B', add in each node B.multiple_mapped_abundances[node] b/(a+b+c)
     # For path 'C', add in each node C.multiple_mapped_abundances[node] c/(a+b+c)
+    print(f"Parsing Alignment: second pass ({len(multi_mapped_reads)} classes of multi mapped alignments)")
+    add_multi_mapped_reads(pangenome, multi_mapped_reads)
+
+
+# READS SUMMARY
+# The json parsing (BFS and path matching) does not depend on the alignment score threshold, except for discarding 
+# reads. The summary stores for each mapped read its best normalized score, its length and its resolved best 
+# alignments. Results for any threshold are then computed from the summary without decoding the json again.
+
+class ReadsSummaryWriter:
+    def __init__(self, summary_file_name: str, pangenome: Pangenome, batch_size=10000):
+        """
+        reads are pickled by batches of batch_size reads, after a header with the number of paths of the graph
+        """
+        self.summary_file = open(summary_file_name, "wb")
+        self.batch_size = batch_size
+        self.batch = []
+        pickle.dump({'nb_paths': len(pangenome.paths)}, self.summary_file, protocol=pickle.HIGHEST_PROTOCOL)
     
-    steps = 0
-    print("Parsing Alignment: second pass")
-    with open(json_file_name, 'r') as json_file:
-        size_file = file_size(json_file)
+    def add(self, best_score: float, read_len: int, resolved_alignments):
+        self.batch.append((best_score, read_len, [(tuple(found_gene_paths), tuple(nodes_cov), nb_errors) for found_gene_paths, nodes_cov, nb_errors in resolved_alignments]))
+        if len(self.batch) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pickle.dump(self.batch, self.summary_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.batch = []
+
+    def close(self):
+        if self.batch:
+            self.flush()
+        self.summary_file.close()
+
+def parse_reads_summary(summary_file_name: str, pangenome: Pangenome, thr=0.95, multi_mapped_reads=None):
+    """
+    same as parse_vgmpmap, from a reads summary
+    """
+    redistribute_multi_mapped_reads = multi_mapped_reads is None
+    if redistribute_multi_mapped_reads:
+        multi_mapped_reads = {}
+
+    print(f"Parsing Alignment summary (threshold {thr}): first pass")
+    with open(summary_file_name, "rb") as summary_file:
+        size_file = file_size(summary_file)
+        header = pickle.load(summary_file)
+        if header['nb_paths'] != len(pangenome.paths):
+            sys.exit(f"{summary_file_name} was not computed with this graph ({header['nb_paths']} paths instead of {len(pangenome.paths)})")
         while True:
-            steps += 1
-            current_seek = json_file.tell() 
-            if steps%1000==0: update_progress(current_seek/size_file)
-            if current_seek in do_not_recompute_line: 
-                json_file.readline() # dont care
-                continue
-            mapped_paths, aligned_read = get_all_alignments_one_read(json_file, pangenome, thr)
-            
-            # end of file
-            if mapped_paths == None:
+            try:
+                batch = pickle.load(summary_file)
+            except EOFError:
                 break
+            update_progress(summary_file.tell()/size_file)
+            for best_score, read_len, resolved_alignments in batch:
+                if best_score >= thr:
+                    add_mapped_read(pangenome, resolved_alignments, read_len, multi_mapped_reads)
+    update_progress(1)
 
-            # we retreive the paths corresponding to this alignments:
-            for aligned_path in mapped_paths:
-                aligned_path_as_nodes = [n[0] for n in aligned_path.mapped_node_ids_cov]
-                found_gene_paths = pangenome.get_matching_path(aligned_path_as_nodes) 
-                # don't duplicate the result if the path has only one node
-                if len(aligned_path_as_nodes) > 1:
-                    found_gene_paths += pangenome.get_matching_path(aligned_path_as_nodes[::-1]) 
-                
-                # compute a+b+c (cf earlier comments)
-                sum_covered_paths = 0
-                for found_gene_path in found_gene_paths:
-                    path_id = found_gene_path[0]
-                    path = pangenome.paths[path_id]
-                    sum_covered_paths += path.total_mapped_unique_reads # TODO: valider avec Kevin ce +1 (en cas de tout à zero)
-                
-                    # update the number of mapping errors for this path
-                    for strain_id in path.strain_ids: 
-                        #if strain_id not in pangenome.hamming_freq: pangenome.hamming_freq[strain_id] = {}
-                        if aligned_path.nb_errors not in pangenome.hamming_freq[strain_id]:
-                            pangenome.hamming_freq[strain_id][aligned_path.nb_errors] = 0
-                        pangenome.hamming_freq[strain_id][aligned_path.nb_errors]+=1
-
-
-                # fill corresponding nodes normalized abundances (a/(a+b+c) cf earlier comments
-                for found_gene_path in found_gene_paths:
-                    path_id = found_gene_path[0]
-                    starting_node_id = found_gene_path[1]
-                    nb_mapped_nodes = len(aligned_path.mapped_node_ids_cov)
-                    path = pangenome.paths[path_id]
-                    if sum_covered_paths == 0: # if no unique mapped reads, equal repartition to the strains
-                        ratio = 1/len(found_gene_paths)
-                    else:
-                        ratio = (path.total_mapped_unique_reads)/float(sum_covered_paths)# TODO: valider avec Kevin ce +1 (en cas de tout à zero)
-                    path.total_mapped_mult_reads += ratio # TODO: valider avec Kevin
-                    path.total_mapped_mult_reads_normalized += ratio*len(aligned_read)/pangenome.get_sequence_length(path)
-                    for i in range(nb_mapped_nodes):
-                        path.multiple_mapped_abundances[starting_node_id+i]+=aligned_path.mapped_node_ids_cov[i][1]*ratio
-                    
-                
-                
+    if not redistribute_multi_mapped_reads:
+        return
+
+    print(f"Parsing Alignment summary: second pass ({len(multi_mapped_reads)} classes of multi mapped alignments)")
+    add_multi_mapped_reads(pangenome, multi_mapped_reads)
+
+
+# PARTIAL RESULTS
+# A sample split in several chunks of reads (eg mapped on distinct nodes) is processed chunk by chunk: json2csv -d
+# dumps for each chunk the unique mapped accounting of the paths, the error distribution and the equivalence 
+# classes of the multi mapped alignments. json2csv merge sums the states and does the second pass once, with the global 
+# total_mapped_unique_reads of the paths.
+
+def dump_state(pangenome: Pangenome, multi_mapped_reads, state_file_name: str):
+    """
+    pickle the unique mapped accounting of the paths (only paths with mapped reads), the error distribution 
+    and the equivalence classes of multi mapped alignments
+    """
+    print(f"Print partial results to file {state_file_name}")
+    pangenome.flush_abundances()
+    unique_mapped = {}
+    for path_id, path in enumerate(pangenome.paths):
+        if path.total_mapped_unique_reads > 0:
+            unique_mapped[path_id] = (path.total_mapped_unique_reads, path.total_mapped_unique_reads_normalized, path.unique_mapped_abundances)
+    state = {
+        'nb_paths': len(pangenome.paths),
+        'unique_mapped': unique_mapped,
+        'hamming_freq': pangenome.get_error_distribution(),
+        'multi_mapped_reads': multi_mapped_reads
+    }
+    with open(state_file_name, "wb") as state_file:
+        pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_states(pangenome: Pangenome, state_file_names):
+    """
+    sum the partial results of several chunks in the pangenome.
+    Returns the merged multi mapped alignments
+    """
+    multi_mapped_reads = {}
+    for state_file_name in state_file_names:
+        print(f"Load partial results {state_file_name}")
+        with open(state_file_name, "rb") as state_file:
+            state = pickle.load(state_file)
+        if state['nb_paths'] != len(pangenome.paths):
+            sys.exit(f"{state_file_name} was not computed with this graph ({state['nb_paths']} paths instead of {len(pangenome.paths)})")
+        for path_id, (nb_reads, nb_reads_normalized, abundances) in state['unique_mapped'].items():
+            path = pangenome.paths[path_id]
+            path.total_mapped_unique_reads += nb_reads
+            path.total_mapped_unique_reads_normalized += nb_reads_normalized
+            path.unique_mapped_abundances += abundances
+        pangenome.add_error_distribution(*state['hamming_freq'])
+        for key, (nb_reads, sum_read_len, sum_nodes_cov) in state['multi_mapped_reads'].items():
+            if key not in multi_mapped_reads:
+                multi_mapped_reads[key] = [0, 0, np.zeros(key[1])]
+            equivalence_class = multi_mapped_reads[key]
+            equivalence_class[0] += nb_reads
+            equivalence_class[1] += sum_read_len
+            equivalence_class[2] += sum_nodes_cov
+    return multi_mapped_reads
+
+
+
+
+# CLUSTER-SHARDED QUERY
+# A read maps on a single cluster graph, hence the accounting of parse_vgmpmap is partitioned by cluster.
+# Clusters are distributed in nb_shards shards (cluster id modulo nb_shards). Each shard is processed by a worker
+# holding only the nodes and paths of its clusters (and their clusters and duplicates). The read groups of the mapping
+# file are routed to the workers through queues while they are parsed. A read group mapping several shards is routed 
+# to each of them, each shard counting only its own paths.
+
+def get_clusters_of_paths(clusters_file):
+    """
+    returns a dictionary: key = path name, value = cluster id (int)
+    """
+    return dict(iter_genes_clusters(clusters_file))
+
+def get_shard(cluster_id, nb_shards: int):
+    """ 
+    paths without cluster are all stored in the first shard 
+    """
+    if cluster_id is None:
+        return 0
+    return cluster_id % nb_shards
+
+def get_nodes_shard(gfa_file_name: str, path_to_cluster, nb_shards: int, duplicates=None):
+    """
+    PARSE GFA FILE (P lines only)
+    returns a numpy array: index = node id, value = shard of the node (-1 if the node is traversed by no path),
+    and the list of species names ordered by first occurrence (including the strains of the duplicates of the paths)
+    """
+    nodes_shard = np.full(1024, -1, dtype=np.int32)
+    species_names = {}  # ordered set
+    for record in iter_gfa(gfa_file_name, progress=False):
+        if record[0] != 'P':
+            continue
+        _, path_name, walk = record
+        species_names[get_accession_number(path_name)] = None
+        if duplicates and path_name in duplicates:
+            for gene_name in duplicates[path_name]:
+                species_names[get_accession_number(gene_name)] = None
+        shard = get_shard(path_to_cluster.get(path_name), nb_shards)
+        node_ids = [int(node_info[:-1]) for node_info in walk.split(',')]
+        max_node_id = max(node_ids)
+        if max_node_id >= len(nodes_shard):
+            nodes_shard = np.concatenate((nodes_shard, np.full(max(max_node_id+1, 2*len(nodes_shard)) - len(nodes_shard), -1, dtype=np.int32)))
+        nodes_shard[node_ids] = shard
+    return nodes_shard, list(species_names)
+
+def split_by_shard(path_to_cluster, duplicates, nb_shards: int):
+    """
+    returns the clusters of the paths (see get_clusters_of_paths) and the duplicates (see get_duplicate_genes) of each shard
+    """
+    shards_path_to_cluster = [{} for _ in range(nb_shards)]
+    shards_duplicates = [{} for _ in range(nb_shards)]
+    for path_name, cluster_id in path_to_cluster.items():
+        shards_path_to_cluster[get_shard(cluster_id, nb_shards)][path_name] = cluster_id
+    for path_name, gene_names in duplicates.items():
+        shards_duplicates[get_shard(path_to_cluster.get(path_name), nb_shards)][path_name] = gene_names
+    return shards_path_to_cluster, shards_duplicates
+
+def iter_queue(shard_queue):
+    """
+    yields the read groups sent by batches to a shard (see route_reads_to_shards), until None
+    """
+    while True:
+        read_groups = shard_queue.get()
+        if read_groups is None:
+            return
+        yield from read_groups
+
+def shard_failed(shard_queues, worker):
+    """
+    exits when a shard worker failed: the read groups left in the queues are dropped, the other workers are daemons
+    """
+    for shard_queue in shard_queues:
+        shard_queue.cancel_join_thread()
+    sys.exit(f"A shard worker failed (exit code {worker.exitcode})")
+
+def route_reads_to_shards(json_file_name: str, shard_queues, workers, nodes_shard, batch_size=1000):
+    """
+    send each read group of the mapping file to the queue of each shard it maps on, by batches of batch_size read groups.
+    Read groups that do not map are not sent. None is sent to each shard at the end.
+    """
+    print("Route reads to shards")
+    batches = [[] for _ in shard_queues]
+
+    def send(shard: int, read_groups):
+        # the queues are bounded: wait for the worker, unless it failed
+        while True:
+            try:
+                shard_queues[shard].put(read_groups, timeout=1)
+                return
+            except queue.Full:
+                if not workers[shard].is_alive():
+                    shard_failed(shard_queues, workers[shard])
+
+    def route(read_group):
+        node_ids = [int(node_id) for line in read_group for node_id in mpmap_node_id_regex.findall(line)]
+        node_ids = [node_id for node_id in node_ids if node_id < len(nodes_shard)]
+        for shard in np.unique(nodes_shard[node_ids]):
+            if shard < 0: continue
+            batches[shard].append(read_group)
+            if len(batches[shard]) == batch_size:
+                send(shard, batches[shard])
+                batches[shard] = []
+
+    steps = 0
+    with open_mapping_file(json_file_name) as json_file:
+        size_file = file_size(json_file)
+        for read_group in iter_read_groups(json_file):
+            steps += 1
+            if size_file and steps%10000 == 0: update_progress(json_file.buffer.tell()/size_file)
+            route(read_group)
     update_progress(1)
+    for shard, batch in enumerate(batches):
+        if batch:
+            send(shard, batch)
+        send(shard, None)
 
+def shard_worker(shard: int, graph_file, nodes_shard, path_to_cluster, duplicates, shard_queue, thr, species_names, shard_csv_file, shard_dist_err_file, shard_node_coverage_file=None):
+    """
+    load the nodes and paths of one shard, then compute its abundances from the read groups of its queue.
+    path_to_cluster and duplicates: those of the paths of the shard.
+    The error distribution of the shard is pickled for the main process.
+    """
+    sys.stderr = open(os.devnull, 'w') # no concurrent progress bars
+    pangenome = Pangenome()
+    pangenome.fill_pangenome(graph_file, keep_node=lambda node_id: node_id < len(nodes_shard) and nodes_shard[node_id] == shard, duplicates=duplicates)
+    pangenome.set_clusters_of_paths(path_to_cluster.items())
+    parse_vgmpmap(None, pangenome, thr, read_groups=iter_queue(shard_queue))
+    pangenome.print_to_csv(shard_csv_file, species_names, print_header=False)
+    if shard_node_coverage_file:
+        pangenome.print_node_coverage(shard_node_coverage_file)
+    with open(shard_dist_err_file, "wb") as dist_err_file:
+        pickle.dump(pangenome.get_error_distribution(), dist_err_file)
+    if profile:
+        profile.write(f"_shard{shard}") # atexit functions are not called in worker processes
+
+def merge_node_coverages(node_coverage_files, node_coverage_file_name):
+    """
+    concatenate node coverages (see Pangenome.get_node_coverage) of paths printed one after the other (eg. shards)
+    """
+    node_coverages = []
+    for node_coverage_file in node_coverage_files:
+        with np.load(node_coverage_file) as node_coverage:
+            node_coverages.append(dict(node_coverage))
+    nb_entries = np.cumsum([0]+[len(node_coverage["node_offsets"]) for node_coverage in node_coverages])
+    merged = {"paths_index": np.concatenate([[0]]+[node_coverage["paths_index"][1:]+offset for node_coverage, offset in zip(node_coverages, nb_entries)]).astype(np.int64)}
+    for key in ("node_offsets", "unique_mapped", "multiple_mapped"):
+        merged[key] = np.concatenate([node_coverage[key] for node_coverage in node_coverages])
+    np.savez_compressed(node_coverage_file_name, **merged)
+
+def sharded_json2csv(graph_file, clusters_file, mapping_file, thr, nb_shards: int, output_file_csv_name, dist_err_file_name, binary_dist_err=False, node_coverage_file_name=None):
+    """
+    query run with one worker process per shard. 
+    Shard outputs are concatenated in the final csv (and node coverages), shard error distributions are summed.
+    """
+    shard_csv_files = [f"{output_file_csv_name}.shard{shard}.csv" for shard in range(nb_shards)]
+    shard_dist_err_files = [f"{output_file_csv_name}.shard{shard}.pickle" for shard in range(nb_shards)]
+    shard_node_coverage_files = [f"{output_file_csv_name}.shard{shard}.npz" if node_coverage_file_name else None for shard in range(nb_shards)]
+
+    path_to_cluster = get_clusters_of_paths(clusters_file)
+    duplicates = get_duplicate_genes(clusters_file)
+    nodes_shard, species_names = get_nodes_shard(graph_file, path_to_cluster, nb_shards, duplicates)
+    shards_path_to_cluster, shards_duplicates = split_by_shard(path_to_cluster, duplicates, nb_shards)
+    del path_to_cluster, duplicates
+
+    # workers load their paths, then parse their reads while they are routed
+    shard_queues = [Queue(maxsize=64) for _ in range(nb_shards)]
+    workers = [Process(target=shard_worker, args=(shard, graph_file, nodes_shard, shards_path_to_cluster[shard], shards_duplicates[shard], shard_queues[shard], thr, species_names, shard_csv_files[shard], shard_dist_err_files[shard], shard_node_coverage_files[shard]), daemon=True) for shard in range(nb_shards)]
+    for worker in workers:
+        worker.start()
+    del shards_path_to_cluster, shards_duplicates
+    route_reads_to_shards(mapping_file, shard_queues, workers, nodes_shard)
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            shard_failed(shard_queues, worker)
+
+    # sum the error distributions of the shards
+    pangenome = Pangenome()  # only used for printing the error distribution
+    shards_error_distributions = []
+    for shard_dist_err_file in shard_dist_err_files:
+        with open(shard_dist_err_file, "rb") as dist_err_file:
+            shards_error_distributions.append(pickle.load(dist_err_file))
+    shards_strain_ids = set(strain_id for strain_ids, _ in shards_error_distributions for strain_id in strain_ids)
+    for strain_id in species_names:
+        if strain_id in shards_strain_ids:
+            pangenome.add_strain(strain_id)
+    for strain_ids, hamming_freq in shards_error_distributions:
+        pangenome.add_error_distribution(strain_ids, hamming_freq)
+
+    print(f"Print results to file {output_file_csv_name}")
+    with open(output_file_csv_name, "w") as cvs_file:
+        write_csv_header(cvs_file, species_names)
+        for shard_csv_file in shard_csv_files:
+            with open(shard_csv_file, "r") as shard_file:
+                shutil.copyfileobj(shard_file, cvs_file)
+    pangenome.print_error_distribution(dist_err_file_name, binary_dist_err)
+    if node_coverage_file_name:
+        print(f"Print node coverages to file {node_coverage_file_name}")
+        merge_node_coverages(shard_node_coverage_files, node_coverage_file_name)
+        shard_csv_files += shard_node_coverage_files
+    for shard_file in shard_csv_files + shard_dist_err_files:
+        os.remove(shard_file)
+
+
+def compute_abundances(pangenome: Pangenome, mapping_file, summary_file, thr, multi_mapped_reads=None):
+    """
+    parse the mapping file (storing its reads summary if summary_file is given), or the reads summary if there is no mapping file
+    """
+    if mapping_file:
+        parse_vgmpmap(mapping_file, pangenome, thr, multi_mapped_reads, summary_file)
+    else:
+        parse_reads_summary(summary_file, pangenome, thr, multi_mapped_reads)
 
+def thresholds_sweep(pangenome: Pangenome, mapping_file, summary_file, thresholds, strains_thresholds, output_file_prefix, binary_dist_err=False, node_coverage=False):
+    """
+    gene-level and strain-level results for several alignment score thresholds (and thresholds on the 
+    proportion of detected genes). The mapping file, if any, is parsed once, other thresholds use the reads summary.
+    """
+    import pandas as pd # only needed for strain-level results
+    from .compute_strains_abundance import compute_strains_profile
+    for thr in thresholds:
+        output_file_thr_prefix = f"{output_file_prefix}_thr{thr}"
+        pangenome.reset_abundances()
+        compute_abundances(pangenome, mapping_file, summary_file, thr)
+        mapping_file = None # next thresholds are computed from the summary
+        pangenome.print_to_csv(output_file_thr_prefix+".csv")
+        pangenome.print_error_distribution(output_file_thr_prefix+"_dist_err.txt", binary_dist_err)
+        if node_coverage:
+            pangenome.print_node_coverage(output_file_thr_prefix+"_node_coverage.npz")
+        for strains_thr in strains_thresholds:
+            strains_profile = compute_strains_profile(pd.read_csv(output_file_thr_prefix+".csv", sep=";"), strains_thr)
+            strains_profile.to_csv(f"{output_file_thr_prefix}_strainsprofile{strains_thr}.csv")
+
+# PREVIEW
+# json2csv --preview tolerance computes a rough strain profile from a subsample of the read groups: one read group every
+# 1/rate (strided, default) or each read group with probability rate (random). Unique mapped reads and equivalence classes 
+# of multi mapped reads are accumulated as in the first pass of parse_vgmpmap. Every `every` sampled reads, the multi 
+# mapped reads are distributed again (second pass) and the strain profile is recomputed. The parsing stops once 
+# mean_abund (as a proportion) and detected_genes of every strain changed by at most tolerance during patience 
+# successive profiles.
+
+def get_preview_profile(pangenome: Pangenome, multi_mapped_reads, strains_thr: float):
+    """
+    strain profile of the reads accounted so far
+    """
+    import pandas as pd # only needed for strain-level results
+    from .compute_strains_abundance import compute_strains_profile
+    pangenome.reset_multi_mapped_abundances()
+    add_multi_mapped_reads(pangenome, multi_mapped_reads)
+    csv_file = io.StringIO()
+    pangenome.print_to_csv(csv_file)
+    csv_file.seek(0)
+    return compute_strains_profile(pd.read_csv(csv_file, sep=";"), strains_thr)
+
+def get_profile_change(strains_profile, previous_strains_profile):
+    """
+    maximal change of mean_abund (as a proportion) and detected_genes of the strains between two strain profiles
+    (None without previous profile)
+    """
+    if previous_strains_profile is None:
+        return None
+    mean_abund_change = (strains_profile["mean_abund"] - previous_strains_profile["mean_abund"]).abs().max()/100
+    detected_genes_change = (strains_profile["detected_genes"].fillna(0) - previous_strains_profile["detected_genes"].fillna(0)).abs().max()
+    return max(mean_abund_change, detected_genes_change)
 
+def preview_vgmpmap(json_file_name: str, pangenome: Pangenome, thr: float, strains_thr: float, tolerance: float, rate=0.1, random_sampling=False, every=10000, patience=2, seed=1):
+    """
+    strain profile of a subsample of the reads, stopping once it is stable within tolerance.
+    Returns the strain profile and a summary: number of sampled reads, fraction of the reads used, changes of the profiles
+    """
+    print(f"Preview: {'random' if random_sampling else 'strided'} sample of {rate:.1%} of the reads, strain profile every {every} sampled reads")
+    multi_mapped_reads = {}
+    rng = random.Random(seed)
+    stride = max(1, round(1/rate))
+    nb_read_groups = 0
+    nb_sampled_reads = 0
+    strains_profile = None
+    changes = []
+    converged = False
+    with open_mapping_file(json_file_name) as json_file:
+        size_file = file_size(json_file)
+        for read_lines in iter_read_groups(json_file):
+            nb_read_groups += 1
+            if (rng.random() >= rate) if random_sampling else ((nb_read_groups-1)%stride != 0):
+                continue
+            nb_sampled_reads += 1
+            mapped_paths, aligned_read = get_all_alignments_one_read(read_lines, pangenome, thr)
+            if len(mapped_paths) > 0:
+                add_mapped_read(pangenome, resolve_alignments(pangenome, mapped_paths), len(aligned_read), multi_mapped_reads)
+            if nb_sampled_reads%every == 0:
+                previous_strains_profile = strains_profile
+                strains_profile = get_preview_profile(pangenome, multi_mapped_reads, strains_thr)
+                change = get_profile_change(strains_profile, previous_strains_profile)
+                print(f"{nb_sampled_reads} sampled reads ({nb_read_groups} reads read): change of the strain profile {change}")
+                if change is None:
+                    continue
+                changes.append(change)
+                if len(changes) >= patience and max(changes[-patience:]) <= tolerance:
+                    converged = True
+                    break
+        fraction_file_read = json_file.buffer.tell()/size_file if size_file else None
+    if not converged:
+        fraction_file_read = 1 # the whole mapping file was read
+        if nb_sampled_reads%every != 0 or strains_profile is None:
+            strains_profile = get_preview_profile(pangenome, multi_mapped_reads, strains_thr)
+    summary = {
+        "converged": converged,
+        "tolerance": tolerance,
+        "sampling": "random" if random_sampling else "strided",
+        "rate": rate,
+        "sampled_reads": nb_sampled_reads,
+        "reads_read": nb_read_groups,
+        "fraction_file_read": fraction_file_read,
+        # reads read / fraction of the file read estimates the number of reads of the file (exact if it was read entirely)
+        "fraction_reads_used": nb_sampled_reads*fraction_file_read/nb_read_groups if fraction_file_read and nb_read_groups else None,
+        "changes": changes,
+    }
+    return strains_profile, summary
+
+# PROFILING
+# json2csv --profile times the functions of the hot path (Profile.timed replaces them by timed versions, hence no cost 
+# without --profile) and counts reads, alignments, subpaths and candidate paths scanned. The cumulative and self 
+# (without the timed functions it calls) times of each phase and the counters are written in prefix_profile.json, 
+# with a throughput line on the standard error every interval seconds. --cprofile dumps cProfile statistics instead.
+
+profile = None  # Profile of the run, None without --profile
+
+class Profile:
+    def __init__(self, prefix: str, interval=10):
+        self.prefix = prefix
+        self.interval = interval
+        self.phases = {}        # key: phase name, value: [number of calls, cumulative time, self time]
+        self.counters = {}      # key: counter name, value: count
+        self.nested_times = []  # for each running phase, time spent in the timed functions it called
+        self.start = time.perf_counter()
+        self.last_report = (self.start, 0, 0) # time, number of reads and bytes of the last throughput line
+
+    def count(self, counter: str, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def timed(self, function, phase: str, count=None):
+        """
+        returns function timing its calls as phase. count(args, result) returns the (counter, n) of a call
+        """
+        def timed_function(*args, **kwargs):
+            self.nested_times.append(0)
+            t = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter()-t
+            nested_time = self.nested_times.pop()
+            if self.nested_times:
+                self.nested_times[-1] += elapsed
+            if phase not in self.phases:
+                self.phases[phase] = [0, 0, 0]
+            stats = self.phases[phase]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed-nested_time
+            if count:
+                for counter, n in count(args, result):
+                    self.count(counter, n)
+            return result
+        return timed_function
+
+    def report_throughput(self):
+        """
+        prints the throughput since the last line if it was printed more than interval seconds ago
+        """
+        t = time.perf_counter()
+        last_t, last_reads, last_bytes = self.last_report
+        if t-last_t < self.interval:
+            return
+        nb_reads, nb_bytes = self.counters.get("reads", 0), self.counters.get("bytes", 0)
+        sys.stderr.write(f"\n{nb_reads} reads, {nb_bytes/1e6:.1f} MB: {(nb_reads-last_reads)/(t-last_t):.0f} reads/s, {(nb_bytes-last_bytes)/1e6/(t-last_t):.2f} MB/s\n")
+        self.last_report = (t, nb_reads, nb_bytes)
+
+    def get_report(self):
+        wall = time.perf_counter()-self.start
+        counters = dict(self.counters)
+        if "walks" in counters:
+            counters["walks cache hits"] = counters["walks"] - counters.get("walks cache misses", 0) # a miss calls match_gene_paths
+        ratios = {}
+        for ratio, numerator, denominator in (
+                ("alignment lines per read", "alignment lines", "reads"),
+                ("subpaths per read", "subpaths", "reads"),
+                ("alignments per mapped read", "alignments", "mapped reads"),
+                ("candidate paths per match", "candidate paths", "matches"),
+                ("walks cache hit ratio", "walks cache hits", "walks")):
+            if counters.get(denominator):
+                ratios[ratio] = counters.get(numerator, 0)/counters[denominator]
+        return {
+            "wall": wall,
+            "reads/s": counters.get("reads", 0)/wall,
+            "MB/s": counters.get("bytes", 0)/1e6/wall,
+            "phases": {phase: {"calls": calls, "time": cumulative_time, "self time": self_time} for phase, (calls, cumulative_time, self_time) in sorted(self.phases.items(), key=lambda item: -item[1][2])},
+            "counters": counters,
+            "ratios": ratios,
+        }
+
+    def write(self, suffix=""):
+        report = self.get_report()
+        profile_file_name = f"{self.prefix}{suffix}_profile.json"
+        with open(profile_file_name, "w") as profile_file:
+            json.dump(report, profile_file, indent=1)
+        sys.stderr.write(f"\nProfile ({profile_file_name}): {report['wall']:.2f}s, {report['reads/s']:.0f} reads/s, {report['MB/s']:.2f} MB/s\n")
+        for phase, stats in report["phases"].items():
+            sys.stderr.write(f"\t{phase}: {stats['calls']} calls, {stats['time']:.2f}s ({stats['self time']:.2f}s self)\n")
+
+def count_read(args, result):
+    read_lines, _, _ = args
+    mapped_paths, _ = result
+    return (("reads", 1), ("alignment lines", len(read_lines)), ("bytes", sum(len(line.encode()) for line in read_lines)), ("mapped reads", len(mapped_paths) > 0))
+
+def enable_profile(prefix: str):
+    """
+    times the hot path functions of json2csv, profiling reports are written in prefix_profile.json when json2csv exits
+    """
+    global profile, BFS, get_all_alignments_one_read, get_found_gene_paths, match_gene_paths, resolve_alignments, add_mapped_read, add_multi_mapped_reads
+    profile = Profile(prefix)
+    get_all_alignments_one_read = profile.timed(get_all_alignments_one_read, "json decoding", count_read)
+    BFS = profile.timed(BFS, "BFS", lambda args, result: (("subpaths", len(args[0]['subpath'])), ("alignments", len(result))))
+    resolve_alignments = profile.timed(resolve_alignments, "alignments resolution")
+    get_found_gene_paths = profile.timed(get_found_gene_paths, "walks cache", lambda args, result: (("walks", 1),))
+    match_gene_paths = profile.timed(match_gene_paths, "paths matching", lambda args, result: (("walks cache misses", 1),))
+    Pangenome.get_matching_path = profile.timed(Pangenome.get_matching_path, "candidate paths scan", 
+        lambda args, result: (("matches", 1), ("candidate paths", len(args[0].nodes[args[1][0]].traversed_path) if args[1][0] in args[0].nodes else 0), ("matching paths", len(result))))
+    Pangenome.add_abundances = profile.timed(Pangenome.add_abundances, "abundances buffering")
+    Pangenome.flush_abundances = profile.timed(Pangenome.flush_abundances, "abundances accounting")
+    add_mapped_read = profile.timed(add_mapped_read, "first pass accounting")
+    add_multi_mapped_reads = profile.timed(add_multi_mapped_reads, "second pass accounting")
+    Pangenome.flush_errors = profile.timed(Pangenome.flush_errors, "errors accounting")
+    Pangenome.fill_pangenome = profile.timed(Pangenome.fill_pangenome, "graph loading")
+    Pangenome.print_to_csv = profile.timed(Pangenome.print_to_csv, "csv writing")
+    Pangenome.print_error_distribution = profile.timed(Pangenome.print_error_distribution, "error distribution writing")
+    atexit.register(profile.write)
+
+def enable_cprofile(prefix: str):
+    """
+    cProfile statistics of the main process are dumped in prefix_cprofile.prof when json2csv exits (eg. python -m pstats prefix_cprofile.prof)
+    """
+    import cProfile # only needed with --cprofile
+    cprofiler = cProfile.Profile()
+    cprofiler.enable()
+    atexit.register(lambda: cprofiler.dump_stats(f"{prefix}_cprofile.prof"))
+    atexit.register(cprofiler.disable)
 
 def usage():
-    print(f"Usage: python {sys.argv[0]} -g graph_file_name (gfa) -m mapped_file_name (json) -p dictionary_file_name (pickle) -t alignment_score_threshold -o prefix_output_files_name")
+    print(f"Usage: python {sys.argv[0]} -g graph_file_name (gfa) -m mapped_file_name (json, - for the standard input) -p clusters_index_file_name (clusters_index.db or dict_clusters.pickle) -t alignment_score_threshold -o prefix_output_files_name [-s nb_shards] [-d] [-r reads_summary_file_name] [--thresholds thr1,thr2,... [--strains-thresholds thr1,thr2,...]] [-b] [--node-coverage] [--preview tolerance [--preview-rate rate] [--preview-random] [--preview-every nb_reads]] [--profile] [--cprofile]")
+    print("\t-s nb_shards: process clusters in nb_shards parallel workers, each holding only the nodes and paths of its clusters [default: 1, no sharding]")
+    print("\t-d: dump the partial results of this chunk of reads in prefix_output_files_name_state.pickle instead of the final results. -p is needed: the strains of its duplicate genes are counted in the partial error distribution")
+    print("\t-r reads_summary_file_name: with -m, store a summary of the best alignments of each read in this file. Without -m, compute the results from this summary instead of the mapping file")
+    print("\t--thresholds thr1,thr2,...: compute the results for several alignment score thresholds (prefix_output_files_name_thrX.csv). The mapping file is parsed once, its summary is stored in prefix_output_files_name_summary.pickle unless -r is given")
+    print("\t--strains-thresholds thr1,thr2,...: with --thresholds (or --preview, first threshold only), thresholds on the proportion of detected specific genes of the strain-level results (prefix_output_files_name_thrX_strainsprofileY.csv) [default: 0.5]")
+    print("\t-b: also save the error distribution in numpy format (prefix_output_files_name_dist_err.txt.npz)")
+    print("\t--node-coverage: save the non zero unique and multiple mapped coverages of the nodes of each path (prefix_output_files_name_node_coverage.npz, see Pangenome.get_node_coverage)")
+    print("\t--preview tolerance: rough strain-level results (prefix_output_files_name_preview.csv) from a subsample of the reads, stopping once the mean_abund and detected_genes of the strains change by at most tolerance (eg. 0.01). The subsample and the convergence are described in prefix_output_files_name_preview.json")
+    print("\t--preview-rate rate: with --preview, proportion of the reads sampled [default: 0.1]")
+    print("\t--preview-random: with --preview, sample reads randomly instead of one read every 1/rate reads")
+    print("\t--preview-every nb_reads: with --preview, number of sampled reads between two computations of the strain profile [default: 10000]")
+    print("\t--profile: time the phases of the parsing and count reads, alignments, subpaths and candidate paths (prefix_output_files_name_profile.json, prefix_output_files_name_shardX_profile.json with -s), print the throughput every 10 seconds")
+    print("\t--cprofile: dump cProfile statistics of the main process in prefix_output_files_name_cprofile.prof")
+    print(f"Usage: python {sys.argv[0]} merge -g graph_file_name (gfa) -p clusters_index_file_name (clusters_index.db or dict_clusters.pickle) -o prefix_output_files_name [-b] [--node-coverage] state_file_name [state_file_name ...]")
+    print("\tmerge partial results dumped with -d and compute the final results")
 
     
+def json2csv_merge_main(argv):
+    
+    graph_file = None
+    clusters_file = None
+    output_file_prefix = "res"
+    binary_dist_err = False
+    node_coverage = False
+    
+    try:
+        opts, state_files = getopt.getopt(argv, "hg:p:o:b", ["node-coverage"])
+    
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(err) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o in ("-g"):
+            graph_file = a
+        elif o in ("-p"):
+            clusters_file = a
+        elif o in ("-o"):
+            output_file_prefix = a
+        elif o in ("-b"):
+            binary_dist_err = True
+        elif o == "--node-coverage":
+            node_coverage = True
+        else:
+            assert False, "unhandled option"
+    if not graph_file or not clusters_file or not state_files: 
+        usage()
+        exit()
+
+    start_report("json2csv merge", output_file_prefix+"_report.json")
+    dist_err_file_name = output_file_prefix+"_dist_err.txt"
+    output_file_csv_name = output_file_prefix+".csv"
+    panpan = Pangenome()
+    with Timer("graph loading"):
+        panpan.fill_pangenome(graph_file, duplicates=get_duplicate_genes(clusters_file))
+    with Timer("clusters loading"):
+        panpan.fill_cluster_id_for_each_path(clusters_file)
+    with Timer("partial results merging"):
+        multi_mapped_reads = load_states(panpan, state_files)
+        print(f"Multi mapped reads: second pass ({len(multi_mapped_reads)} classes of multi mapped alignments)")
+        add_multi_mapped_reads(panpan, multi_mapped_reads)
+    with Timer("results writing"):
+        panpan.print_to_csv(output_file_csv_name)
+        panpan.print_error_distribution(dist_err_file_name, binary_dist_err)
+        if node_coverage:
+            panpan.print_node_coverage(output_file_prefix+"_node_coverage.npz")
+
+    print(f"Done, csv results are in {output_file_csv_name}, and error distribution are in {dist_err_file_name}")
 
 #if __name__ == "__main__":
 def json2csv_main():
     
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        json2csv_merge_main(sys.argv[2:])
+        return
+
     graph_file = None
-    pickle_file = None
+    clusters_file = None
     mapping_file = None
+    summary_file = None
     output_file_prefix = "res"
     thr = 0.95
+    thresholds = None
+    strains_thresholds = [0.5]
+    nb_shards = 1
+    dump = False
+    binary_dist_err = False
+    node_coverage = False
+    profiling = False
+    cprofile = False
+    preview_tolerance = None
+    preview_rate = 0.1
+    preview_random = False
+    preview_every = 10000
     
     try:
-        opts, _ = getopt.getopt(sys.argv[1:], "hg:p:o:m:t:")
+        opts, _ = getopt.getopt(sys.argv[1:], "hg:p:o:m:t:s:dr:b", ["thresholds=", "strains-thresholds=", "node-coverage", "profile", "cprofile", "preview=", "preview-rate=", "preview-random", "preview-every="])
     
     except getopt.GetoptError as err:
         # print help information and exit:
@@ -730,30 +1694,116 @@ def json2csv_main():
         elif o in ("-m"):
             mapping_file = a
         elif o in ("-p"):
-            pickle_file = a
+            clusters_file = a
         elif o in ("-o"):
             output_file_prefix = a
         elif o in ("-t"):
-            thr = a
+            thr = float(a)
+        elif o in ("-s"):
+            nb_shards = int(a)
+        elif o in ("-d"):
+            dump = True
+        elif o in ("-r"):
+            summary_file = a
+        elif o in ("-b"):
+            binary_dist_err = True
+        elif o == "--thresholds":
+            thresholds = [float(t) for t in a.split(",")]
+        elif o == "--strains-thresholds":
+            strains_thresholds = [float(t) for t in a.split(",")]
+        elif o == "--node-coverage":
+            node_coverage = True
+        elif o == "--profile":
+            profiling = True
+        elif o == "--cprofile":
+            cprofile = True
+        elif o == "--preview":
+            preview_tolerance = float(a)
+        elif o == "--preview-rate":
+            preview_rate = float(a)
+        elif o == "--preview-random":
+            preview_random = True
+        elif o == "--preview-every":
+            preview_every = int(a)
         
         else:
             assert False, "unhandled option"
-    if not graph_file or not pickle_file or not mapping_file: 
+    if not graph_file or (not mapping_file and not summary_file) or not clusters_file: 
         usage()
         exit()
-
+    if nb_shards > 1 and (dump or summary_file or thresholds):
+        sys.exit("Partial results (-d), reads summary (-r) and thresholds (--thresholds) are not available in sharded mode (-s)")
+    if dump and thresholds:
+        sys.exit("Partial results (-d) are computed for a single threshold (-t)")
+    if preview_tolerance is not None and (not mapping_file or nb_shards > 1 or dump or summary_file or thresholds):
+        sys.exit("The preview (--preview) reads the mapping file (-m), it is not available with -s, -d, -r and --thresholds")
+    start_report("json2csv", output_file_prefix+"_report.json")
+    if profiling:
+        enable_profile(output_file_prefix)
+    if cprofile:
+        enable_cprofile(output_file_prefix)
+
+    if dump:
+        state_file_name = output_file_prefix+"_state.pickle"
+        panpan = Pangenome()
+        with Timer("graph loading"):
+            # the error distribution of the chunk counts the strains of the duplicate genes, it cannot be completed by json2csv merge
+            panpan.fill_pangenome(graph_file, duplicates=get_duplicate_genes(clusters_file))
+        panpan.paths_name_to_ids = {} # path names are only used for filling the clusters
+        multi_mapped_reads = {}
+        with Timer("alignments parsing"):
+            compute_abundances(panpan, mapping_file, summary_file, thr, multi_mapped_reads)
+        with Timer("partial results writing"):
+            dump_state(panpan, multi_mapped_reads, state_file_name)
+        print(f"Done, partial results are in {state_file_name}")
+        return
+
+    if preview_tolerance is not None:
+        panpan = Pangenome()
+        with Timer("graph loading"):
+            panpan.fill_pangenome(graph_file, duplicates=get_duplicate_genes(clusters_file))
+        with Timer("clusters loading"):
+            panpan.fill_cluster_id_for_each_path(clusters_file)
+        with Timer("preview"):
+            strains_profile, summary = preview_vgmpmap(mapping_file, panpan, thr, strains_thresholds[0], preview_tolerance, preview_rate, preview_random, preview_every)
+        strains_profile.to_csv(f"{output_file_prefix}_preview.csv")
+        with open(f"{output_file_prefix}_preview.json", "w") as summary_file:
+            json.dump(summary, summary_file, indent=1)
+        fraction_reads_used = f"{summary['fraction_reads_used']:.1%}" if summary['fraction_reads_used'] is not None else "unknown fraction"
+        print(f"Done, {'converged' if summary['converged'] else 'not converged'} with {summary['sampled_reads']} reads ({fraction_reads_used} of the reads), strain-level results are in {output_file_prefix}_preview.csv")
+        return
+
+    if thresholds:
+        if mapping_file and not summary_file:
+            summary_file = output_file_prefix+"_summary.pickle"
+        panpan = Pangenome()
+        with Timer("graph loading"):
+            panpan.fill_pangenome(graph_file, duplicates=get_duplicate_genes(clusters_file))
+        with Timer("clusters loading"):
+            panpan.fill_cluster_id_for_each_path(clusters_file)
+        with Timer("thresholds sweep"):
+            thresholds_sweep(panpan, mapping_file, summary_file, thresholds, strains_thresholds, output_file_prefix, binary_dist_err, node_coverage)
+        print(f"Done, results are in {output_file_prefix}_thr*")
+        return
 
     dist_err_file_name = output_file_prefix+"_dist_err.txt"
     output_file_csv_name = output_file_prefix+".csv"
-    panpan = Pangenome()
-    panpan.fill_pangenome(graph_file)
-    panpan.fill_cluster_id_for_each_path(pickle_file)
-    parse_vgmpmap(mapping_file, panpan, thr)
-    panpan.print_to_csv(output_file_csv_name)
-    panpan.print_error_distribution(dist_err_file_name)
+    node_coverage_file_name = output_file_prefix+"_node_coverage.npz" if node_coverage else None
+    if nb_shards > 1:
+        with Timer("sharded alignments parsing"):
+            sharded_json2csv(graph_file, clusters_file, mapping_file, thr, nb_shards, output_file_csv_name, dist_err_file_name, binary_dist_err, node_coverage_file_name)
+    else:
+        panpan = Pangenome()
+        with Timer("graph loading"):
+            panpan.fill_pangenome(graph_file, duplicates=get_duplicate_genes(clusters_file))
+        with Timer("clusters loading"):
+            panpan.fill_cluster_id_for_each_path(clusters_file)
+        with Timer("alignments parsing"):
+            compute_abundances(panpan, mapping_file, summary_file, thr)
+        with Timer("results writing"):
+            panpan.print_to_csv(output_file_csv_name)
+            panpan.print_error_distribution(dist_err_file_name, binary_dist_err)
+            if node_coverage:
+                panpan.print_node_coverage(node_coverage_file_name)
 
     print(f"Done, csv results are in {output_file_csv_name}, and error distribution are in {dist_err_file_name}")
-
-            
-
-   
\ No newline at end of file
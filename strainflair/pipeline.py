@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import subprocess # run the stages
+import os
+import sys # manage arguments
+import getopt # manage arguments
+import glob # outputs of a stage to remove before running it again
+import hashlib # content hash of the inputs of the stages
+import json # checkpoints
+import shutil # check dependencies, remove outputs
+import time # times stored in log
+import logging # log.txt with times
+from .telemetry import Timer, setup_logger, format_time, start_report, record_command # times and resources stored in log and run report
+
+def check_dependencies(tools):
+    for tool in tools:
+        if not shutil.which(tool):
+            print(f"{sys.argv[0]} requires {tool}")
+            sys.exit(1)
+
+class Stage:
+    """
+    A step of the pipeline: a shell command with its input and output files.
+    """
+    def __init__(self, name: str, cmd: str, inputs, outputs, deps=(), resume_cmd=None, clean=()):
+        self.name = name
+        self.cmd = cmd                      # bash command
+        self.inputs = list(inputs)          # input files, their content is part of the checkpoint of the stage
+        self.outputs = list(outputs)        # output files, the stage is run again if one of them is missing
+        self.deps = list(deps)              # names of the stages producing the inputs
+        self.resume_cmd = resume_cmd        # command resuming an interrupted run of this stage with the same command and inputs, if possible
+        self.clean = list(clean)            # files and directories (glob patterns) removed before running the stage from scratch
+
+class Pipeline:
+    """
+    Run stages as a DAG, independent stages being run concurrently.
+    A stage whose command and inputs content did not change since its last successful run, and whose outputs exist, is skipped.
+    An interrupted stage is resumed if it has a resume command, otherwise it is run from scratch.
+    """
+    def __init__(self, checkpoints_dir: str, max_jobs: int, logger):
+        self.checkpoints_dir = checkpoints_dir
+        self.max_jobs = max_jobs
+        self.logger = logger
+        os.makedirs(checkpoints_dir, exist_ok=True)
+        # content hash of files, recomputed only if their size or modification time changed
+        self.files_hashes_file = f"{checkpoints_dir}/files_hashes.json"
+        self.files_hashes = {}
+        if os.path.exists(self.files_hashes_file):
+            with open(self.files_hashes_file) as f:
+                self.files_hashes = json.load(f)
+
+    def file_hash(self, file_name: str, block_size=1<<24):
+        stat = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        if path in self.files_hashes and self.files_hashes[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+            return self.files_hashes[path][2]
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(file_name, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                content_hash.update(block)
+        self.files_hashes[path] = [stat.st_size, stat.st_mtime_ns, content_hash.hexdigest()]
+        with open(self.files_hashes_file, "w") as f:
+            json.dump(self.files_hashes, f)
+        return self.files_hashes[path][2]
+
+    def get_signature(self, stage: Stage):
+        signature = hashlib.blake2b(digest_size=16)
+        signature.update(stage.cmd.encode())
+        for input_file in stage.inputs:
+            signature.update(f"\n{input_file}:{self.file_hash(input_file)}".encode())
+        return signature.hexdigest()
+
+    def read_checkpoint(self, stage: Stage):
+        checkpoint_file = f"{self.checkpoints_dir}/{stage.name}.json"
+        if not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, stage: Stage, signature: str, done: bool):
+        with open(f"{self.checkpoints_dir}/{stage.name}.json", "w") as f:
+            json.dump({"signature": signature, "done": done}, f)
+
+    def prepare(self, stage: Stage):
+        """
+        returns the command to run for this stage and its signature, no command if the stage is up to date
+        """
+        signature = self.get_signature(stage)
+        checkpoint = self.read_checkpoint(stage)
+        if checkpoint and checkpoint["signature"] == signature:
+            if checkpoint["done"] and all(os.path.exists(output) for output in stage.outputs):
+                return None, signature
+            if not checkpoint["done"] and stage.resume_cmd:
+                return stage.resume_cmd, signature
+        for pattern in stage.clean:
+            for path in glob.glob(pattern):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        return stage.cmd, signature
+
+    def run(self, stages):
+        """
+        returns True if all stages are done
+        """
+        pending = {stage.name: stage for stage in stages}
+        done = set()
+        running = {} # stage name: (stage, process, signature, start time)
+        failed = False
+        while True:
+            # launch the stages whose dependencies are done
+            launched = True
+            while launched and not failed:
+                launched = False
+                for name, stage in list(pending.items()):
+                    if len(running) >= self.max_jobs:
+                        break
+                    if not all(dep in done for dep in stage.deps):
+                        continue
+                    del pending[name]
+                    launched = True
+                    cmd, signature = self.prepare(stage)
+                    if cmd is None:
+                        print(f"{name}: up to date, skipped")
+                        self.logger.info(f"{name} up to date, skipped")
+                        done.add(name)
+                        continue
+                    print(f"{name}: {cmd}")
+                    self.logger.info(f"{name} started: {cmd}")
+                    self.write_checkpoint(stage, signature, False)
+                    running[name] = (stage, subprocess.Popen(["bash", "-o", "pipefail", "-c", cmd]), signature, time.time())
+            if not running:
+                break
+            time.sleep(1)
+            for name, (stage, process, signature, start) in list(running.items()):
+                # wait4 instead of poll: resource usage of the stage (bash and the tools it ran)
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid == 0:
+                    continue
+                process.returncode = os.waitstatus_to_exitcode(status)
+                record_command(process.args[-1], time.time()-start, rusage, process.returncode, tool=name)
+                del running[name]
+                if process.returncode != 0:
+                    print(f"there was a problem with {name}")
+                    self.logger.error(f"{name} failed with exit code {process.returncode}")
+                    failed = True
+                    continue
+                self.write_checkpoint(stage, signature, True)
+                done.add(name)
+                print(f"{name} done in: {format_time(time.time()-start)}")
+                self.logger.info(f"{name} done in: {format_time(time.time()-start)}")
+        return not failed and not pending
+
+def index_stages(input_data: str, directory_output: str, len_extension: int, cdhit_options: str, partition_jobs=0, collapse_duplicates=False):
+    fasta_files = [input_data]
+    if not (input_data.endswith(".fasta") or input_data.endswith(".fna")):
+        with open(input_data) as f:
+            fasta_files += [line.rstrip("\n") for line in f if line.strip()]
+    graphs = f"{directory_output}/graphs"
+    # identical genes are written once by genes_prediction, the others are stored in the clusters index
+    duplicates_option = " -u" if collapse_duplicates else ""
+    duplicates_files = [f"{directory_output}/all_genes_duplicates.tsv"] if collapse_duplicates else []
+    graphs_duplicates_option = f" -u {directory_output}/all_genes_duplicates.tsv" if collapse_duplicates else ""
+    clustering_cmd = f"cd-hit-est -i {directory_output}/all_genes.fasta -o {directory_output}/clusters/all_genes_clusters {cdhit_options}"
+    if partition_jobs:
+        # cd-hit-est on groups of possibly similar genes, run in parallel
+        clustering_cmd = f"genes_clustering -i {directory_output}/all_genes.fasta -o {directory_output}/clusters/all_genes_clusters -x '{cdhit_options}' -j {partition_jobs}"
+    return [
+        Stage("genes_prediction",
+            f"genes_prediction -s {input_data} -o {directory_output} -l {len_extension}{duplicates_option}",
+            fasta_files, [f"{directory_output}/all_genes.fasta", f"{directory_output}/all_genes_extended.fasta"] + duplicates_files,
+            clean=[f"{directory_output}/predGenes_*", f"{directory_output}/chunks_*"]),
+        Stage("genes_clustering",
+            f"mkdir -p {directory_output}/clusters && {clustering_cmd}",
+            [f"{directory_output}/all_genes.fasta"], [f"{directory_output}/clusters/all_genes_clusters.clstr"],
+            deps=["genes_prediction"]),
+        # only the graphs of the clusters not built yet are built when resuming
+        Stage("graphs_construction",
+            f"mkdir -p {graphs} && graphs_construction -s {directory_output}/all_genes_extended.fasta -c {directory_output}/clusters/all_genes_clusters.clstr -o {graphs}{graphs_duplicates_option}",
+            [f"{directory_output}/all_genes_extended.fasta", f"{directory_output}/clusters/all_genes_clusters.clstr"] + duplicates_files, [f"{graphs}/clusters_index.db"],
+            deps=["genes_prediction", "genes_clustering"],
+            resume_cmd=f"graphs_construction -s {directory_output}/all_genes_extended.fasta -c {directory_output}/clusters/all_genes_clusters.clstr -o {graphs} -r{graphs_duplicates_option}",
+            clean=[f"{graphs}/*.vg", f"{graphs}/*.vg.tmp"]),
+        # concat_graphs combines the graphs already combined by an interrupted run with the remaining ones
+        Stage("graphs_concatenation",
+            f"concat_graphs -i {graphs} -s 1000",
+            [f"{graphs}/clusters_index.db"], [f"{graphs}/all_graphs.vg"],
+            deps=["graphs_construction"],
+            resume_cmd=f"concat_graphs -i {graphs} -s 1000"),
+        # the gfa and the indexes only depend on the concatenated graph, they are built concurrently
+        Stage("vg_to_gfa",
+            f"vg view {graphs}/all_graphs.vg > {graphs}/all_graphs.gfa",
+            [f"{graphs}/all_graphs.vg"], [f"{graphs}/all_graphs.gfa"],
+            deps=["graphs_concatenation"]),
+        Stage("xg_index",
+            f"vg index -x {graphs}/all_graphs.xg {graphs}/all_graphs.vg",
+            [f"{graphs}/all_graphs.vg"], [f"{graphs}/all_graphs.xg"],
+            deps=["graphs_concatenation"]),
+        Stage("gcsa_index",
+            f"vg prune {graphs}/all_graphs.vg | vg index -g {graphs}/all_graphs.gcsa -",
+            [f"{graphs}/all_graphs.vg"], [f"{graphs}/all_graphs.gcsa"],
+            deps=["graphs_concatenation"]),
+        Stage("snarls",
+            f"vg snarls {graphs}/all_graphs.vg > {graphs}/all_graphs.snarls",
+            [f"{graphs}/all_graphs.vg"], [f"{graphs}/all_graphs.snarls"],
+            deps=["graphs_concatenation"]),
+    ]
+
+def query_stages(graph: str, reads1: str, reads2: str, vg_t: int, clusters_data: str, directory_output: str, filename_output: str, threshold: float, keep_gamp=False):
+    reads = [reads1] + ([reads2] if reads2 else [])
+    mapping = f"{directory_output}/mapping/mapping_{filename_output}"
+    results = f"{directory_output}/results"
+    # the alignments are converted to json and accumulated by json2csv as vg mpmap outputs them
+    # the .gamp is written only if asked, no json file is written
+    tee_gamp = f" | tee {mapping}.gamp" if keep_gamp else ""
+    return [
+        Stage("mapping_gene_level",
+            f"vg mpmap -x {graph}.xg -g {graph}.gcsa -s {graph}.snarls {' '.join(f'-f {r}' for r in reads)} -t {vg_t} -M 10 -m -L 0{tee_gamp} | vg view -j -K - | json2csv -g {graph}.gfa -m - -p {clusters_data} -o {results}/genelevel_{filename_output}",
+            [f"{graph}.xg", f"{graph}.gcsa", f"{graph}.snarls", f"{graph}.gfa", clusters_data] + reads,
+            [f"{results}/genelevel_{filename_output}.csv"] + ([f"{mapping}.gamp"] if keep_gamp else [])),
+        Stage("strain_level",
+            f"compute_strains_abundance -i {results}/genelevel_{filename_output}.csv -o {results}/strainsprofile_{filename_output} -t {threshold}",
+            [f"{results}/genelevel_{filename_output}.csv"], [f"{results}/strainsprofile_{filename_output}.csv"],
+            deps=["mapping_gene_level"]),
+    ]
+
+def usage_index():
+    print(f"Usage: {sys.argv[0]} index -i file_of_files -o directory_output_name [OPTIONS]")
+    print("\nMANDATORY")
+    print("\t -i <file name of a file of file(s) or of a fasta file>")
+    print("\t    In case of a fasta file: each fasta input line is considered as a genome")
+    print("\t    In case of a .txt file: each line contains a fasta file, and each of these fasta is considered as a genome. In this case a genome can span several line, for instance for perfectly assembled genomes")
+    print("\t -o <directory_output_name>. All results are stored in this directory. If it contains a previous run, stages whose inputs and options did not change are skipped and interrupted stages are resumed")
+    print("\nOPTIONS")
+    print("\ngenes prediction:")
+    print("\t -l value <int value>. Set the length of the sequences on the left and right part of each predicted gene, added to the indexation graph. [default: 75]")
+    print("\t -u Genes with the same sequence are clustered and added to the graphs once, their strains are still counted by json2csv")
+    print("\ngenes clustering:")
+    print("\t -c value <float value>. Sequence identity threshold [default: 0.95]")
+    print("\t -aS value <float value>. Alignment coverage for the shorter sequence [default: 0.90]")
+    print("\t -g 0 or 1. [default: 1]")
+    print("\t    If set to 0, a sequence is clustered to the first cluster that meet the threshold.")
+    print("\t    If set to 1, a sequence is clustered to the most similar cluster that meet the threshold.")
+    print("\t -d value <int value>. Length of description in .clstr file [default: 0]")
+    print("\t -M value <int value>. Memory limit (in MB) ; 0 for unlimited. [default: 0]")
+    print("\t -T value <int value>. Number of threads ; with 0, all CPUs will be used. [default: 0]")
+    print("\t -G 0 or 1. [default: 0]")
+    print("\t    If set to 0, use local sequence identity.")
+    print("\t    If set to 1, use global sequence identity.")
+    print("\t -P value <int value>. Split the genes into groups of possibly similar genes (MinHash sketches) and run this number of cd-hit-est concurrently on the groups. [default: 0, a single cd-hit-est]")
+    print("\nglobal:")
+    print("\t -j value <int value>. Maximal number of stages run concurrently (gfa, xg, gcsa and snarls are built concurrently) [default: 4]")
+    print("\t -h Prints this message and exit\n")
+
+def usage_query():
+    print(f"Usage: {sys.argv[0]} query -g graph -f1 reads1 -f2 reads2 -t threads -p clusters_index -d output_directory_name -o output_files_name [OPTIONS]")
+    print("\nMANDATORY")
+    print("\t -g <file name of a graph (no format)>")
+    print("\t -f1 <single-end reads or pair1 of paired-end reads (fastq or fastq.gz)>")
+    print("\t -t <number of threads to use for mapping>")
+    print("\t -p <clusters index file (graphs/clusters_index.db) containing the clusters of the genes>")
+    print("\t -d <output_directory_name>. Name of the directory in which all files are output.")
+    print("\t -o <output_files_name>. Specific name for the output files. Stages of a previous query with this name whose inputs and options did not change are skipped")
+    print("\nOPTIONS")
+    print("\t -f2 <pair2 of paired-end reads (fastq or fastq.gz)>")
+    print("\t -s value <float value between [0-1]>. Set the threshold on proportion of detected specific genes. [default=0.5]")
+    print("\t -k Keep the mapping file (output_directory_name/mapping/mapping_output_files_name.gamp). The alignments are quantified as they are mapped, the mapping file is not needed")
+    print("\t -j value <int value>. Maximal number of stages run concurrently [default: 4]")
+    print("\t -h Prints this message and exit\n")
+
+def usage():
+    print(f"Usage: {sys.argv[0]} [index/query]")
+
+def get_opts(argv, short_options: str, long_options):
+    """
+    getopt with the two-letters options of StrainFLAIR.sh (-f1, -f2, -aS) given as long options
+    """
+    argv = [f"-{arg}" if arg.startswith("-") and arg[1:] in long_options else arg for arg in argv]
+    return getopt.getopt(argv, short_options, [option+"=" for option in long_options])
+
+def index_main(argv):
+    input_data = None
+    directory_output = None
+    len_extension = 75
+    cdhit = {"-c": "0.95", "-aS": "0.90", "-g": "1", "-d": "0", "-M": "0", "-T": "0", "-G": "0"}
+    max_jobs = 4
+    partition_jobs = 0
+    collapse_duplicates = False
+    try:
+        opts, _ = get_opts(argv, "hi:o:l:c:g:d:M:T:G:j:P:u", ["aS"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage_index()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-h":
+            usage_index()
+            sys.exit()
+        elif o == "-i":
+            input_data = a
+        elif o == "-o":
+            directory_output = a
+        elif o == "-l":
+            len_extension = int(a)
+        elif o == "-j":
+            max_jobs = int(a)
+        elif o == "-P":
+            partition_jobs = int(a)
+        elif o == "-u":
+            collapse_duplicates = True
+        elif o == "--aS":
+            cdhit["-aS"] = a
+        else:
+            cdhit[o] = a
+    if not input_data or not directory_output:
+        usage_index()
+        sys.exit(1)
+    check_dependencies(["prodigal", "cd-hit-est", "minimap2", "seqwish", "vg"])
+    os.makedirs(directory_output, exist_ok=True)
+    setup_logger("logger", f"{directory_output}/pipeline_log.txt", mode="a")
+    logger = logging.getLogger("logger")
+    start_report("pipeline index", f"{directory_output}/pipeline_index_report.json")
+    cdhit_options = ' '.join(f"{option} {value}" for option, value in cdhit.items())
+    with Timer() as _t:
+        pipeline = Pipeline(f"{directory_output}/checkpoints/index", max_jobs, logger)
+        success = pipeline.run(index_stages(input_data, directory_output, len_extension, cdhit_options, partition_jobs, collapse_duplicates))
+    logger.info(f"Indexation {'done' if success else 'failed'} in: {_t.t}")
+    if not success:
+        sys.exit(1)
+
+def query_main(argv):
+    graph = None
+    reads1 = None
+    reads2 = None
+    vg_t = 16
+    clusters_data = None
+    directory_output = None
+    filename_output = None
+    threshold = 0.5
+    keep_gamp = False
+    max_jobs = 4
+    try:
+        opts, _ = get_opts(argv, "hg:t:p:d:o:s:kj:", ["f1", "f2"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage_query()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-h":
+            usage_query()
+            sys.exit()
+        elif o == "-g":
+            graph = a
+        elif o == "--f1":
+            reads1 = a
+        elif o == "--f2":
+            reads2 = a
+        elif o == "-t":
+            vg_t = int(a)
+        elif o == "-p":
+            clusters_data = a
+        elif o == "-d":
+            directory_output = a
+        elif o == "-o":
+            filename_output = a
+        elif o == "-s":
+            threshold = float(a)
+        elif o == "-k":
+            keep_gamp = True
+        elif o == "-j":
+            max_jobs = int(a)
+    if not graph or not reads1 or not clusters_data or not directory_output or not filename_output:
+        usage_query()
+        sys.exit(1)
+    check_dependencies(["vg"])
+    os.makedirs(f"{directory_output}/mapping", exist_ok=True)
+    os.makedirs(f"{directory_output}/results", exist_ok=True)
+    setup_logger("logger", f"{directory_output}/pipeline_log.txt", mode="a")
+    logger = logging.getLogger("logger")
+    start_report("pipeline query", f"{directory_output}/pipeline_query_{filename_output}_report.json")
+    with Timer() as _t:
+        pipeline = Pipeline(f"{directory_output}/checkpoints/query_{filename_output}", max_jobs, logger)
+        success = pipeline.run(query_stages(graph, reads1, reads2, vg_t, clusters_data, directory_output, filename_output, threshold, keep_gamp))
+    logger.info(f"Query {filename_output} {'done' if success else 'failed'} in: {_t.t}")
+    if not success:
+        sys.exit(1)
+
+#if __name__ == "__main__":
+def pipeline_main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("index", "query"):
+        usage()
+        sys.exit(1)
+    if sys.argv[1] == "index":
+        index_main(sys.argv[2:])
+    else:
+        query_main(sys.argv[2:])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time # wall times
+import json # run report
+import atexit # the run report is written when the entry point exits
+import logging # log.txt with times
+import resource # CPU time, peak memory and I/O of the process and of its children
+import subprocess # external tools (prodigal, minimap2, seqwish, vg)
+import tempfile # outputs of the external tools
+
+# Run report of the current entry point (see start_report): wall time, CPU time, peak memory (RSS) and bytes
+# read and written from storage, for each stage of the entry point and for each external command it runs.
+# Commands run by the workers of a pool are appended, one json per line, to a file read when the report is written.
+# Tasks run by an executor (see executor.py) are stored with their duration, resources and attempts.
+report = None
+report_file_name = None
+commands_file_name = None
+
+def setup_logger(name, log_path, mode="w"):
+    l = logging.getLogger(name)
+    formatter = logging.Formatter("%(asctime)s -- %(levelname)s -- %(message)s")
+    fileHandler = logging.FileHandler(log_path, mode=mode)
+    fileHandler.setFormatter(formatter)
+
+    l.setLevel(logging.DEBUG)
+    l.addHandler(fileHandler)
+
+def format_time(seconds: float):
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
+
+def get_maxrss_bytes(rusage):
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss*1024
+
+def get_metrics(rusage):
+    """
+    CPU time (s), peak RSS (bytes) and bytes read and written from storage of a resource usage
+    """
+    return {
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss": get_maxrss_bytes(rusage),
+        "read_bytes": rusage.ru_inblock*512,
+        "write_bytes": rusage.ru_oublock*512,
+    }
+
+def get_usage():
+    """
+    metrics of this process plus its terminated children. The peak RSS is the max of both
+    """
+    self_metrics = get_metrics(resource.getrusage(resource.RUSAGE_SELF))
+    children_metrics = get_metrics(resource.getrusage(resource.RUSAGE_CHILDREN))
+    usage = {key: self_metrics[key]+children_metrics[key] for key in ("cpu", "read_bytes", "write_bytes")}
+    usage["peak_rss"] = max(self_metrics["peak_rss"], children_metrics["peak_rss"])
+    return usage
+
+class Timer:
+    """
+    Wall time of a block (self.t, as HH:MM:SS.ss).
+    With a stage name, the metrics of the block are added to the run report. The peak RSS is the one
+    reached at the end of the block since the start of the process.
+    """
+    def __init__(self, stage=None):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t1 = time.time()
+        self.usage = get_usage() if self.stage else None
+        return self
+
+    def __exit__(self, *args):
+        self.t2 = time.time()
+        self.t = format_time(self.t2-self.t1)
+        if self.stage and report is not None:
+            usage = get_usage()
+            stage = {"name": self.stage, "wall": self.t2-self.t1}
+            stage.update({key: usage[key]-self.usage[key] for key in ("cpu", "read_bytes", "write_bytes")})
+            stage["peak_rss"] = usage["peak_rss"]
+            report["stages"].append(stage)
+
+def start_report(name: str, file_name: str):
+    """
+    starts the run report of an entry point, written in file_name (json) when it exits
+    """
+    global report, report_file_name, commands_file_name
+    report = {"name": name, "argv": sys.argv, "start": time.time(), "stages": [], "commands": [], "tasks": []}
+    report_file_name = file_name
+    commands_file_name = file_name + ".commands"
+    if os.path.exists(commands_file_name):
+        os.remove(commands_file_name)
+    atexit.register(write_report)
+
+def get_tool_name(cmd):
+    words = cmd.split() if isinstance(cmd, str) else [str(word) for word in cmd]
+    if not words:
+        return ""
+    # vg subcommands are distinct tools
+    if os.path.basename(words[0]) == "vg" and len(words) > 1:
+        return f"vg {words[1]}"
+    return os.path.basename(words[0])
+
+def record_command(cmd, wall: float, rusage, returncode: int, tool=None):
+    """
+    adds an external command to the run report, with the resource usage of the command and of its own children (eg. a pipe)
+    """
+    if report is None:
+        return
+    command = {"tool": tool or get_tool_name(cmd), "cmd": cmd if isinstance(cmd, str) else ' '.join(str(word) for word in cmd), "returncode": returncode, "wall": wall}
+    command.update(get_metrics(rusage))
+    # one write per line: lines of concurrent workers are not mixed
+    with open(commands_file_name, "a") as f:
+        f.write(json.dumps(command)+"\n")
+
+def record_task(task):
+    """
+    adds a task of an executor to the run report (dict with name, returncode, wall, attempts, killed and the metrics of the task)
+    """
+    if report is None:
+        return
+    report["tasks"].append(task)
+
+def run(cmd, shell=False, stdout=None, stderr=None, check=False):
+    """
+    subprocess.run recording the command in the run report
+    stdout and stderr are None, subprocess.PIPE or a file
+    """
+    outputs = {}
+    for key, output in (("stdout", stdout), ("stderr", stderr)):
+        # a pipe would need communicate(), that waits for the process: outputs are captured in temporary files
+        outputs[key] = tempfile.TemporaryFile() if output == subprocess.PIPE else output
+    t1 = time.time()
+    process = subprocess.Popen(cmd, shell=shell, stdout=outputs["stdout"], stderr=outputs["stderr"])
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record_command(cmd, time.time()-t1, rusage, process.returncode)
+    captured = {}
+    for key, output in (("stdout", stdout), ("stderr", stderr)):
+        captured[key] = None
+        if output == subprocess.PIPE:
+            outputs[key].seek(0)
+            captured[key] = outputs[key].read()
+            outputs[key].close()
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, captured["stdout"], captured["stderr"])
+    return subprocess.CompletedProcess(cmd, process.returncode, captured["stdout"], captured["stderr"])
+
+def summarize_commands(commands):
+    """
+    number of calls and total wall time, CPU time and I/O bytes, and max peak RSS of each tool
+    """
+    tools = {}
+    for command in commands:
+        if command["tool"] not in tools:
+            tools[command["tool"]] = {"calls": 0, "wall": 0, "cpu": 0, "read_bytes": 0, "write_bytes": 0, "peak_rss": 0, "failures": 0}
+        tool = tools[command["tool"]]
+        tool["calls"] += 1
+        tool["failures"] += command["returncode"] != 0
+        for key in ("wall", "cpu", "read_bytes", "write_bytes"):
+            tool[key] += command[key]
+        tool["peak_rss"] = max(tool["peak_rss"], command["peak_rss"])
+    return tools
+
+def summarize_tasks(tasks):
+    """
+    number of tasks, of failures and of stragglers killed, and quantiles of the wall times of the tasks done
+    """
+    walls = sorted(task["wall"] for task in tasks if task["returncode"] == 0)
+    summary = {"tasks": len(tasks), "failures": sum(task["returncode"] != 0 and not task["killed"] for task in tasks), "killed": sum(task["killed"] for task in tasks)}
+    for name, quantile in (("wall_median", 0.5), ("wall_p95", 0.95), ("wall_max", 1)):
+        summary[name] = walls[min(len(walls)-1, int(quantile*len(walls)))] if walls else None
+    summary["cpu"] = sum(task["cpu"] for task in tasks)
+    return summary
+
+def write_report():
+    global report
+    if report is None:
+        return
+    if os.path.exists(commands_file_name):
+        with open(commands_file_name) as f:
+            report["commands"] += [json.loads(line) for line in f]
+        os.remove(commands_file_name)
+    report["wall"] = time.time()-report["start"]
+    report.update(get_usage())
+    report["tools"] = summarize_commands(report["commands"])
+    if report["tasks"]:
+        report["tasks_summary"] = summarize_tasks(report["tasks"])
+    with open(report_file_name, "w") as f:
+        json.dump(report, f, indent=1)
+    report = None